@@ -0,0 +1,220 @@
+"""
+Checks that the menu caches of several worker processes stay coherent.
+
+Starts --writers processes that each rename a drink of their own through
+PATCH /drinks/<id>, again and again, and --readers processes that poll
+GET /drinks for those drinks, each process with an app of its own on the
+same database, as the workers of a prefork server would be. Every reader
+serves the menu from its own menu cache, so only the generation file
+tells it about the writes of the other processes. Run from the backend
+directory::
+
+    python bench/coherence.py --readers 4 --writers 2 --writes 200
+
+The readers revalidate like a client whose requests are spread across
+the workers: each read sends the ETag of the latest menu any reader got
+in If-None-Match, and a 304 is taken to show that menu. A read that
+started after a write had been answered must show that write or a later
+one. Any read that didn't, whether a 200 or a 304 to a stale tag, is
+counted as stale, with how long the newer title had been committed; the
+run exits with status 1 if there are any. The lag is the time from a
+write being answered to each reader returning it. With --generation-file
+off every process keeps its cache to itself, which shows the stale reads
+the generation file prevents.
+
+"""
+
+import argparse
+import bisect
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+BACKEND = os.path.dirname(BENCH)
+
+
+def process_config(url, generation, keys):
+    from run import auth_config
+
+    return dict(auth_config(keys), DATABASE_URL=url, SLOW_REQUEST_MS=0,
+                RATE_LIMITS='off', MENU_GENERATION_FILE=generation)
+
+
+def write(index, args, config, headers, start, results):
+    from src.api import create_app
+
+    client = create_app(config).test_client()
+    rng = random.Random(index)
+    done = []
+    time.sleep(max(0.0, start - time.monotonic()))
+    for n in range(1, args.writes + 1):
+        response = client.patch('/drinks/%d' % (index + 1),
+                                json={'title': 'writer %d %d' % (index, n)},
+                                headers=headers)
+        if response.status_code != 200:
+            raise SystemExit('PATCH answered %d' % response.status_code)
+        done.append(time.monotonic())
+        time.sleep(rng.uniform(0, args.pause / 1000.0))
+    results.put(('writer', index, done, None))
+
+
+def read(index, args, config, start, stop, latest, results):
+    from src.api import create_app
+    from src.database.cache import menu_cache
+
+    client = create_app(config).test_client()
+    path = '/drinks?fields=id,title&limit=%d' % args.writers
+    tag, seen = latest
+    reads = []
+    not_modified = 0
+    time.sleep(max(0.0, start - time.monotonic()))
+    while not stop.is_set():
+        with tag.get_lock():
+            etag, known = tag.value.decode(), list(seen)
+        began = time.monotonic()
+        response = client.get(path, headers={'If-None-Match': etag}
+                              if etag else {})
+        ended = time.monotonic()
+        if response.status_code == 304:
+            not_modified += 1
+            reads.append((began, ended, known))
+            continue
+
+        # 'writer <index> <n>' is the n-th write; the catalog title is 0
+
+        drinks = response.get_json()['drinks']
+        shown = [int(d['title'].split()[2])
+                 if d['title'].startswith('writer') else 0 for d in drinks]
+        reads.append((began, ended, shown))
+        with tag.get_lock():
+            tag.value = response.headers['ETag'].encode()
+            seen[:] = shown
+    results.put(('reader', index, reads,
+                 (menu_cache.hits, menu_cache.misses, not_modified)))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(fraction * (len(values) - 1))]
+
+
+def analyse(writes, reads):
+    '''
+    analyse(writes, reads)
+        Returns (stale reads, their staleness, lags) from the answer times
+        of each writer's writes and the (began, ended, seen) reads of each
+        reader.
+    '''
+
+    stale = []
+    for reader in reads:
+        for began, _, seen in reader:
+            for writer, done in enumerate(writes):
+                expected = bisect.bisect_right(done, began)
+                if seen[writer] < expected:
+                    stale.append(began - done[seen[writer]])
+
+    # A read that misses one write misses every later one too, so each
+    # reader is walked once per writer
+
+    lags = []
+    for reader in reads:
+        for writer, done in enumerate(writes):
+            j = 0
+            for n, answered in enumerate(done, 1):
+                while j < len(reader) and (reader[j][1] < answered or
+                                           reader[j][2][writer] < n):
+                    j += 1
+                if j == len(reader):
+                    break
+                lags.append(reader[j][1] - answered)
+    return len(stale), stale, lags
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--writes', type=int, default=200)
+    parser.add_argument('--pause', type=float, default=5,
+                        help='most milliseconds between two writes')
+    parser.add_argument('--drinks', type=int, default=100)
+    parser.add_argument('--generation-file', default=None,
+                        help="shared generation file, or 'off'")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='coffee-bench-')
+    sys.path.insert(0, BACKEND)
+    sys.path.insert(0, BENCH)
+
+    from run import MANAGER, build_catalog, make_keys, mint_token
+
+    try:
+        pem = make_keys(tmp)
+        headers = {'Authorization': 'Bearer ' +
+                   mint_token(pem, 'bench|manager', MANAGER)}
+        url = 'sqlite:///' + os.path.join(tmp, 'catalog.db')
+        build_catalog(url, max(args.drinks, args.writers), 1)
+        generation = args.generation_file or os.path.join(tmp, 'generation')
+        config = process_config(url, generation, tmp)
+
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        stop = context.Event()
+        latest = (context.Array('c', 128),
+                  context.Array('i', args.writers, lock=False))
+        start = time.monotonic() + 2
+        writers = [context.Process(target=write, args=(
+            n, args, config, headers, start, results))
+            for n in range(args.writers)]
+        readers = [context.Process(target=read, args=(
+            n, args, config, start, stop, latest, results))
+            for n in range(args.readers)]
+        for process in writers + readers:
+            process.start()
+
+        writes = [None] * args.writers
+        reads = [None] * args.readers
+        hits = misses = not_modified = 0
+        for _ in writers:
+            _, index, done, _ = results.get()
+            writes[index] = done
+        time.sleep(0.1)
+        stop.set()
+        for _ in readers:
+            _, index, done, counts = results.get()
+            reads[index] = done
+            hits += counts[0]
+            misses += counts[1]
+            not_modified += counts[2]
+        for process in writers + readers:
+            process.join()
+
+        count, stale, lags = analyse(writes, reads)
+        print('generation file  %s' % generation)
+        print('writes           %d' % sum(len(w) for w in writes))
+        print('reads            %d, %d answered 304, %.1f%% of the rest '
+              'from the menu cache' % (
+                  sum(len(r) for r in reads), not_modified,
+                  100.0 * hits / max(hits + misses, 1)))
+        print('stale reads      %d%s' % (count, (
+            ', up to %.3f ms behind' % (max(stale) * 1000)) if stale
+            else ''))
+        print('lag ms           p50 %.3f  p99 %.3f  max %.3f' % (
+            percentile(lags, 0.5) * 1000, percentile(lags, 0.99) * 1000,
+            max(lags or [0]) * 1000))
+        if count and generation != 'off':
+            raise SystemExit(1)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+Side by side throughput of the WSGI and the asyncio serving modes.
+
+Each mode is started in its own process on a fresh SQLite database filled
+with --drinks drinks, then loaded with --concurrency keep-alive clients
+reading GET /drinks for --seconds seconds. Needs quart, aiosqlite and
+hypercorn for the asyncio mode. Run from the backend directory::
+
+    python bench/compare_wsgi_asgi.py --concurrency 64 --seconds 10
+
+"""
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def fill(url, drinks):
+    from src.api import create_app
+    from src.database.models import Drink, db
+
+    app = create_app({'DATABASE_URL': url})
+    with app.app_context():
+        for i in range(drinks):
+            drink = Drink(title='drink %d' % i,
+                          recipe=[{'name': 'milk', 'color': 'white',
+                                   'parts': 1 + i % 3}])
+            drink.materialize()
+            db.session.add(drink)
+        db.session.commit()
+
+
+def serve(mode, url, port):
+
+    # One client address sends every request, so the rate limits are off
+
+    config = {'DATABASE_URL': url, 'RATE_LIMITS': 'off'}
+    if mode == 'wsgi':
+        from werkzeug.serving import WSGIRequestHandler, make_server
+        from src.api import create_app
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args):
+                pass
+
+        app = create_app(config)
+        make_server('127.0.0.1', port, app, threaded=True,
+                    request_handler=QuietHandler).serve_forever()
+    else:
+        import asyncio
+        from hypercorn.asyncio import serve as hypercorn_serve
+        from hypercorn.config import Config
+        from src.asgi import create_asgi_app
+
+        app = create_asgi_app(config)
+        config = Config()
+        config.bind = ['127.0.0.1:%d' % port]
+        config.accesslog = None
+        asyncio.run(hypercorn_serve(app, config))
+
+
+def wait_for(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server on port %d did not start' % port)
+
+
+def load(port, concurrency, seconds, path):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop = time.perf_counter() + seconds
+
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        mine = []
+        while time.perf_counter() < stop:
+            started = time.perf_counter()
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    raise http.client.HTTPException(response.status)
+            except (OSError, http.client.HTTPException):
+                with lock:
+                    errors[0] += 1
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port)
+                continue
+            mine.append(time.perf_counter() - started)
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    latencies.sort()
+
+    def pct(p):
+        if not latencies:
+            return None
+        return round(latencies[int(p * (len(latencies) - 1))] * 1000, 2)
+
+    return {'requests': len(latencies), 'errors': errors[0],
+            'req_per_second': round(len(latencies) / seconds, 1),
+            'p50_ms': pct(0.50), 'p99_ms': pct(0.99)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--drinks', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--path', default='/drinks')
+    parser.add_argument('--modes', default='wsgi,asgi')
+    parser.add_argument('--serve', choices=['wsgi', 'asgi'],
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    sys.path.insert(0, BACKEND)
+    if args.serve:
+        serve(args.serve, args.url, args.port)
+        return
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        url = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        fill(url, args.drinks)
+        for mode in args.modes.split(','):
+            port = free_port()
+            server = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), '--serve', mode,
+                 '--url', url, '--port', str(port)], cwd=BACKEND)
+            try:
+                wait_for(port)
+                results[mode] = load(port, args.concurrency, args.seconds,
+                                     args.path)
+            finally:
+                server.terminate()
+                server.wait()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
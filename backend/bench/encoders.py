@@ -0,0 +1,91 @@
+"""
+Compares the JSON encoders on the drink list endpoints.
+
+Serves GET /drinks and GET /drinks-detail through the Flask test client
+with the menu cache emptied before every request, so each response is
+built and encoded again, once per JSON encoder installed. Run from the
+backend directory::
+
+    python bench/encoders.py --drinks 10000
+
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+BACKEND = os.path.dirname(BENCH)
+
+PATHS = ('/drinks', '/drinks-detail')
+
+
+def measure(client, path, headers, requests):
+    from src.database.cache import menu_cache
+
+    latencies = []
+    size = 0
+    started = time.perf_counter()
+    for _ in range(requests):
+        menu_cache.invalidate()
+        began = time.perf_counter()
+        response = client.get(path, headers=headers)
+        size = len(response.get_data())
+        latencies.append(time.perf_counter() - began)
+        if response.status_code != 200:
+            raise SystemExit('%s answered %d' % (path,
+                                                 response.status_code))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return (requests / elapsed, latencies[len(latencies) // 2] * 1000,
+            latencies[int(0.95 * (len(latencies) - 1))] * 1000, size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--drinks', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='coffee-bench-')
+    sys.path.insert(0, BACKEND)
+    sys.path.insert(0, BENCH)
+
+    from run import BARISTA, auth_config, build_catalog, make_keys, \
+        mint_token
+
+    try:
+        from src import serializer
+        from src.api import create_app
+
+        pem = make_keys(tmp)
+        headers = {'Authorization': 'Bearer ' +
+                   mint_token(pem, 'bench|barista', BARISTA)}
+        url = 'sqlite:///' + os.path.join(tmp, 'catalog.db')
+        build_catalog(url, args.drinks, args.seed)
+        app = create_app(dict(auth_config(tmp), DATABASE_URL=url,
+                              SLOW_REQUEST_MS=0, RATE_LIMITS='off'))
+        client = app.test_client()
+
+        encoders = ['json']
+        if serializer.orjson is not None:
+            encoders.append('orjson')
+
+        print('%-7s %-15s %9s %10s %10s %10s' % (
+            'encoder', 'path', 'req/s', 'p50 ms', 'p95 ms', 'bytes'))
+        for name in encoders:
+            serializer.use(name)
+            for path in PATHS:
+                print('%-7s %-15s %9.1f %10.3f %10.3f %10d' % (
+                    (name, path) + measure(client, path, headers,
+                                           args.requests)))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
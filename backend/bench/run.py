@@ -0,0 +1,405 @@
+"""
+Benchmark suite for the drink endpoints.
+
+Builds a catalog of --drinks generated drinks, mints barista and manager
+tokens signed by a throwaway key published through a local JWKS, then
+drives each scenario through the Flask test client and through a real
+HTTP server, reporting throughput and p50, p95 and p99 latency. The same
+--seed gives the same catalog and the same requests. Run from the backend
+directory::
+
+    python bench/run.py --drinks 1000
+    python bench/run.py --drinks 1000 --save-baseline bench/baseline.json
+    python bench/run.py --drinks 1000 --baseline bench/baseline.json
+
+With --baseline, a scenario whose p95 latency rose or whose throughput
+fell by more than --threshold (a fraction, 0.25 by default) against the
+stored results is reported as a regression and the run exits with status
+1. Baselines depend on the machine; store one per machine that compares
+against it.
+
+"""
+
+import argparse
+import base64
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+BACKEND = os.path.dirname(BENCH)
+
+SCENARIOS = ('get_drinks', 'get_drinks_page', 'get_drinks_detail',
+             'post_drink', 'patch_drink', 'delete_drink')
+
+MODES = ('client', 'http')
+
+BARISTA = ['get:drinks-detail']
+MANAGER = ['get:drinks-detail', 'post:drinks', 'patch:drinks',
+           'delete:drinks']
+
+COLORS = ('white', 'brown', 'black', 'blue', 'grey', 'cream')
+INGREDIENTS = ('milk', 'oat milk', 'espresso', 'water', 'foam', 'cream',
+               'chocolate', 'caramel', 'vanilla', 'ice')
+
+# The claims of the bench tokens, whatever the environment sets
+AUDIENCE = 'coffee-bench'
+ISSUER = 'https://bench.invalid/'
+
+
+# ----------------------------------------------------------------------------#
+#  Keys, tokens and catalog
+# ----------------------------------------------------------------------------#
+
+def make_keys(directory):
+    '''
+    make_keys(directory)
+        Writes the public half of a new RSA key to directory as a JWKS
+        file and returns the private key in PEM form.
+    '''
+
+    import rsa
+
+    def b64(number):
+        data = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+        return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+    public, private = rsa.newkeys(2048)
+    with open(os.path.join(directory, 'bench.json'), 'w') as f:
+        json.dump({'keys': [{'kty': 'RSA', 'kid': 'bench', 'use': 'sig',
+                             'n': b64(public.n), 'e': b64(public.e)}]}, f)
+    return private.save_pkcs1().decode()
+
+
+def auth_config(keys):
+    '''
+    auth_config(keys)
+        Returns the settings of an app trusting the tokens of
+        mint_token(), signed by the keys of make_keys(keys).
+    '''
+
+    return {'JWKS_PATH': keys, 'API_AUDIENCE': AUDIENCE,
+            'AUTH_ISSUER': ISSUER}
+
+
+def mint_token(pem, sub, permissions):
+    from jose import jwt
+
+    return jwt.encode({'sub': sub, 'aud': AUDIENCE, 'iss': ISSUER,
+                       'exp': int(time.time()) + 3600,
+                       'permissions': permissions},
+                      pem, algorithm='RS256', headers={'kid': 'bench'})
+
+
+def make_recipe(rng):
+    return [{'name': rng.choice(INGREDIENTS), 'color': rng.choice(COLORS),
+             'parts': rng.randint(1, 4)}
+            for _ in range(rng.randint(1, 4))]
+
+
+def build_catalog(url, drinks, seed):
+    '''
+    build_catalog(url, drinks, seed)
+        Creates a database at url holding drinks generated drinks.
+    '''
+
+    from sqlalchemy import text
+    from src.api import create_app
+    from src.database.models import Drink, db
+
+    rng = random.Random(seed)
+    app = create_app({'DATABASE_URL': url})
+    with app.app_context():
+        for start in range(0, drinks, 1000):
+            Drink.insert_many([
+                {'title': 'drink %d' % i, 'recipe': make_recipe(rng)}
+                for i in range(start, min(start + 1000, drinks))])
+        with db.engine.connect() as connection:
+            connection.execute(text('PRAGMA wal_checkpoint(TRUNCATE)'))
+        db.engine.dispose()
+
+
+# ----------------------------------------------------------------------------#
+#  Scenarios
+#
+#  A scenario returns the list of (method, path, headers, body) requests
+#  it sends, drawn from a seeded random generator.
+# ----------------------------------------------------------------------------#
+
+def scenario_requests(name, count, drinks, tokens, rng):
+    barista = {'Authorization': 'Bearer ' + tokens['barista']}
+    manager = {'Authorization': 'Bearer ' + tokens['manager'],
+               'Content-Type': 'application/json'}
+
+    def body(value):
+        return json.dumps(value).encode('utf-8')
+
+    requests = []
+    for n in range(count):
+        if name == 'get_drinks':
+            requests.append(('GET', '/drinks', {}, None))
+        elif name == 'get_drinks_page':
+            after = rng.randrange(max(drinks - 50, 1))
+            requests.append(('GET', '/drinks?limit=50&after=%d' % after,
+                             {}, None))
+        elif name == 'get_drinks_detail':
+            after = rng.randrange(max(drinks - 100, 1))
+            requests.append(('GET', '/drinks-detail?limit=100&after=%d' %
+                             after, barista, None))
+        elif name == 'post_drink':
+            requests.append(('POST', '/drinks', manager, body({
+                'title': 'bench %d' % n, 'recipe': make_recipe(rng)})))
+        elif name == 'patch_drink':
+            drink_id = rng.randint(1, drinks)
+            requests.append(('PATCH', '/drinks/%d' % drink_id, manager,
+                             body({'title': 'patched %d' % n})))
+        elif name == 'delete_drink':
+
+            # Deletes the drinks added by post_drink, which ran before
+
+            requests.append(('DELETE', '/drinks/%d' % (drinks + n + 1),
+                             manager, None))
+    return requests
+
+
+# ----------------------------------------------------------------------------#
+#  Drivers
+# ----------------------------------------------------------------------------#
+
+def drive_client(app, requests):
+    client = app.test_client()
+    latencies = []
+    errors = 0
+    for method, path, headers, body in requests:
+        started = time.perf_counter()
+        response = client.open(path, method=method, headers=headers,
+                               data=body)
+        response.get_data()
+        latencies.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            errors += 1
+    return latencies, errors
+
+
+def drive_http(port, requests, concurrency):
+    import http.client
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    shares = [requests[i::concurrency] for i in range(concurrency)]
+
+    def client(share):
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        mine = []
+        failed = 0
+        for method, path, headers, body in share:
+            started = time.perf_counter()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port)
+            mine.append(time.perf_counter() - started)
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client, args=(share,))
+               for share in shares]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, errors[0]
+
+
+def summarize(latencies, errors, seconds):
+    latencies = sorted(latencies)
+
+    def pct(p):
+        if not latencies:
+            return None
+        return round(latencies[int(p * (len(latencies) - 1))] * 1000, 3)
+
+    return {'requests': len(latencies), 'errors': errors,
+            'req_per_second': round(len(latencies) / seconds, 1),
+            'p50_ms': pct(0.50), 'p95_ms': pct(0.95), 'p99_ms': pct(0.99)}
+
+
+def run_mode(mode, url, args, tokens, keys):
+    from compare_wsgi_asgi import free_port, wait_for
+
+    results = {}
+    server = app = port = None
+    if mode == 'client':
+        from src.api import create_app
+        app = create_app(dict(auth_config(keys), DATABASE_URL=url,
+                              SLOW_REQUEST_MS=0, RATE_LIMITS='off'))
+    else:
+
+        # The server process takes its settings from the environment
+
+        port = free_port()
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(BENCH, 'compare_wsgi_asgi.py'),
+             '--serve', 'wsgi', '--url', url, '--port', str(port)],
+            cwd=BACKEND, env=dict(os.environ, SLOW_REQUEST_MS='0',
+                                  **auth_config(keys)))
+
+    try:
+        if port is not None:
+            wait_for(port)
+        for name in args.scenarios:
+            rng = random.Random('%s-%s' % (args.seed, name))
+            requests = scenario_requests(name, args.requests, args.drinks,
+                                         tokens, rng)
+            started = time.perf_counter()
+            if mode == 'client':
+                latencies, errors = drive_client(app, requests)
+            else:
+                latencies, errors = drive_http(port, requests,
+                                               args.concurrency)
+            results[name] = summarize(latencies, errors,
+                                      time.perf_counter() - started)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    return results
+
+
+# ----------------------------------------------------------------------------#
+#  Baselines
+# ----------------------------------------------------------------------------#
+
+def settings(args):
+    return {'drinks': args.drinks, 'requests': args.requests,
+            'concurrency': args.concurrency, 'seed': args.seed}
+
+
+def compare(results, baseline, threshold):
+    '''
+    compare(results, baseline, threshold)
+        Returns a line per scenario that regressed against baseline.
+    '''
+
+    regressions = []
+    for mode, scenarios in results.items():
+        for name, now in scenarios.items():
+            before = baseline.get(mode, {}).get(name)
+            if before is None:
+                continue
+            if now['p95_ms'] > before['p95_ms'] * (1 + threshold):
+                regressions.append('%s %s: p95 %.3f ms, baseline %.3f ms' % (
+                    mode, name, now['p95_ms'], before['p95_ms']))
+            if now['req_per_second'] < \
+                    before['req_per_second'] * (1 - threshold):
+                regressions.append('%s %s: %.1f req/s, baseline %.1f' % (
+                    mode, name, now['req_per_second'],
+                    before['req_per_second']))
+            if now['errors'] > before['errors']:
+                regressions.append('%s %s: %d errors, baseline %d' % (
+                    mode, name, now['errors'], before['errors']))
+    return regressions
+
+
+def print_table(results):
+    print('%-7s %-18s %9s %7s %10s %10s %10s' % (
+        'mode', 'scenario', 'req/s', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for mode, scenarios in results.items():
+        for name, r in scenarios.items():
+            print('%-7s %-18s %9.1f %7d %10.3f %10.3f %10.3f' % (
+                mode, name, r['req_per_second'], r['errors'], r['p50_ms'],
+                r['p95_ms'], r['p99_ms']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--drinks', type=int, default=1000,
+                        help='catalog size, e.g. 100 to 100000')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per scenario and mode')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='client threads against the HTTP server')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--save-baseline', metavar='PATH')
+    parser.add_argument('--baseline', metavar='PATH')
+    parser.add_argument('--threshold', type=float, default=0.25)
+    args = parser.parse_args()
+    args.scenarios = [s for s in args.scenarios.split(',') if s]
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario %s' % name)
+
+    tmp = tempfile.mkdtemp(prefix='coffee-bench-')
+    sys.path.insert(0, BACKEND)
+    sys.path.insert(0, BENCH)
+
+    try:
+        pem = make_keys(tmp)
+        tokens = {'barista': mint_token(pem, 'bench|barista', BARISTA),
+                  'manager': mint_token(pem, 'bench|manager', MANAGER)}
+
+        template = os.path.join(tmp, 'catalog.db')
+        started = time.perf_counter()
+        build_catalog('sqlite:///' + template, args.drinks, args.seed)
+        print('catalog of %d drinks built in %.1f s' % (
+            args.drinks, time.perf_counter() - started))
+
+        results = {}
+        for mode in args.modes.split(','):
+            database = os.path.join(tmp, '%s.db' % mode)
+            shutil.copy(template, database)
+            results[mode] = run_mode(mode, 'sqlite:///' + database, args,
+                                     tokens, tmp)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print_table(results)
+    report = {'settings': settings(args),
+              'python': platform.python_version(),
+              'platform': platform.platform(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('baseline saved to %s' % args.save_baseline)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['settings'] != settings(args):
+            print('baseline settings %s differ from this run, not compared'
+                  % baseline['settings'])
+            sys.exit(2)
+        regressions = compare(results, baseline['results'], args.threshold)
+        for line in regressions:
+            print('REGRESSION ' + line)
+        if regressions:
+            sys.exit(1)
+        print('no regression over %d%% against %s' % (
+            args.threshold * 100, args.baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -20,23 +20,101 @@ With the following API permissions:
 """
 
 import os
-from flask import Flask, request, jsonify, abort
+import time
+import click
+from flask import Blueprint, Flask, Response, current_app, request, \
+    jsonify, abort, stream_with_context
 from sqlalchemy import exc
-import json
-from flask_cors import CORS
-from werkzeug.exceptions import NotFound
+from sqlalchemy.orm import lazyload
+
+from .database.models import db, db_drop_and_create_all, db_create_all, \
+    setup_db, release_connections, Drink, backfill_materialized, \
+    read_query, read_session, changes_since, prune_tombstones, \
+    drinks_changed, DRINK_FIELDS, DEFAULT_FIELDS
+from .database import cache
+from .database.cache import menu_cache
+from .database.feed import change_feed, heartbeat, stream_preamble, \
+    HEARTBEAT_INTERVAL
+from . import compression, menu, metrics, profiling, ratelimit, serializer
+from .ratelimit import limiter, PUBLIC_BUDGET
+from .serializer import Fragment
+from .auth import auth
+from .auth.auth import requires_auth, get_token_auth_header, \
+    verified_payload
+
+api = Blueprint('api', __name__, cli_group=None)
 
-from .database.models import db_drop_and_create_all, setup_db, Drink
-from .auth.auth import requires_auth
 
-app = Flask(__name__)
-setup_db(app)
-CORS(app)
+# ----------------------------------------------------------------------------#
+#  App factory
+#
+#  create_app(config) builds the app. Startup never drops data: the schema
+#  is created or migrated only when its stored version is out of date.
+#  Database connections opened during startup are released before
+#  returning, so a prefork server can create the app once and fork workers
+#  from it:
+#
+#     gunicorn --preload 'src.api:create_app()'
+#
+#  The time spent in each startup phase is kept in
+#  app.config['STARTUP_TIMINGS'] and printed by flask startup-report.
+# ----------------------------------------------------------------------------#
+
+def create_app(config=None):
+    '''
+    create_app(config=None)
+        Returns a new Flask app. config is a dict of settings applied
+        before the database is set up, e.g. {'DATABASE_URL': ...}.
+    '''
+
+    timings = {}
+    started = mark = time.perf_counter()
+
+    def phase(name):
+        nonlocal mark
+        now = time.perf_counter()
+        timings[name] = (now - mark) * 1000
+        mark = now
+
+    app = Flask(__name__)
+    app.config.update(config or {})
+    phase('config')
+
+    setup_db(app)
+    cache.init_app(app)
+    phase('setup_db')
+
+    with app.app_context():
+        db_create_all()
+    phase('schema')
+
+    from flask_cors import CORS
+    CORS(app)
+    serializer.init_app(app)
+    ratelimit.init_app(app)
+    metrics.init_app(app)
+    profiling.init_app(app)
+    compression.init_app(app)
+    app.register_blueprint(api)
+    phase('routes')
+
+    auth.init_app(app)
+    phase('keys')
+
+    release_connections()
+    timings['total'] = (time.perf_counter() - started) * 1000
+    app.config['STARTUP_TIMINGS'] = timings
+    app.logger.info('startup: %s', format_timings(timings))
+    return app
+
+
+def format_timings(timings):
+    return ', '.join('%s %.1f ms' % item for item in timings.items())
 
 
 # CORS Headers
 
-@app.after_request
+@api.after_app_request
 def after_request(response):
     response.headers.add('Access-Control-Allow-Headers',
                          'Content-Type,Authorization,true')
@@ -46,16 +124,29 @@ def after_request(response):
     return response
 
 
-# ----------------------------------------------------------------------------#
-# uncomment the following line to initialize the datbase
-# ----------------------------------------------------------------------------#
-db_drop_and_create_all()
+# Largest page the drink list endpoints will return
+MAX_PAGE_SIZE = 1000
+
+# Largest number of drinks a batch endpoint will take
+MAX_BATCH_SIZE = 1000
+
+# Rows fetched per round trip by GET /drinks/export
+EXPORT_BATCH_SIZE = 500
+
+# Drinks written per transaction by POST /drinks/import
+IMPORT_CHUNK_SIZE = 500
+
+# Most per-line errors reported back by POST /drinks/import
+IMPORT_MAX_ERRORS = 100
+
+# Tombstones kept by flask prune-tombstones
+TOMBSTONES_KEPT = 10000
 
 # ----------------------------------------------------------------------------#
 # Helper Functions
 #    dump: print out the contents of an object
-#    paginate: pages data for output
-#    leftJoin does a database left join on sets
+#    drink_list: reads a page of drinks as an encoded response body
+#    cached_menu: serves drink lists from the menu cache
 # ----------------------------------------------------------------------------#
 
 
@@ -69,6 +160,271 @@ def dumpData(obj):
         print('data.%s = %r' % (attr, obj[attr]))
 
 
+def page_args(args=None):
+    '''
+    page_args(args=None)
+        Returns the (limit, after) keyset pagination arguments of the
+        request, or of args when given. Either is None when not given; a
+        bad value aborts with a 400.
+    '''
+
+    if args is None:
+        args = request.args
+    try:
+        limit = args.get('limit')
+        after = args.get('after')
+        limit = None if limit is None else int(limit)
+        after = None if after is None else int(after)
+    except ValueError:
+        abort(400, 'limit and after must be integers.')
+
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        abort(400, 'limit must be between 1 and %d.' % MAX_PAGE_SIZE)
+    if after is not None and limit is None:
+        limit = MAX_PAGE_SIZE
+    return limit, after
+
+
+def field_args(args=None):
+    '''
+    field_args(args=None)
+        Returns the drink fields named by the fields parameter of the
+        request, or of args when given, e.g. fields=id,title, in sorted
+        order. The fields of short() and long() when not given; an unknown
+        field aborts with a 400.
+    '''
+
+    if args is None:
+        args = request.args
+    value = args.get('fields')
+    if value is None:
+        return DEFAULT_FIELDS
+
+    fields = set(name.strip() for name in value.split(','))
+    fields.discard('')
+    if not fields or not fields <= set(DRINK_FIELDS):
+        abort(400, 'fields must be a comma separated list of %s.' %
+              ', '.join(DRINK_FIELDS))
+    return tuple(sorted(fields))
+
+
+def expected_versions(if_match, request_json=None):
+    '''
+    expected_versions(if_match, request_json=None)
+        Returns (versions, status) for a conditional write to one drink:
+        the versions the drink may be at, taken from the If-Match header
+        if_match or else from the "version" of request_json, and the
+        status to answer when it is at another version, 412 for If-Match
+        and 409 for "version". versions is None when neither is given or
+        If-Match is *. The ETag of a compressed write response counts
+        as its version. A "version" that is not an integer aborts with a
+        422.
+
+        EXAMPLE::
+
+            versions, status = expected_versions(request.if_match,
+                                                 request.get_json())
+
+    '''
+
+    if if_match:
+        if if_match.star_tag:
+            return None, 412
+
+        # A write response sent compressed carries the ETag of its variant
+
+        tags = [compression.identity_etag(tag) for tag in if_match.as_set()]
+        return [int(tag) for tag in tags if tag.isdigit()], 412
+
+    version = request_json.get('version') \
+        if isinstance(request_json, dict) else None
+    if version is None:
+        return None, 409
+    if not isinstance(version, int) or isinstance(version, bool):
+        abort(422)
+    return [version], 409
+
+
+def written(result, conflict):
+    '''
+    written(result, conflict)
+        Aborts with the error of a failed Drink.update_where() or
+        Drink.delete_where() result, answering a version conflict with
+        the conflict status of expected_versions().
+    '''
+
+    if not result['success']:
+        error = result['error']
+        abort(conflict if error == 412 else error, result['message'])
+
+
+def drink_list(form, fields, limit, after, ingredient=None, q=None):
+    '''
+    drink_list(form, fields, limit, after, ingredient=None, q=None)
+        Returns the drink list response body for the 'short' or 'long'
+        form, paged and filtered as requested, with just fields of each
+        drink. Only the columns behind fields are read, as row tuples, so
+        no Drink or ingredient is loaded.
+    '''
+
+    query = menu.list_select(form, fields, limit, after, ingredient, q,
+                             db.engine.dialect.name)
+    rows, next_after = menu.page_rows(read_session.execute(query).all(),
+                                      limit)
+
+    # A drink written without stored recipe JSON needs its ingredients
+
+    recipes = {}
+    missing = menu.recipes_missing(rows, fields)
+    if missing:
+        drinks = read_session.execute(menu.recipes_select(missing)).scalars()
+        recipes = {d.id: d.recipe_json(form) for d in drinks}
+    return menu.page_body(rows, fields, recipes, limit, next_after)
+
+
+def caller_form(headers, args):
+    '''
+    caller_form(headers, args)
+        Returns the form of drinks a caller may read on the routes open
+        to everyone: 'long' with the get:drinks-detail permission,
+        otherwise 'short'. The token is optional and may also be passed
+        as the access_token query parameter, since a browser EventSource
+        can't set headers.
+    '''
+
+    token = args.get('access_token')
+    if token is None and 'Authorization' in headers:
+        token = get_token_auth_header(headers)
+    if token is None:
+        return 'short'
+    payload = verified_payload(token)
+    if 'get:drinks-detail' in payload.get('permissions', []):
+        return 'long'
+    return 'short'
+
+
+def batch_items(key):
+    '''
+    batch_items(key)
+        Returns the list held under key in the request JSON, aborting
+        with a 400 if it is missing, empty or larger than MAX_BATCH_SIZE.
+    '''
+
+    request_json = request.get_json(silent=True)
+    items = request_json.get(key) if isinstance(request_json, dict) \
+        else None
+    if not isinstance(items, list) or not items:
+        abort(400, '"%s" must be a non-empty list.' % key)
+    if len(items) > MAX_BATCH_SIZE:
+        abort(400, 'A batch holds at most %d drinks.' % MAX_BATCH_SIZE)
+    return items
+
+
+def read_ndjson_chunks(stream, chunk_size):
+    '''
+    read_ndjson_chunks(stream, chunk_size)
+        Reads a newline delimited JSON stream one line at a time and
+        yields lists of up to chunk_size (line number, value) pairs.
+        A line that is not valid JSON yields a ValueError as its value.
+        Blank lines are skipped.
+    '''
+
+    chunk = []
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            value = current_app.json.loads(line)
+        except ValueError as e:
+            value = e
+        chunk.append((line_number, value))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def cached_menu(key, build, private=False, store=True):
+    '''
+    cached_menu(key, build, private=False, store=True)
+        Returns the drink list response for key from the menu cache,
+        calling build() to produce the response body on a miss. The body
+        is compressed as the request accepts, see compression.py. With
+        store False, e.g. for search results, the cache is bypassed so
+        one-off responses don't crowd out the menu pages.
+
+        The response carries an ETag for the menu version. A request whose
+        If-None-Match holds the current ETag is answered with a 304
+        without touching the database. Writes by other worker processes
+        are picked up first, see MenuCache.sync().
+    '''
+
+    tag, body, version = menu.lookup(key, request.if_none_match, store)
+    if tag is not None:
+        response = Response(status=304)
+    else:
+        if body is None:
+            with profiling.phase('build'):
+                body = menu.save(key, build(), version, store)
+        body, encoding, tag = menu.encode(key, body, version,
+                                          request.accept_encodings,
+                                          current_app.config)
+        response = Response(body, mimetype='application/json')
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+
+    menu.set_headers(response, tag, private)
+    return response
+
+
+@api.cli.command('backfill-recipes')
+def backfill_recipes_command():
+    '''
+    flask backfill-recipes
+        Encodes the stored short and long recipe JSON for drinks written
+        before it was materialized.
+    '''
+
+    print('Backfilled %d drinks' % backfill_materialized())
+
+
+@api.cli.command('prune-tombstones')
+@click.option('--keep', default=TOMBSTONES_KEPT, show_default=True,
+              help='Number of the latest tombstones to keep.')
+def prune_tombstones_command(keep):
+    '''
+    flask prune-tombstones [--keep N]
+        Deletes the tombstones of deleted drinks, but the latest N.
+        Clients that last synced before them get the whole menu again.
+    '''
+
+    print('Pruned %d tombstones' % prune_tombstones(keep))
+
+
+@api.cli.command('reset-db')
+def reset_db_command():
+    '''
+    flask reset-db
+        Drops every table and creates an empty database.
+    '''
+
+    db_drop_and_create_all()
+    menu_cache.invalidate()
+    print('Database reset')
+
+
+@api.cli.command('startup-report')
+def startup_report_command():
+    '''
+    flask startup-report
+        Prints the time spent in each phase of create_app().
+    '''
+
+    print('startup: %s' % format_timings(
+        current_app.config['STARTUP_TIMINGS']))
+
+
 # ----------------------------------------------------------------------------#
 # ----------------------------------------------------------------------------#
 # ROUTES
@@ -79,7 +435,7 @@ def dumpData(obj):
 #  Get list of Drinks - Short form, public
 # ----------------------------------------------------------------------------#
 
-@app.route('/drinks', methods=['GET'])
+@api.route('/drinks', methods=['GET'])
 def list_of_drinks_short_form():
     """
         **Get Drinks**
@@ -88,6 +444,16 @@ def list_of_drinks_short_form():
 
         **Get Drinks**
 
+        - Optional query parameters:
+
+            limit: page size, 1 to MAX_PAGE_SIZE. Adds "next" to the response
+            after: return drinks with an id greater than this cursor
+            ingredient: only drinks using this ingredient, any case
+            q: only drinks with a title or ingredient word starting with
+               each word of q, e.g. q=oat%20lat
+            fields: comma separated fields of each drink to return, of id,
+               recipe, title and version, e.g. fields=id,title
+
         - Sample Call create question::
 
             curl -X POST http://localhost:5000/drinks
@@ -116,20 +482,24 @@ def list_of_drinks_short_form():
 
     """
 
-    selection = Drink.query.order_by(Drink.id).all()
-    drinks_list = [d.short() for d in selection]
+    limiter.check(PUBLIC_BUDGET, request.remote_addr)
+    limit, after = page_args()
+    ingredient = request.args.get('ingredient')
+    q = request.args.get('q')
+    fields = field_args()
 
-    if selection is None:
-        abort(404)
+    def build():
+        return drink_list('short', fields, limit, after, ingredient, q)
 
-    return jsonify({'success': True, 'drinks': drinks_list})
+    key = menu.list_key('short', fields, limit, after, ingredient, q)
+    return cached_menu(key, build, store=q is None)
 
 
 # ----------------------------------------------------------------------------#
 #  Retrieve list of drinks in long form.
 # ----------------------------------------------------------------------------#
 
-@app.route('/drinks-detail', methods=['GET'])
+@api.route('/drinks-detail', methods=['GET'])
 @requires_auth('get:drinks-detail')
 def list_of_drinks_long_form(payload):
     """
@@ -139,6 +509,16 @@ def list_of_drinks_long_form(payload):
 
         **Get Drinks**
 
+        - Optional query parameters:
+
+            limit: page size, 1 to MAX_PAGE_SIZE. Adds "next" to the response
+            after: return drinks with an id greater than this cursor
+            ingredient: only drinks using this ingredient, any case
+            q: only drinks with a title or ingredient word starting with
+               each word of q, e.g. q=oat%20lat
+            fields: comma separated fields of each drink to return, of id,
+               recipe, title and version, e.g. fields=id,title
+
         - Sample Call create question::
 
             curl -X POST http://localhost:5000/drinks
@@ -183,21 +563,23 @@ def list_of_drinks_long_form(payload):
             }
    """
 
-    selection = Drink.query.order_by(Drink.id).all()
+    limit, after = page_args()
+    ingredient = request.args.get('ingredient')
+    q = request.args.get('q')
+    fields = field_args()
 
-    if selection is None:
-        abort(404)
+    def build():
+        return drink_list('long', fields, limit, after, ingredient, q)
 
-    drinks = [d.long() for d in selection]
-
-    return jsonify({'success': True, 'drinks': drinks})
+    key = menu.list_key('long', fields, limit, after, ingredient, q)
+    return cached_menu(key, build, private=True, store=q is None)
 
 
 # ----------------------------------------------------------------------------#
 #  Create drink
 # ----------------------------------------------------------------------------#
 
-@app.route('/drinks', methods=['POST'])
+@api.route('/drinks', methods=['POST'])
 @requires_auth('post:drinks')
 def create_new_drink(payload):
     """
@@ -237,6 +619,8 @@ def create_new_drink(payload):
             "success": true
             }
 
+            The response carries the version of the drink as its ETag.
+
 
         - Expected Fail Response::
 
@@ -262,7 +646,10 @@ def create_new_drink(payload):
         drink = Drink(title=title, recipe=recipe)
         drink.insert()
 
-        return jsonify({'success': True, 'drinks': drink.long()})
+        response = jsonify({'success': True,
+                            'drinks': Fragment(drink.long_json())})
+        response.set_etag(str(drink.version))
+        return response
     except Exception:
         abort(422)
 
@@ -271,18 +658,27 @@ def create_new_drink(payload):
 #  Update Drink
 # ----------------------------------------------------------------------------#
 
-@app.route('/drinks/<int:drink_id>', methods=['PATCH'])
+@api.route('/drinks/<int:drink_id>', methods=['PATCH'])
 @requires_auth('patch:drinks')
 def update_drink(payload, drink_id):
     """
         **Updates a drink**
 
-        This API will update a drink by drink Id.
+        This API will update a drink by drink Id. The drink row is
+        written with one conditional UPDATE, see Drink.update_where().
+
+        - Optional, to update only the version last read:
+
+            If-Match header: the ETag of a drink write response, or its
+               version, e.g. If-Match: "12". A mismatch answers 412
+            version: the version in the request JSON. A mismatch
+               answers 409
 
         - Sample Call::
 
             curl -X PATCH http://localhost:5000/drink/1 \
                  -H 'content-type: application/json' \
+                 -H 'If-Match: "12"' \
                  -d '{"title": "water"}'
 
         - Expected Success Response::
@@ -306,6 +702,8 @@ def update_drink(payload, drink_id):
             "success": true
             }
 
+            The response carries the new version of the drink as its ETag.
+
 
         - Expected Fail Response::
 
@@ -316,50 +714,55 @@ def update_drink(payload, drink_id):
                 "message": "Unauthorized",
                 "success": false
             }
-    """
 
-    # Get the drink record
-
-    drink = Drink.query.filter(Drink.id == drink_id).one_or_none()
-
-    # Abort if no drink found
-
-    if drink is None:
-        abort(404)
+            HTTP Status Code: 412
+            {
+                "description": "412 Precondition Failed: Drink has
+                                changed.",
+                "error": 412,
+                "message": "Precondition Failed",
+                "success": false
+            }
+    """
 
     request_json = request.get_json()
-    title = request_json.get('title', None)
-    recipe = request_json.get('recipe', None)
-
-    # Set the values
-
-    if title is not None:
-        drink.title = title
-    if recipe is not None:
-        drink.recipe = recipe
-
-    # do the update
+    if not isinstance(request_json, dict):
+        abort(422)
+    versions, conflict = expected_versions(request.if_match, request_json)
 
-    try:
-        drink.update()
+    # One conditional UPDATE; nothing is read before it
 
-    except Exception as e:
-        abort(422)
+    result, change = Drink.update_where(
+        db.session, drink_id, title=request_json.get('title'),
+        recipe=request_json.get('recipe'), versions=versions)
+    if change is None:
+        db.session.rollback()
+        written(result, conflict)
+    db.session.commit()
+    drinks_changed([change])
 
-    return jsonify({'success': True, 'drinks': [drink.long()]})
+    response = jsonify({'success': True, 'drinks': [result['drinks']]})
+    response.set_etag(str(result['version']))
+    return response
 
 
 # ----------------------------------------------------------------------------#
 #  Delete question from the database
 # ----------------------------------------------------------------------------#
 
-@app.route('/drinks/<int:drink_id>', methods=['DELETE'])
+@api.route('/drinks/<int:drink_id>', methods=['DELETE'])
 @requires_auth('delete:drinks')
 def delete_drink(payload, drink_id):
     """
         **Delete a drink from the database**
 
-        This API will delete a drink from the database.
+        This API will delete a drink from the database with one
+        conditional DELETE, see Drink.delete_where().
+
+        - Optional, to delete only the version last read:
+
+            If-Match header: the ETag of a drink write response, or its
+               version, e.g. If-Match: "12". A mismatch answers 412
 
         - Sample Call::
 
@@ -386,27 +789,551 @@ def delete_drink(payload, drink_id):
             }
     """
 
+    versions, conflict = expected_versions(request.if_match)
+
+    result, change = Drink.delete_where(db.session, drink_id, versions)
+    if change is None:
+        db.session.rollback()
+        written(result, conflict)
+    db.session.commit()
+    drinks_changed([change])
+
+    return jsonify(result)
+
+
+# ----------------------------------------------------------------------------#
+#  Batch create, update and delete
+# ----------------------------------------------------------------------------#
+
+@api.route('/drinks/batch', methods=['POST'])
+@requires_auth('post:drinks')
+def create_drinks_batch(payload):
+    """
+        **Create Drinks in a Batch**
+
+        This API will create up to MAX_BATCH_SIZE drinks in one transaction.
+        Each drink gets its own result, so a drink that can't be created
+        doesn't stop the others.
+
+        - Sample Call::
+
+            curl -X POST http://localhost:5000/drinks/batch \
+                 -H 'content-type: application/json' \
+                 -d '{"drinks": [{"title": "Water", \
+                                  "recipe": [{"name": "Water", \
+                                              "color": "blue", \
+                                              "parts": 1}]}, \
+                                 {"title": "Water", \
+                                  "recipe": []}]}'
+
+        - Expected Success Response::
+
+            HTTP Status Code: 200
+
+            {
+            "results": [
+                {
+                "drinks": {
+                    "id": 2,
+                    "recipe": [
+                    {
+                        "color": "blue",
+                        "name": "Water",
+                        "parts": 1
+                    }
+                    ],
+                    "title": "Water"
+                },
+                "success": true
+                },
+                {
+                "error": 409,
+                "message": "Duplicate title.",
+                "success": false
+                }
+            ],
+            "success": true
+            }
+
+
+        - Expected Fail Response::
+
+            HTTP Status Code: 400
+            {
+                "description": "400 Bad Request: \"drinks\" must be a
+                                non-empty list.",
+                "error": 400,
+                "message": "Bad Request",
+                "success": false
+            }
+    """
+
+    items = batch_items('drinks')
+
     try:
-        drink = Drink.query.filter(Drink.id == drink_id).one_or_none()
+        results = Drink.insert_many(items)
+    except Exception:
+        abort(422)
 
-        if drink is None:
-            abort(404)
+    return jsonify({'success': True, 'results': results})
 
-        drink.delete()
 
-        return jsonify({'success': True, 'deleted': drink_id})
-    except NotFound:
-        abort(404)
-    except Exception as e:
+@api.route('/drinks/batch', methods=['PATCH'])
+@requires_auth('patch:drinks')
+def update_drinks_batch(payload):
+    """
+        **Update Drinks in a Batch**
+
+        This API will update up to MAX_BATCH_SIZE drinks in one transaction.
+        Each item holds the drink id and the title and/or recipe to set. A
+        drink may appear once; a second item for it gets a 409.
+
+        - Sample Call::
+
+            curl -X PATCH http://localhost:5000/drinks/batch \
+                 -H 'content-type: application/json' \
+                 -d '{"drinks": [{"id": 1, "title": "water"}, \
+                                 {"id": 99, "title": "tea"}]}'
+
+        - Expected Success Response::
+
+            HTTP Status Code: 200
 
+            {
+            "results": [
+                {
+                "drinks": {
+                    "id": 1,
+                    "recipe": [
+                    {
+                        "color": "blue",
+                        "name": "water",
+                        "parts": 1
+                    }
+                    ],
+                    "title": "water"
+                },
+                "success": true
+                },
+                {
+                "error": 404,
+                "message": "Drink not found.",
+                "success": false
+                }
+            ],
+            "success": true
+            }
+
+
+        - Expected Fail Response::
+
+            HTTP Status Code: 401
+             {
+                "description": "401: Authorization header is expected.",
+                "error": 401,
+                "message": "Unauthorized",
+                "success": false
+            }
+    """
+
+    items = batch_items('drinks')
+
+    try:
+        results = Drink.update_many(items)
+    except Exception:
         abort(422)
 
+    return jsonify({'success': True, 'results': results})
+
+
+@api.route('/drinks/batch', methods=['DELETE'])
+@requires_auth('delete:drinks')
+def delete_drinks_batch(payload):
+    """
+        **Delete Drinks in a Batch**
+
+        This API will delete up to MAX_BATCH_SIZE drinks by id in one
+        transaction.
+
+        - Sample Call::
+
+            curl -X DELETE http://localhost:5000/drinks/batch \
+                 -H 'content-type: application/json' \
+                 -d '{"ids": [2, 99]}'
+
+        - Expected Success Response::
+
+            HTTP Status Code: 200
+            {
+            "results": [
+                {
+                "deleted": 2,
+                "success": true
+                },
+                {
+                "error": 404,
+                "message": "Drink not found.",
+                "success": false
+                }
+            ],
+            "success": true
+            }
+
+
+        - Expected Fail Response::
+
+            HTTP Status Code: 401
+            {
+                "description": "401: Authorization header is expected.",
+                "error": 401,
+                "message": "Unauthorized",
+                "success": false
+            }
+    """
+
+    ids = batch_items('ids')
+    if not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        abort(400, '"ids" must be a list of drink ids.')
+
+    try:
+        results = Drink.delete_many(ids)
+    except Exception:
+        abort(422)
+
+    return jsonify({'success': True, 'results': results})
+
+
+# ----------------------------------------------------------------------------#
+#  Export and import the drink catalog as NDJSON
+# ----------------------------------------------------------------------------#
+
+@api.route('/drinks/export', methods=['GET'])
+@requires_auth('get:drinks-detail')
+def export_drinks(payload):
+    """
+        **Export Drinks**
+
+        Streams every drink in long form as newline delimited JSON, one
+        drink per line. Rows are read from a server-side cursor
+        EXPORT_BATCH_SIZE at a time, so memory use doesn't grow with the
+        size of the catalog.
+
+        - Sample Call::
+
+            curl http://localhost:5000/drinks/export > drinks.ndjson
+
+        - Expected Success Response::
+
+            HTTP Status Code: 200
+            Content-Type: application/x-ndjson
+
+            {"id":1,"recipe":[{"color":"blue","name":"water",...}],...}
+            {"id":2,"recipe":[{"color":"brown","name":"coffee",...}],...}
+
+
+        - Expected Fail Response::
+
+            HTTP Status Code: 401
+            {
+                "description": "401: Authorization header is expected.",
+                "error": 401,
+                "message": "Unauthorized",
+                "success": false
+            }
+    """
+
+    def generate():
+        query = read_query(Drink).options(lazyload(Drink.ingredients)) \
+            .order_by(Drink.id).yield_per(EXPORT_BATCH_SIZE)
+        lines = []
+        for drink in query:
+            lines.append(drink.long_json() + '\n')
+            if len(lines) >= EXPORT_BATCH_SIZE:
+                yield ''.join(lines)
+                lines = []
+        if lines:
+            yield ''.join(lines)
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+# ----------------------------------------------------------------------------#
+#  Delta sync of the drinks changed since a version
+# ----------------------------------------------------------------------------#
+
+@api.route('/drinks/changes', methods=['GET'])
+def drink_changes():
+    """
+        **Get Drink Changes**
+
+        Returns the drinks written and the ids of the drinks deleted since
+        the version a client last synced, so a client catching up
+        downloads the changes instead of the whole menu. Callers with the
+        get:drinks-detail permission get the long form, everyone else the
+        short form.
+
+        Apply "deleted" before "drinks", then keep "version" for the next
+        sync. If "reset" is true the client missed pruned deletes: drop
+        every drink held before applying the response.
+
+        - Optional query parameters:
+
+            since: the version of the last sync, 0 (default) for all
+            limit: at most this many changes. "more" is true if changes
+                   after "version" remain
+
+        - Sample Call::
+
+            curl 'http://localhost:5000/drinks/changes?since=41'
+
+        - Expected Success Response::
+
+            HTTP Status Code: 200
+
+            {
+             "deleted": [3],
+             "drinks": [ list of drink.short() ],
+             "more": false,
+             "reset": false,
+             "success": true,
+             "version": 44
+            }
+
+        - Expected Fail Response::
+
+            HTTP Status Code: 400
+            {
+                "description": "400: since must be a non-negative integer.",
+                "error": 400,
+                "message": "Bad Request",
+                "success": false
+            }
+    """
+
+    limiter.check(PUBLIC_BUDGET, request.remote_addr)
+    form = caller_form(request.headers, request.args)
+    limit, _ = page_args()
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        since = -1
+    if since < 0:
+        abort(400, 'since must be a non-negative integer.')
+
+    changes = changes_since(since, limit)
+    if form == 'long':
+        fragments = [d.long_json() for d in changes['drinks']]
+    else:
+        fragments = [d.short_json() for d in changes['drinks']]
+    body = menu.list_body(fragments, {
+        'deleted': changes['deleted'], 'version': changes['version'],
+        'more': changes['more'], 'reset': changes['reset']})
+
+    response = Response(body, mimetype='application/json')
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+# ----------------------------------------------------------------------------#
+#  Change feed of drink writes as server-sent events
+# ----------------------------------------------------------------------------#
+
+@api.route('/drinks/stream', methods=['GET'])
+def stream_drinks():
+    """
+        **Stream Drink Changes**
+
+        Pushes every committed drink write as a server-sent event:
+        created and updated events carry the drink, deleted events its
+        id. Callers with the get:drinks-detail permission get the long
+        form, everyone else the short form. A heartbeat comment is sent
+        every HEARTBEAT_INTERVAL seconds on an idle stream.
+
+        A reconnecting EventSource sends Last-Event-ID and resumes after
+        the last event it saw. If that event is no longer held, or was
+        sent by another server process, a reset event is sent instead
+        and the menu should be reloaded. A write made by another worker
+        process is also announced by a reset event, within
+        FEED_POLL_INTERVAL seconds, as its events are held by that
+        process only.
+
+        Each open stream holds a worker thread here. The asyncio app in
+        asgi.py serves many subscribers without a thread each.
+
+        - Sample Call::
+
+            curl -N http://localhost:5000/drinks/stream
+
+        - Expected Success Response::
+
+            HTTP Status Code: 200
+            Content-Type: text/event-stream
+
+            retry: 3000
+
+            id: 5f0c2a91-7
+            event: updated
+            data: {"id":1,"recipe":[{"color":"blue","parts":1}],...}
+
+            : heartbeat
+
+        - Expected Fail Response::
+
+            HTTP Status Code: 401
+            {
+                "description": "401 Unauthorized: ...",
+                "error": 401,
+                "message": "Unauthorized",
+                "success": false
+            }
+    """
+
+    limiter.check(PUBLIC_BUDGET, request.remote_addr)
+    form = caller_form(request.headers, request.args)
+    seq = change_feed.position(request.headers.get('Last-Event-ID'))
+
+    def generate(seq):
+        yield stream_preamble()
+        while True:
+            messages, seq = change_feed.since(seq, form)
+            if messages:
+                yield messages
+            change_feed.wait(seq, HEARTBEAT_INTERVAL)
+            if change_feed.seq == seq:
+                yield heartbeat()
+
+    response = Response(generate(seq), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@api.route('/drinks/import', methods=['POST'])
+@requires_auth('post:drinks')
+def import_drinks(payload):
+    """
+        **Import Drinks**
+
+        Creates drinks from a newline delimited JSON body, one drink per
+        line, as written by GET /drinks/export (the id is ignored). The
+        body is read a line at a time and written IMPORT_CHUNK_SIZE drinks
+        per transaction. Progress is logged after each chunk.
+
+        - Sample Call::
+
+            curl -X POST http://localhost:5000/drinks/import \
+                 -H 'content-type: application/x-ndjson' \
+                 --data-binary @drinks.ndjson
+
+        - Expected Success Response::
+
+            HTTP Status Code: 200
+
+            {
+            "created": 2,
+            "drinks_per_second": 1850.4,
+            "errors": [
+                {
+                "error": 409,
+                "line": 3,
+                "message": "Duplicate title.",
+                "success": false
+                }
+            ],
+            "failed": 1,
+            "received": 3,
+            "seconds": 0.002,
+            "success": true
+            }
+
+
+        - Expected Fail Response::
+
+            HTTP Status Code: 401
+            {
+                "description": "401: Authorization header is expected.",
+                "error": 401,
+                "message": "Unauthorized",
+                "success": false
+            }
+    """
+
+    started = time.perf_counter()
+    received = created = failed = 0
+    errors = []
+
+    for chunk in read_ndjson_chunks(request.stream, IMPORT_CHUNK_SIZE):
+        items = [value for _, value in chunk]
+        try:
+            results = Drink.insert_many(
+                [{} if isinstance(v, ValueError) else v for v in items])
+        except Exception:
+            abort(422)
+
+        for (line_number, value), result in zip(chunk, results):
+            if result['success']:
+                created += 1
+                continue
+            failed += 1
+            if isinstance(value, ValueError):
+                result = {'success': False, 'error': 400,
+                          'message': 'Invalid JSON.'}
+            if len(errors) < IMPORT_MAX_ERRORS:
+                errors.append(dict(result, line=line_number))
+
+        received += len(chunk)
+        elapsed = time.perf_counter() - started
+        current_app.logger.info(
+            'import: %d drinks read, %d created, %.0f/s',
+            received, created, received / elapsed)
+
+    elapsed = time.perf_counter() - started
+    return jsonify({'success': True, 'received': received,
+                    'created': created, 'failed': failed,
+                    'errors': errors, 'seconds': round(elapsed, 3),
+                    'drinks_per_second':
+                        round(received / elapsed, 1) if elapsed else 0})
+
+
+# ----------------------------------------------------------------------------#
+#  Prometheus metrics
+# ----------------------------------------------------------------------------#
+
+@api.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+        **Get Metrics**
+
+        Returns the metrics of the server in the Prometheus text format,
+        added up across the worker processes when PROMETHEUS_MULTIPROC_DIR
+        is set. See metrics.py. Answers 404 when prometheus_client is not
+        installed.
+
+        - Sample Call::
+
+            curl http://localhost:5000/metrics
+
+        - Expected Success Response::
+
+            HTTP Status Code: 200
+            Content-Type: text/plain; version=0.0.4; charset=utf-8
+
+            coffee_http_request_duration_seconds_bucket{le="0.005",...} 42
+            ...
+    """
+
+    if not metrics.enabled():
+        abort(404)
+    body, content_type = metrics.exposition()
+    return Response(body, content_type=content_type)
+
 
 # ------------------------------------------------------------------------#
 #  error handlers
 # ------------------------------------------------------------------------#
 
-@app.errorhandler(400)
+@api.app_errorhandler(400)
 def bad_request(error):
     return (jsonify({
         'success': False,
@@ -416,7 +1343,7 @@ def bad_request(error):
         }), 400)
 
 
-@app.errorhandler(401)
+@api.app_errorhandler(401)
 def unauthorized_user(error):
     return (jsonify({
         'success': False,
@@ -426,7 +1353,7 @@ def unauthorized_user(error):
         }), 401)
 
 
-@app.errorhandler(404)
+@api.app_errorhandler(404)
 def not_found(error):
     return (jsonify({
         'success': False,
@@ -436,7 +1363,7 @@ def not_found(error):
         }), 404)
 
 
-@app.errorhandler(405)
+@api.app_errorhandler(405)
 def not_found(error):
     return (jsonify({
         'success': False,
@@ -446,7 +1373,27 @@ def not_found(error):
         }), 405)
 
 
-@app.errorhandler(422)
+@api.app_errorhandler(409)
+def conflict(error):
+    return (jsonify({
+        'success': False,
+        'error': 409,
+        'message': 'Conflict',
+        'description': str(error),
+        }), 409)
+
+
+@api.app_errorhandler(412)
+def precondition_failed(error):
+    return (jsonify({
+        'success': False,
+        'error': 412,
+        'message': 'Precondition Failed',
+        'description': str(error),
+        }), 412)
+
+
+@api.app_errorhandler(422)
 def unprocessable(error):
     return (jsonify({
         'success': False,
@@ -456,7 +1403,20 @@ def unprocessable(error):
         }), 422)
 
 
-@app.errorhandler(500)
+@api.app_errorhandler(429)
+def too_many_requests(error):
+    response = jsonify({
+        'success': False,
+        'error': 429,
+        'message': 'Too Many Requests',
+        'description': str(error),
+        })
+    if error.retry_after is not None:
+        response.headers['Retry-After'] = str(error.retry_after)
+    return response, 429
+
+
+@api.app_errorhandler(500)
 def unprocessable(error):
     return (jsonify({
         'success': False,
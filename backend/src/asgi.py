@@ -0,0 +1,418 @@
+"""
+**Introduction**
+----------------
+An asyncio serving mode for the drinks API. It serves the same five
+endpoints as the WSGI app in api.py with async handlers, an async
+database driver and requires_auth_async, so one process can hold
+thousands of concurrent keep-alive connections:
+
+- GET /drinks
+- GET /drinks-detail
+- POST /drinks
+- PATCH /drinks/<id>
+- DELETE /drinks/<id>
+- GET /drinks/stream
+
+The app is built with Quart, which keeps Flask's API, and SQLAlchemy's
+asyncio extension. It needs the async driver for the database, e.g.
+aiosqlite for SQLite. Run it with any ASGI server::
+
+    hypercorn 'src.asgi:create_asgi_app()'
+
+The batch, export and import endpoints are only served by the WSGI app.
+Of the responses here, only the drink lists are compressed.
+
+"""
+
+import asyncio
+import time
+
+from quart import Blueprint, Quart, Response, current_app, request, \
+    jsonify, abort
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from werkzeug.exceptions import HTTPException
+
+from . import menu, metrics, serializer
+from .api import create_app, page_args, field_args, caller_form, \
+    expected_versions, written
+from .database.models import db, Drink, backfill_materialized, \
+    drinks_changed, sqlite_pragmas
+from .database.feed import change_feed, heartbeat, stream_preamble, \
+    HEARTBEAT_INTERVAL
+from .ratelimit import limiter, PUBLIC_BUDGET
+from .serializer import Fragment
+from .auth.auth import requires_auth_async
+
+# Async driver used for each database dialect
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'mysql': 'mysql+aiomysql',
+}
+
+ERROR_MESSAGES = {
+    400: 'Bad Request',
+    401: 'Unauthorized',
+    404: 'Resource Not Found',
+    405: 'Method Not Allowed',
+    409: 'Conflict',
+    412: 'Precondition Failed',
+    422: 'Unprocessable',
+    429: 'Too Many Requests',
+    500: 'Internal Server Error',
+}
+
+async_session = sessionmaker(class_=AsyncSession, expire_on_commit=False)
+'''Session factory of the async engine, bound by create_asgi_app().'''
+
+api = Blueprint('asgi_api', __name__)
+
+
+# ----------------------------------------------------------------------------#
+#  App factory
+#
+#  The schema, key providers and settings are prepared by the WSGI
+#  create_app(), so both serving modes start from the same database. Drinks
+#  without stored recipe JSON are backfilled at startup, since the async
+#  read path never loads ingredients.
+# ----------------------------------------------------------------------------#
+
+def create_asgi_app(config=None):
+    '''
+    create_asgi_app(config=None)
+        Returns a new Quart app serving the drinks API with async
+        handlers. config is applied as in create_app().
+    '''
+
+    started = time.perf_counter()
+    flask_app = create_app(config)
+    with flask_app.app_context():
+        backfill_materialized()
+        url = db.engine.url
+
+    app = Quart(__name__)
+    app.config.update(flask_app.config)
+    serializer.init_app(app)
+
+    engine = create_async_engine(async_url(url, app.config),
+                                 **_async_engine_options(url, app.config))
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine.sync_engine, 'connect',
+                     sqlite_pragmas(app.config))
+    async_session.configure(bind=engine)
+    app.register_blueprint(api)
+
+    # The client IP behind proxies, as ratelimit.init_app() does for WSGI
+
+    proxies = int(app.config['TRUSTED_PROXIES'])
+    if proxies:
+        from hypercorn.middleware import ProxyFixMiddleware
+        app.asgi_app = ProxyFixMiddleware(app.asgi_app,
+                                          trusted_hops=proxies)
+
+    @app.after_serving
+    async def dispose_engine():
+        await engine.dispose()
+
+    app.config['STARTUP_TIMINGS'] = dict(
+        app.config['STARTUP_TIMINGS'],
+        total=(time.perf_counter() - started) * 1000)
+    return app
+
+
+def async_url(url, config):
+    '''
+    async_url(url, config)
+        Returns ASYNC_DATABASE_URL if configured, otherwise url with its
+        driver switched to the async one for its dialect.
+    '''
+
+    if config.get('ASYNC_DATABASE_URL'):
+        return config['ASYNC_DATABASE_URL']
+    dialect = url.drivername.split('+')[0]
+    if dialect not in ASYNC_DRIVERS:
+        raise ValueError('No async driver known for %s; '
+                         'set ASYNC_DATABASE_URL' % dialect)
+    return url.set(drivername=ASYNC_DRIVERS[dialect])
+
+
+def _async_engine_options(url, config):
+    options = {}
+    if url.drivername.startswith('sqlite'):
+        options['connect_args'] = {
+            'timeout': int(config['SQLITE_BUSY_TIMEOUT']) / 1000.0}
+    if config.get('DB_POOL_SIZE'):
+        options['poolclass'] = AsyncAdaptedQueuePool
+        options['pool_size'] = int(config['DB_POOL_SIZE'])
+        options['max_overflow'] = int(config['DB_MAX_OVERFLOW'])
+    return options
+
+
+# Request metrics, see metrics.py
+
+@api.before_app_request
+async def start_metrics():
+    if metrics.enabled():
+        metrics.start_request()
+
+
+@api.after_app_request
+async def finish_metrics(response):
+    if metrics.enabled():
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.finish_request(request.method, route, response.status_code,
+                               response.content_length)
+    return response
+
+
+# CORS Headers
+
+@api.after_app_request
+async def after_request(response):
+    response.headers.add('Access-Control-Allow-Headers',
+                         'Content-Type,Authorization,true')
+    response.headers.add('Access-Control-Allow-Methods',
+                         'GET,PUT,POST,DELETE,OPTIONS')
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+
+# ----------------------------------------------------------------------------#
+# Helper Functions
+#    drink_list: reads a page of drinks as an encoded response body
+#    cached_menu: serves drink lists from the menu cache
+# ----------------------------------------------------------------------------#
+
+async def drink_list(form, fields, limit, after, ingredient, q):
+    '''
+    drink_list(form, fields, limit, after, ingredient, q)
+        Returns the encoded drink list response body for the 'short' or
+        'long' form, paged, filtered and narrowed to fields as in api.py.
+    '''
+
+    query = menu.list_select(form, fields, limit, after, ingredient, q,
+                             async_session.kw['bind'].dialect.name)
+    async with async_session() as session:
+        rows, next_after = menu.page_rows(
+            (await session.execute(query)).all(), limit)
+
+        # A drink written without stored recipe JSON needs its ingredients
+
+        recipes = {}
+        missing = menu.recipes_missing(rows, fields)
+        if missing:
+            drinks = (await session.execute(
+                menu.recipes_select(missing))).scalars()
+            recipes = {d.id: d.recipe_json(form) for d in drinks}
+    return menu.page_body(rows, fields, recipes, limit, next_after)
+
+
+async def cached_menu(key, build, private=False, store=True):
+    '''
+    cached_menu(key, build, private=False, store=True)
+        The async counterpart of api.cached_menu(). build is awaited on a
+        cache miss.
+    '''
+
+    tag, body, version = menu.lookup(key, request.if_none_match, store)
+    if tag is not None:
+        response = Response('', status=304)
+    else:
+        if body is None:
+            body = menu.save(key, await build(), version, store)
+        body, encoding, tag = menu.encode(key, body, version,
+                                          request.accept_encodings,
+                                          current_app.config)
+        response = Response(body, mimetype='application/json')
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+
+    menu.set_headers(response, tag, private)
+    return response
+
+
+# ----------------------------------------------------------------------------#
+# ----------------------------------------------------------------------------#
+# ROUTES
+#
+# Each route answers exactly as its counterpart in api.py, whose docstrings
+# describe the requests and responses.
+# ----------------------------------------------------------------------------#
+# ----------------------------------------------------------------------------#
+
+@api.route('/drinks', methods=['GET'])
+async def list_of_drinks_short_form():
+    """
+        **Get Drinks**
+
+        Get a list of the drinks in short form. See
+        api.list_of_drinks_short_form.
+    """
+
+    limiter.check(PUBLIC_BUDGET, request.remote_addr)
+    limit, after = page_args(request.args)
+    ingredient = request.args.get('ingredient')
+    q = request.args.get('q')
+    fields = field_args(request.args)
+
+    async def build():
+        return await drink_list('short', fields, limit, after, ingredient, q)
+
+    key = menu.list_key('short', fields, limit, after, ingredient, q)
+    return await cached_menu(key, build, store=q is None)
+
+
+@api.route('/drinks-detail', methods=['GET'])
+@requires_auth_async('get:drinks-detail')
+async def list_of_drinks_long_form(payload):
+    """
+        **Retrieve Drink Details in Long form**
+
+        Get a list of the drinks in long form. See
+        api.list_of_drinks_long_form.
+    """
+
+    limit, after = page_args(request.args)
+    ingredient = request.args.get('ingredient')
+    q = request.args.get('q')
+    fields = field_args(request.args)
+
+    async def build():
+        return await drink_list('long', fields, limit, after, ingredient, q)
+
+    key = menu.list_key('long', fields, limit, after, ingredient, q)
+    return await cached_menu(key, build, private=True, store=q is None)
+
+
+@api.route('/drinks', methods=['POST'])
+@requires_auth_async('post:drinks')
+async def create_new_drink(payload):
+    """
+        **Create Drink**
+
+        This API will create a new Drink. See api.create_new_drink.
+    """
+
+    request_json = await request.get_json()
+
+    try:
+        drink = Drink(title=request_json.get('title', None),
+                      recipe=request_json.get('recipe', None))
+        drink.materialize()
+        async with async_session() as session:
+            session.add(drink)
+            await session.commit()
+    except Exception:
+        abort(422)
+
+    drinks_changed([drink.change('created')])
+    response = jsonify({'success': True,
+                        'drinks': Fragment(drink.long_json())})
+    response.set_etag(str(drink.version))
+    return response
+
+
+@api.route('/drinks/<int:drink_id>', methods=['PATCH'])
+@requires_auth_async('patch:drinks')
+async def update_drink(payload, drink_id):
+    """
+        **Updates a drink**
+
+        This API will update a drink by drink Id. See api.update_drink.
+    """
+
+    request_json = await request.get_json()
+    if not isinstance(request_json, dict):
+        abort(422)
+    versions, conflict = expected_versions(request.if_match, request_json)
+
+    async with async_session() as session:
+        result, change = await session.run_sync(
+            Drink.update_where, drink_id, title=request_json.get('title'),
+            recipe=request_json.get('recipe'), versions=versions)
+        if change is None:
+            await session.rollback()
+            written(result, conflict)
+        await session.commit()
+
+    drinks_changed([change])
+    response = jsonify({'success': True, 'drinks': [result['drinks']]})
+    response.set_etag(str(result['version']))
+    return response
+
+
+@api.route('/drinks/<int:drink_id>', methods=['DELETE'])
+@requires_auth_async('delete:drinks')
+async def delete_drink(payload, drink_id):
+    """
+        **Delete a drink from the database**
+
+        This API will delete a drink from the database. See
+        api.delete_drink.
+    """
+
+    versions, conflict = expected_versions(request.if_match)
+
+    async with async_session() as session:
+        result, change = await session.run_sync(
+            Drink.delete_where, drink_id, versions)
+        if change is None:
+            await session.rollback()
+            written(result, conflict)
+        await session.commit()
+
+    drinks_changed([change])
+    return jsonify(result)
+
+
+@api.route('/drinks/stream', methods=['GET'])
+async def stream_drinks():
+    """
+        **Stream Drink Changes**
+
+        Pushes every committed drink write as a server-sent event. See
+        api.stream_drinks. Every stream on the event loop waits on the
+        same change feed event, so subscribers cost no thread each.
+    """
+
+    limiter.check(PUBLIC_BUDGET, request.remote_addr)
+    loop = asyncio.get_running_loop()
+    form = await loop.run_in_executor(None, caller_form,
+                                      request.headers, request.args)
+    seq = change_feed.position(request.headers.get('Last-Event-ID'))
+
+    async def generate(seq):
+        yield stream_preamble().encode('utf-8')
+        while True:
+            messages, seq = change_feed.since(seq, form)
+            if messages:
+                yield messages.encode('utf-8')
+            await change_feed.wait_async(seq, HEARTBEAT_INTERVAL)
+            if change_feed.seq == seq:
+                yield heartbeat().encode('utf-8')
+
+    response = Response(generate(seq), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.timeout = None
+    return response
+
+
+# ------------------------------------------------------------------------#
+#  error handlers
+# ------------------------------------------------------------------------#
+
+@api.app_errorhandler(HTTPException)
+async def http_error(error):
+    headers = {}
+    if getattr(error, 'retry_after', None) is not None:
+        headers['Retry-After'] = str(error.retry_after)
+    return (jsonify({
+        'success': False,
+        'error': error.code,
+        'message': ERROR_MESSAGES.get(error.code, error.name),
+        'description': str(error),
+        }), error.code, headers)
@@ -1,12 +1,61 @@
+import asyncio
+import hashlib
 import json
-from flask import request, _request_ctx_stack, abort
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from flask import request, abort
 from functools import wraps
-from jose import jwt
 from urllib.request import urlopen
 
-AUTH0_DOMAIN = 'dev-p35ewo73.auth0.com'
+from ..metrics import JWKS_FETCHES, JWT_VERIFY_SECONDS, TOKEN_CACHE_HITS, \
+    TOKEN_CACHE_MISSES
+from ..profiling import phase
+from ..ratelimit import limiter
+from ..settings import config_defaults
+
+# jose is imported where it's used, so it's only loaded once a token or a
+# key has to be handled instead of on every worker start.
+
+# ----------------------------------------------------------------------------#
+#  Settings
+#
+#  Applied by settings.config_defaults(), see there for the order.
+#
+#     AUTH0_DOMAIN: the Auth0 tenant domain
+#     API_AUDIENCE: the expected aud claim
+#     AUTH_ISSUER: the expected iss claim, by default https://AUTH0_DOMAIN/
+#     JWKS_URL: where the signing keys are fetched from, by default the
+#               tenant's /.well-known/jwks.json
+#     JWKS_PATH: a local JWKS file, or a directory of *.json JWKS files,
+#                used instead of JWKS_URL. Changes are picked up without a
+#                restart
+# ----------------------------------------------------------------------------#
+
+AUTH_DEFAULTS = {
+    'AUTH0_DOMAIN': 'dev-p35ewo73.auth0.com',
+    'API_AUDIENCE': 'coffee',
+    'AUTH_ISSUER': None,
+    'JWKS_URL': None,
+    'JWKS_PATH': None,
+}
+
 ALGORITHMS = ['RS256']
-API_AUDIENCE = 'coffee'
+
+# Seconds between mtime checks of JWKS_PATH
+JWKS_POLL_INTERVAL = 1.0
+
+# Seconds to keep the key set when the issuer sends no Cache-Control max-age
+JWKS_DEFAULT_TTL = 600
+
+# Minimum seconds between refetches triggered by an unknown kid, and the
+# shortest time a fetched key set is kept, whatever its max-age
+JWKS_MIN_REFRESH_INTERVAL = 30
+
+# Maximum number of verified tokens held by the token cache
+TOKEN_CACHE_SIZE = 4096
 
 
 # Auth Header
@@ -14,11 +63,14 @@ API_AUDIENCE = 'coffee'
 # def get_token_auth_header():
 #   raise Exception('Not Implemented')
 
-def get_token_auth_header():
+def get_token_auth_header(headers=None):
     """Obtains the Access Token from the Authorization Header
+    of the current Flask request, or of headers when given
     """
 
-    auth = request.headers.get('Authorization', None)
+    if headers is None:
+        headers = request.headers
+    auth = headers.get('Authorization', None)
     if not auth:
         abort(401, 'Authorization header is expected.')
 
@@ -54,6 +106,409 @@ def check_permissions(permission, payload):
     return True
 
 
+# ----------------------------------------------------------------------------#
+#  Signing key providers
+#
+#  A provider loads a JWKS document and says how long it may be kept.
+#
+#     RemoteJWKSProvider: the issuer's /.well-known/jwks.json over HTTPS
+#     LocalJWKSProvider: a JWKS file, or a directory of JWKS files, read
+#                        from disk and reloaded when their mtime changes.
+#                        Needs no network access at all.
+# ----------------------------------------------------------------------------#
+
+class RemoteJWKSProvider:
+
+    '''
+    RemoteJWKSProvider
+    Loads the key set from a JWKS URL, honoring Cache-Control max-age
+    '''
+
+    def __init__(self, url, default_ttl=JWKS_DEFAULT_TTL):
+        self.url = url
+        self.default_ttl = default_ttl
+
+    def load(self):
+        '''
+        load()
+            Returns the JWKS document and the seconds it may be cached.
+            The key store keeps it for at least JWKS_MIN_REFRESH_INTERVAL.
+        '''
+
+        jsonurl = urlopen(self.url)
+        try:
+            jwks = json.loads(jsonurl.read())
+            ttl = _max_age(jsonurl.headers.get('Cache-Control'))
+        finally:
+            jsonurl.close()
+        return jwks, self.default_ttl if ttl is None else ttl
+
+    def changed(self):
+        return False
+
+
+class LocalJWKSProvider:
+
+    '''
+    LocalJWKSProvider
+    Loads the key set from a JWKS file or a directory of JWKS files
+    '''
+
+    def __init__(self, path, poll_interval=JWKS_POLL_INTERVAL):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._signature = None
+        self._next_poll = 0.0
+
+    def load(self):
+        '''
+        load()
+            Returns the merged JWKS document of every file. The keys are
+            kept until the files change.
+        '''
+
+        signature = self._stat()
+        keys = []
+        for filename, _, _ in signature:
+            with open(filename) as f:
+                keys.extend(json.load(f).get('keys', []))
+        self._signature = signature
+        self._next_poll = time.monotonic() + self.poll_interval
+        return {'keys': keys}, float('inf')
+
+    def changed(self):
+        '''
+        changed()
+            True if a file was added, removed or modified since the last
+            load. The files are stat'ed at most once per poll_interval.
+        '''
+
+        now = time.monotonic()
+        if now < self._next_poll:
+            return False
+        self._next_poll = now + self.poll_interval
+        try:
+            return self._stat() != self._signature
+        except OSError:
+            return False
+
+    def _files(self):
+        if not os.path.isdir(self.path):
+            return [self.path]
+        return sorted(os.path.join(self.path, name)
+                      for name in os.listdir(self.path)
+                      if name.endswith('.json'))
+
+    def _stat(self):
+        signature = []
+        for filename in self._files():
+            st = os.stat(filename)
+            signature.append((filename, st.st_mtime_ns, st.st_size))
+        return tuple(signature)
+
+
+def _max_age(cache_control):
+    if not cache_control:
+        return None
+    match = re.search(r'max-age=(\d+)', cache_control)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+# ----------------------------------------------------------------------------#
+#  JWKS key store
+#
+#  Holds the signing keys for the whole process. The key set is loaded
+#  from the provider once and kept for as long as the provider allows. A
+#  token signed with an unknown kid triggers a reload, at most once every
+#  JWKS_MIN_REFRESH_INTERVAL seconds, so a stream of bad tokens can't force
+#  a fetch per request.
+# ----------------------------------------------------------------------------#
+
+class JWKSKeyStore:
+
+    '''
+    JWKSKeyStore
+    Process-wide cache of parsed RSA signing keys, indexed by kid
+    '''
+
+    def __init__(self, provider,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL):
+        self.provider = provider
+        self.min_refresh_interval = min_refresh_interval
+        self._keys = {}
+        self._expires_at = 0.0
+        self._last_fetch = None
+        self._lock = threading.Lock()
+
+    def get_key(self, kid):
+        '''
+        get_key(kid)
+            Returns the parsed key object for kid, or None if the issuer
+            does not publish it.
+        '''
+
+        now = time.monotonic()
+        if self.provider.changed():
+            self._expires_at = 0.0
+        if now >= self._expires_at:
+            self.refresh()
+        key = self._keys.get(kid)
+        if key is None and self._may_refetch(now):
+            self.refresh()
+            key = self._keys.get(kid)
+        return key
+
+    def has_key(self, kid):
+        '''
+        has_key(kid)
+            True if kid is in the key set currently held. Never fetches.
+        '''
+
+        return kid in self._keys
+
+    def is_fresh(self):
+        '''
+        is_fresh()
+            True if the key set held is still current: its TTL hasn't run
+            out and the provider reports no change. Never fetches.
+        '''
+
+        if self.provider.changed():
+            self._expires_at = 0.0
+            return False
+        return time.monotonic() < self._expires_at
+
+    def set_provider(self, provider):
+        '''
+        set_provider(provider)
+            Switches to a new key provider, dropping the keys held. Its
+            keys are loaded on first use, or by load_local_keys().
+        '''
+
+        with self._lock:
+            self.provider = provider
+            self._keys = {}
+            self._expires_at = 0.0
+            self._last_fetch = None
+
+    def refresh(self):
+        '''
+        refresh()
+            Loads the key set from the provider. If the load fails the
+            keys already held are kept, so an identity provider outage
+            doesn't lock out tokens signed with a known key.
+        '''
+
+        with self._lock:
+
+            # Another thread refreshed while we were waiting for the lock
+
+            now = time.monotonic()
+            if not self._may_refetch(now) and now < self._expires_at:
+                return
+
+            self._last_fetch = now
+            try:
+                jwks, ttl = self.provider.load()
+            except Exception:
+                JWKS_FETCHES.labels('error').inc()
+                if not self._keys:
+                    raise
+                self._expires_at = self._last_fetch + \
+                    self.min_refresh_interval
+                return
+
+            # A max-age of 0 would otherwise refetch on every request
+
+            JWKS_FETCHES.labels('ok').inc()
+            self._keys = self._parse(jwks)
+            self._expires_at = self._last_fetch + \
+                max(ttl, self.min_refresh_interval)
+
+    def _may_refetch(self, now):
+        return self._last_fetch is None or \
+            now - self._last_fetch >= self.min_refresh_interval
+
+    @staticmethod
+    def _parse(jwks):
+        from jose import jwk
+
+        keys = {}
+        for key in jwks.get('keys', []):
+            if key.get('kty') != 'RSA' or 'kid' not in key:
+                continue
+            if key.get('use', 'sig') != 'sig':
+                continue
+            try:
+                keys[key['kid']] = jwk.construct(key, ALGORITHMS[0])
+            except Exception:
+                continue
+        return keys
+
+
+def key_provider(config):
+    '''
+    key_provider(config)
+        LocalJWKSProvider when JWKS_PATH is set in config, otherwise the
+        remote JWKS_URL.
+    '''
+
+    if config['JWKS_PATH']:
+        return LocalJWKSProvider(config['JWKS_PATH'])
+    return RemoteJWKSProvider(config['JWKS_URL'] or 'https://' +
+                              config['AUTH0_DOMAIN'] +
+                              '/.well-known/jwks.json')
+
+
+# The default tenant's keys until init_app() applies the app's settings
+jwks_store = JWKSKeyStore(RemoteJWKSProvider(
+    'https://' + AUTH_DEFAULTS['AUTH0_DOMAIN'] + '/.well-known/jwks.json'))
+
+# The aud and iss claims every token must carry, set by init_app()
+expected_claims = {
+    'audience': AUTH_DEFAULTS['API_AUDIENCE'],
+    'issuer': 'https://' + AUTH_DEFAULTS['AUTH0_DOMAIN'] + '/',
+}
+
+
+def load_local_keys():
+    '''
+    load_local_keys()
+        Loads the keys of a local key provider now, so they are ready
+        before the first request. Remote keys are fetched on first use.
+    '''
+
+    if isinstance(jwks_store.provider, LocalJWKSProvider):
+        jwks_store.refresh()
+
+
+# ----------------------------------------------------------------------------#
+#  Verified token cache
+#
+#  A bounded LRU of tokens that already passed verify_decode_jwt, keyed by
+#  the SHA-256 digest of the token so raw bearer tokens are never held.
+#  An entry is only served until the token's exp, and only while the key
+#  that signed it is still published by the issuer. Once the key set is
+#  due for a reload, e.g. its TTL ran out or the local files changed, hits
+#  turn into misses, so the token is verified again against the new keys.
+# ----------------------------------------------------------------------------#
+
+class TokenCache:
+
+    '''
+    TokenCache
+    LRU cache of decoded JWT payloads, with hit and miss counters
+    '''
+
+    def __init__(self, key_store, maxsize=TOKEN_CACHE_SIZE):
+        self.key_store = key_store
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        '''
+        get(token)
+            Returns the cached payload for token, or None on a miss.
+        '''
+
+        digest = hashlib.sha256(token.encode('utf-8')).digest()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                payload, exp, kid = entry
+                if time.time() < exp and self.key_store.is_fresh() and \
+                        self.key_store.has_key(kid):
+                    self._entries.move_to_end(digest)
+                    self.hits += 1
+                    TOKEN_CACHE_HITS.inc()
+                    return payload
+                del self._entries[digest]
+            self.misses += 1
+            TOKEN_CACHE_MISSES.inc()
+            return None
+
+    def put(self, token, payload):
+        '''
+        put(token, payload)
+            Caches a verified payload. Tokens without an exp claim are
+            not cached.
+        '''
+
+        from jose import jwt
+
+        exp = payload.get('exp')
+        if not isinstance(exp, (int, float)) or exp <= time.time():
+            return
+        kid = jwt.get_unverified_header(token).get('kid')
+        digest = hashlib.sha256(token.encode('utf-8')).digest()
+        with self._lock:
+            self._entries[digest] = (payload, exp, kid)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        '''
+        stats()
+            Returns the cache counters.
+
+            Returns::
+
+                {'size': int, 'maxsize': int, 'hits': int,
+                 'misses': int, 'evictions': int, 'hit_rate': float}
+        '''
+
+        lookups = self.hits + self.misses
+        return {'size': len(self._entries), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+token_cache = TokenCache(jwks_store)
+
+
+def init_app(app):
+    '''
+    init_app(app)
+        Applies the auth settings of a Flask app: the claims tokens are
+        checked against and the provider of the signing keys, loading
+        local keys now so they are ready before the first request.
+    '''
+
+    config_defaults(app, AUTH_DEFAULTS)
+    config = app.config
+
+    expected_claims['audience'] = config['API_AUDIENCE']
+    expected_claims['issuer'] = config['AUTH_ISSUER'] or \
+        'https://' + config['AUTH0_DOMAIN'] + '/'
+
+    provider = key_provider(config)
+    if _provider_source(provider) != _provider_source(jwks_store.provider):
+        jwks_store.set_provider(provider)
+    load_local_keys()
+
+    # Tokens verified against other keys or claims are verified again
+
+    token_cache.clear()
+
+
+def _provider_source(provider):
+    return type(provider), getattr(provider, 'path', None), \
+        getattr(provider, 'url', None)
+
+
 # ----------------------------------------------------------------------------#
 # verify_decode_jwt(token) method
 # INPUTS
@@ -63,29 +518,23 @@ def check_permissions(permission, payload):
 # ----------------------------------------------------------------------------#
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen('https://' + AUTH0_DOMAIN + '/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    with JWT_VERIFY_SECONDS.time():
+        return _verify_decode_jwt(token)
+
+
+def _verify_decode_jwt(token):
+    from jose import jwt
+
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
 
     if 'kid' not in unverified_header:
-        raise AuthError({'code': 'invalid_header',
-                        'description': 'Authorization malformed.'}, 401)
-
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e'],
-                }
-    if rsa_key:
+        abort(401, 'Authorization malformed.')
+
+    rsa_key = jwks_store.get_key(unverified_header['kid'])
+    if rsa_key is not None:
         try:
             payload = jwt.decode(token, rsa_key, algorithms=ALGORITHMS,
-                                 audience=API_AUDIENCE,
-                                 issuer='https://' + AUTH0_DOMAIN + '/')
+                                 **expected_claims)
 
             return payload
         except jwt.ExpiredSignatureError:
@@ -103,6 +552,36 @@ def verify_decode_jwt(token):
     abort(400, 'Unable to find the appropriate key.')
 
 
+# ----------------------------------------------------------------------------#
+# verified_payload(token) method
+# INPUTS
+#    token: a json web token (string)
+# Returns:
+#     decoded payload, from the token cache when the token was already
+#     verified
+# ----------------------------------------------------------------------------#
+
+def verified_payload(token):
+    payload = token_cache.get(token)
+    if payload is None:
+        try:
+            payload = verify_decode_jwt(token)
+        except Exception:
+            abort(401)
+        token_cache.put(token, payload)
+    return payload
+
+
+def caller(payload, request):
+    '''
+    caller(payload, request)
+        Returns who a request is rate limited as: the JWT sub, or the
+        client IP for a token without one.
+    '''
+
+    return payload.get('sub') or request.remote_addr
+
+
 # ----------------------------------------------------------------------------#
 #  @requires_auth(permission) decorator method
 #  INPUTS
@@ -116,13 +595,49 @@ def requires_auth(permission=''):
 
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(token)
-            except Exception:
-                abort(401)
-            check_permissions(permission, payload)
+            with phase('auth'):
+                payload = verified_payload(get_token_auth_header())
+                check_permissions(permission, payload)
+                limiter.check(permission, caller(payload, request))
             return f(payload, *args, **kwargs)
         return wrapper
 
     return requires_auth_decorator
+
+
+# ----------------------------------------------------------------------------#
+#  @requires_auth_async(permission) decorator method
+#  INPUTS
+#     permission: string permission (i.e. 'post:drink')
+#
+#  requires_auth for the async handlers of the ASGI app. A cached token is
+#  checked on the event loop. A token that has to be verified, which may
+#  mean fetching the JWKS and always means an RSA signature check, is
+#  verified in the default executor so the loop keeps serving other
+#  connections.
+# ----------------------------------------------------------------------------#
+
+def requires_auth_async(permission=''):
+
+    def requires_auth_decorator(f):
+
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            from quart import request as async_request
+
+            token = get_token_auth_header(async_request.headers)
+            payload = token_cache.get(token)
+            if payload is None:
+                loop = asyncio.get_running_loop()
+                try:
+                    payload = await loop.run_in_executor(
+                        None, verify_decode_jwt, token)
+                except Exception:
+                    abort(401)
+                token_cache.put(token, payload)
+            check_permissions(permission, payload)
+            limiter.check(permission, caller(payload, async_request))
+            return await f(payload, *args, **kwargs)
+        return wrapper
+
+    return requires_auth_decorator
@@ -0,0 +1,201 @@
+"""
+**Introduction**
+----------------
+Response compression negotiated from Accept-Encoding.
+
+- negotiate(accept_encodings, size, config) : the encoding to send a
+  body with
+- cached_variant(key, body, version, accept_encodings, config) : a menu
+  body compressed once per menu version
+- compress_response(response) : compresses a response after the request
+
+Bodies of at least COMPRESS_MIN_SIZE bytes are sent with brotli when the
+client accepts it and the brotli package is installed, otherwise with
+gzip. Smaller bodies, streamed responses such as the export and the
+change feed, and responses other than 200 are sent as they are.
+
+The drink list responses come from the menu cache, so the same body is
+sent again and again until the menu changes. Their compressed variants
+are kept in the menu cache next to the body and dropped with it, so each
+variant is compressed once per menu version. A compressed variant gets
+its own strong ETag, the ETag of the body with the encoding appended.
+
+"""
+
+import gzip
+
+from flask import current_app, request
+
+from .database.cache import menu_cache
+from .settings import config_defaults
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# ----------------------------------------------------------------------------#
+#  Settings
+#
+#  Applied by settings.config_defaults(), see there for the order.
+#
+#     COMPRESS_MIN_SIZE: smallest body compressed, in bytes
+#     GZIP_LEVEL: gzip compression level, 1 (fastest) to 9
+#     BROTLI_QUALITY: brotli quality, 0 (fastest) to 11
+# ----------------------------------------------------------------------------#
+
+COMPRESSION_DEFAULTS = {
+    'COMPRESS_MIN_SIZE': 1024,
+    'GZIP_LEVEL': 6,
+    'BROTLI_QUALITY': 5,
+}
+
+# Content types worth compressing
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'text/plain')
+
+
+def encodings():
+    '''
+    encodings()
+        Returns the encodings the server can send, preferred first.
+    '''
+
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate(accept_encodings, size, config):
+    '''
+    negotiate(accept_encodings, size, config)
+        Returns the encoding to send a body of size bytes with, 'br' or
+        'gzip', or None to send it as it is. accept_encodings is the
+        parsed Accept-Encoding header of the request, config the app
+        config.
+    '''
+
+    if size < int(config['COMPRESS_MIN_SIZE']):
+        return None
+    return accept_encodings.best_match(encodings())
+
+
+def compress(body, encoding, config):
+    '''
+    compress(body, encoding, config)
+        Returns body compressed with encoding, 'br' or 'gzip', at the
+        level set in config.
+    '''
+
+    if encoding == 'br':
+        return brotli.compress(body, quality=int(config['BROTLI_QUALITY']))
+
+    # mtime=0 gives the same bytes for the same body
+
+    return gzip.compress(body, compresslevel=int(config['GZIP_LEVEL']),
+                         mtime=0)
+
+
+def etag(tag, encoding):
+    '''
+    etag(tag, encoding)
+        Returns the ETag of the encoding variant of the body tagged tag.
+    '''
+
+    if encoding is None:
+        return tag
+    return '%s-%s' % (tag, encoding)
+
+
+def identity_etag(tag):
+    '''
+    identity_etag(tag)
+        Returns the ETag of the body a compressed variant tagged tag was
+        made from, or tag itself when it names no encoding.
+
+        EXAMPLE::
+
+            identity_etag('12-gzip')
+            '12'
+
+    '''
+
+    for encoding in ('br', 'gzip'):
+        if tag.endswith('-' + encoding):
+            return tag[:-len(encoding) - 1]
+    return tag
+
+
+def matching_etag(if_none_match, tag):
+    '''
+    matching_etag(if_none_match, tag)
+        Returns the ETag of the body tagged tag, or of one of its
+        compressed variants, held by If-None-Match, or None.
+    '''
+
+    for encoding in (None,) + encodings():
+        variant = etag(tag, encoding)
+        if if_none_match.contains(variant):
+            return variant
+    return None
+
+
+def cached_variant(key, body, version, accept_encodings, config):
+    '''
+    cached_variant(key, body, version, accept_encodings, config)
+        Returns (body, encoding) for the menu cache body of key built at
+        version, compressed as negotiated. A compressed variant is taken
+        from the menu cache, or compressed and stored there.
+
+        EXAMPLE::
+
+            body, encoding = cached_variant(
+                'short:None:None:None:None:id,recipe,title', body, version,
+                request.accept_encodings, current_app.config)
+
+    '''
+
+    encoding = negotiate(accept_encodings, len(body), config)
+    if encoding is None:
+        return body, None
+
+    variant = menu_cache.get_variant(key, encoding)
+    if variant is None:
+        variant = compress(body, encoding, config)
+        menu_cache.set_variant(key, encoding, variant, version)
+    return variant, encoding
+
+
+# ----------------------------------------------------------------------------#
+#  Flask hooks
+# ----------------------------------------------------------------------------#
+
+def init_app(app):
+    '''
+    init_app(app)
+        Compresses the responses of a Flask app.
+    '''
+
+    config_defaults(app, COMPRESSION_DEFAULTS)
+
+    app.after_request(compress_response)
+
+
+def compress_response(response):
+    if (response.status_code != 200 or response.is_streamed or
+            response.direct_passthrough or
+            response.mimetype not in COMPRESSIBLE):
+        return response
+    response.vary.add('Accept-Encoding')
+    if 'Content-Encoding' in response.headers:
+        return response
+
+    body = response.get_data()
+    encoding = negotiate(request.accept_encodings, len(body),
+                         current_app.config)
+    if encoding is None:
+        return response
+
+    response.set_data(compress(body, encoding, current_app.config))
+    response.headers['Content-Encoding'] = encoding
+    tag, weak = response.get_etag()
+    if tag is not None and not weak:
+        response.set_etag(etag(tag, encoding))
+    return response
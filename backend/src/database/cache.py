@@ -0,0 +1,274 @@
+"""
+**Introduction**
+
+The menu cache holds encoded drink list responses so that a read is a
+dict lookup instead of a table scan plus JSON encoding.
+
+- MenuCache Class : the encoded response bodies, keyed by response form,
+  and the menu version they were built at, with their compressed variants.
+- SharedGeneration Class : a write counter shared by the worker processes
+
+Every write to the Drink table invalidates the cache and bumps the menu
+version. A body built from a read that started before the invalidation is
+discarded instead of stored, so a stale menu is never cached.
+
+Each worker process of a prefork server has a cache of its own. A write
+also bumps the generation counter in MENU_GENERATION_FILE, a small file
+every worker maps into memory. Before serving a menu, a worker compares
+the counter with the one it last saw and drops its cache if another
+worker has written since. That is an 8 byte memory read per request, so
+a write is seen by every worker from its next request on, without a
+database query.
+
+The menu version also drives the ETag of the drink list responses. An
+ETag combines the version with a random epoch. With a generation file,
+the version is the shared counter and the epoch is stored in the file
+when it is created, so every worker gives the same menu the same tag and
+a tag from one worker is answered with a 304 by another only if no write
+has happened since. Without one, the epoch is chosen when the process
+starts, so tags handed out before a restart never match a new menu.
+
+"""
+
+import hashlib
+import os
+import struct
+import threading
+
+from ..metrics import MENU_CACHE_HITS, MENU_CACHE_MISSES
+from ..settings import config_defaults, database_file
+from ..sharedfile import SharedFile
+
+# Maximum number of response bodies held, one per distinct page request
+MENU_CACHE_SIZE = 256
+
+# ----------------------------------------------------------------------------#
+#  Settings
+#
+#  Applied by settings.config_defaults(), see there for the order.
+#
+#     MENU_GENERATION_FILE: the generation file shared by the workers of a
+#                           server. By default one in the temp directory
+#                           named after DATABASE_URL, so only apps on the
+#                           same database share it. 'off' keeps each cache
+#                           to its process
+# ----------------------------------------------------------------------------#
+
+CACHE_DEFAULTS = {
+    'MENU_GENERATION_FILE': None,
+}
+
+# Generation file: magic, the epoch of the file, then the counter
+GENERATION = struct.Struct('<8s8sQ')
+MAGIC = b'coffeemg'
+
+
+# ----------------------------------------------------------------------------#
+#  Class SharedGeneration
+# ----------------------------------------------------------------------------#
+
+class SharedGeneration:
+
+    '''
+    SharedGeneration(path)
+    A counter of drink writes in a memory-mapped file shared between
+    processes, with a random epoch chosen when the file is created
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = SharedFile(path, MAGIC, GENERATION.size,
+                               fill=lambda: os.urandom(8))
+
+    def read(self):
+        '''
+        read()
+            Returns the (epoch, counter) pair. The epoch never changes and
+            the counter is an aligned 8 byte read, so no lock is taken.
+        '''
+
+        _, epoch, generation = GENERATION.unpack_from(self.file.map())
+        return epoch.hex(), generation
+
+    def bump(self):
+        '''
+        bump()
+            Adds one to the counter and returns the new (epoch, counter)
+            pair.
+        '''
+
+        with self.file.locked() as data:
+            _, epoch, generation = GENERATION.unpack_from(data)
+            generation += 1
+            GENERATION.pack_into(data, 0, MAGIC, epoch, generation)
+        return epoch.hex(), generation
+
+
+# ----------------------------------------------------------------------------#
+#  Class MenuCache
+# ----------------------------------------------------------------------------#
+
+class MenuCache:
+
+    '''
+    MenuCache
+    In-process cache of encoded drink list responses
+    '''
+
+    def __init__(self, maxsize=MENU_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.epoch = os.urandom(4).hex()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.shared = None
+        self._entries = {}
+        self._variants = {}
+        self._lock = threading.Lock()
+
+    def share(self, path):
+        '''
+        share(path)
+            Shares invalidations with the other processes through the
+            generation file at path, or stops sharing them for None.
+        '''
+
+        if path is None:
+            if self.shared is not None:
+                self.shared = None
+                self.epoch = os.urandom(4).hex()
+        elif self.shared is None or self.shared.path != path:
+            self.shared = SharedGeneration(path)
+
+    def sync(self):
+        '''
+        sync()
+            Drops every cached body if another process has written the
+            drinks since this one last looked, and takes the shared counter
+            as the menu version. Called before each menu read.
+        '''
+
+        shared = self.shared
+        if shared is None:
+            return
+        if shared.read() != (self.epoch, self.version):
+            with self._lock:
+
+                # Read again under the lock, so a bump made meanwhile by
+                # invalidate() in another thread isn't undone
+
+                epoch, generation = shared.read()
+                if (epoch, generation) != (self.epoch, self.version):
+                    self._entries = {}
+                    self._variants = {}
+                    self.epoch, self.version = epoch, generation
+
+    def get(self, key):
+        '''
+        get(key)
+            Returns a (body, version) pair for key, or None on a miss.
+        '''
+
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            MENU_CACHE_MISSES.inc()
+        else:
+            self.hits += 1
+            MENU_CACHE_HITS.inc()
+        return entry
+
+    def set(self, key, body, version):
+        '''
+        set(key, body, version)
+            Stores body for key if the cache is still at version, the
+            version read before the body was built. Once the cache is
+            full, new keys are not stored until the next invalidation.
+
+            EXAMPLE::
+
+                version = menu_cache.version
+                body = build_body()
+                menu_cache.set('short', body, version)
+
+        '''
+
+        # A write by another process since the body was built is noticed
+        # here, before it is stored
+
+        self.sync()
+        with self._lock:
+            if version != self.version:
+                return
+            if key in self._entries or len(self._entries) < self.maxsize:
+                self._entries[key] = (body, version)
+
+    def get_variant(self, key, encoding):
+        '''
+        get_variant(key, encoding)
+            Returns the body of key compressed with encoding, e.g. 'gzip',
+            or None if it isn't held.
+        '''
+
+        return self._variants.get((key, encoding))
+
+    def set_variant(self, key, encoding, body, version):
+        '''
+        set_variant(key, encoding, body, version)
+            Stores the body of key compressed with encoding, if the cache
+            is still at version and holds the body of key.
+        '''
+
+        with self._lock:
+            if version == self.version and key in self._entries:
+                self._variants[(key, encoding)] = body
+
+    def etag(self, key, version=None):
+        '''
+        etag(key, version=None)
+            Returns the strong ETag of the key response at version,
+            defaulting to the current menu version. The key is hashed,
+            as it may hold request text that can't go in a header. Every
+            process sharing a generation file gives the same tag.
+        '''
+
+        if version is None:
+            version = self.version
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8)
+        return '%s-%d-%s' % (self.epoch, version, digest.hexdigest())
+
+    def invalidate(self):
+        '''
+        invalidate()
+            Drops every cached body, here and, through the generation
+            file, in the other processes. Called after each drink write.
+            Returns the (epoch, generation) of the file after the bump, or
+            None when the cache isn't shared.
+        '''
+
+        with self._lock:
+            self._entries = {}
+            self._variants = {}
+            if self.shared is None:
+                self.version += 1
+                return None
+            self.epoch, self.version = self.shared.bump()
+            return self.epoch, self.version
+
+
+menu_cache = MenuCache()
+
+
+def init_app(app):
+    '''
+    init_app(app)
+        Applies the MENU_GENERATION_FILE setting of a Flask app to the
+        menu cache.
+    '''
+
+    config_defaults(app, CACHE_DEFAULTS)
+
+    path = app.config['MENU_GENERATION_FILE']
+    if path is None:
+        path = database_file(app.config['DATABASE_URL'], 'menu-generation')
+    menu_cache.share(None if str(path).lower() == 'off' else path)
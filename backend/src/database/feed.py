@@ -0,0 +1,285 @@
+"""
+**Introduction**
+
+The change feed pushes drink writes to the clients subscribed to
+GET /drinks/stream as server-sent events.
+
+- ChangeFeed Class : a ring buffer of the latest drink events, encoded
+  once per form when they are published.
+
+Every committed write through the Drink write methods publishes one
+event per drink: created, updated or deleted. Each event is encoded as
+an SSE message in both the short and the long form at publish time, so
+fanning it out is a buffer read per subscriber.
+
+Async subscribers never get a thread of their own: they wait on one
+asyncio event per event loop, which a publish sets once for all of that
+loop's subscribers. A WSGI stream holds a worker thread while it is open
+and waits on a shared condition, so many subscribers are best served by
+the asyncio app. A subscriber that falls further behind than the ring
+holds gets a reset event and should reload the menu.
+
+The events live in the process that made the write. Writes by the other
+worker processes of a prefork server are noticed through the generation
+file of the menu cache, see cache.py: each write bumps the counter, and
+a process publishes its own bump together with its events. A stream
+polls the counter every FEED_POLL_INTERVAL seconds, and if it moved past
+the writes this process published, the feed publishes a reset event, so
+the subscribers reload the menu instead of silently missing the write.
+
+"""
+
+import asyncio
+import collections
+import os
+import threading
+import time
+
+from .cache import menu_cache
+
+# Number of events kept for subscribers catching up
+CHANGE_FEED_SIZE = 1024
+
+# Seconds between heartbeat comments on an idle stream
+HEARTBEAT_INTERVAL = 15
+
+# Seconds between checks of a waiting stream for other processes' writes
+FEED_POLL_INTERVAL = 1.0
+
+# Milliseconds a disconnected EventSource waits before reconnecting
+RECONNECT_DELAY = 3000
+
+
+# ----------------------------------------------------------------------------#
+#  Class ChangeFeed
+# ----------------------------------------------------------------------------#
+
+class ChangeFeed:
+
+    '''
+    ChangeFeed
+    In-process publisher of drink change events
+    '''
+
+    def __init__(self, maxsize=CHANGE_FEED_SIZE):
+        self.maxsize = maxsize
+        self.epoch = os.urandom(4).hex()
+        self.seq = 0
+        self.generation = None
+        self._events = collections.deque(maxlen=maxsize)
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._loops = {}
+
+    def publish(self, changes, invalidate=None):
+        '''
+        publish(changes, invalidate=None)
+            Publishes a list of (event, drink_id, short_json, long_json)
+            changes, in commit order. For a deleted drink both JSON
+            fragments are None. invalidate, if given, is called first,
+            under the feed lock, and returns the shared generation of the
+            write as MenuCache.invalidate() does, so a stream catching up
+            never takes this process's own write for another's.
+
+            EXAMPLE::
+
+                change_feed.publish([('updated', drink.id,
+                                      drink.short_json(),
+                                      drink.long_json())],
+                                    menu_cache.invalidate)
+
+        '''
+
+        with self._lock:
+            published = self.seq
+            generation = invalidate() if invalidate is not None else None
+            if generation is not None:
+
+                # A gap before this write's generation holds writes by
+                # other processes
+
+                if self._behind(generation, 1):
+                    self._append('reset', None)
+                self.generation = generation
+            for event, drink_id, short, long in changes:
+                if short is None:
+                    short = long = '{"id":%d}' % drink_id
+                self._append(event, short, long)
+        if self.seq != published:
+            self._notify()
+
+    def catch_up(self):
+        '''
+        catch_up()
+            Publishes a reset event if another process has written the
+            drinks since this one last published or looked. A read of the
+            generation file, called by the waiting streams.
+        '''
+
+        shared = menu_cache.shared
+        if shared is None:
+            return
+        generation = shared.read()
+        if generation == self.generation:
+            return
+        with self._lock:
+
+            # Read again under the lock, after any publish in progress
+
+            generation = shared.read()
+            reset = self._behind(generation, 0)
+            if reset:
+                self._append('reset', None)
+            self.generation = generation
+        if reset:
+            self._notify()
+
+    def _behind(self, generation, own):
+
+        # True if generation is more than own writes past the last one
+        # accounted for. The first look starts the count
+
+        if self.generation is None:
+            return False
+        epoch, count = generation
+        return epoch != self.generation[0] or \
+            count > self.generation[1] + own
+
+    def _append(self, event, short, long=None):
+        self.seq += 1
+        if short is None:
+            short = long = '{}'
+        self._events.append((
+            self.seq,
+            self._message(self.seq, event, short),
+            self._message(self.seq, event, long)))
+
+    def _notify(self):
+        with self._lock:
+            self._changed.notify_all()
+            loops = list(self._loops)
+        for loop in loops:
+            try:
+                loop.call_soon_threadsafe(self._wake, loop)
+            except RuntimeError:
+                with self._lock:
+                    self._loops.pop(loop, None)
+
+    def last_event_id(self, seq=None):
+        '''
+        last_event_id(seq=None)
+            Returns the SSE event id of seq, by default the latest event.
+        '''
+
+        return '%s-%d' % (self.epoch, self.seq if seq is None else seq)
+
+    def position(self, last_event_id):
+        '''
+        position(last_event_id)
+            Returns the seq a stream resumes after, given the Last-Event-ID
+            the client sent. Returns None if the id was issued by another
+            process or can't be parsed, in which case the client missed an
+            unknown number of events.
+        '''
+
+        self.catch_up()
+        if not last_event_id:
+            return self.seq
+        epoch, _, seq = last_event_id.partition('-')
+        if epoch != self.epoch or not seq.isdigit() or int(seq) > self.seq:
+            return None
+        return int(seq)
+
+    def since(self, seq, form):
+        '''
+        since(seq, form)
+            Returns the encoded messages of the events after seq, in the
+            'short' or 'long' form, and the seq of the last one. Returns a
+            reset message instead if events after seq have already left
+            the ring.
+        '''
+
+        with self._lock:
+            latest = self.seq
+            if seq is None or (seq < latest and
+                               self._events[0][0] > seq + 1):
+                return self._message(latest, 'reset', '{}'), latest
+            index = 1 if form == 'short' else 2
+            count = latest - seq
+            messages = [self._events[-i][index] for i in range(count, 0, -1)]
+        return ''.join(messages), latest
+
+    def wait(self, seq, timeout):
+        '''
+        wait(seq, timeout)
+            Blocks the calling thread until an event after seq is
+            published or timeout seconds pass, catching up with the other
+            processes every FEED_POLL_INTERVAL seconds.
+        '''
+
+        deadline = time.monotonic() + timeout
+        while True:
+            self.catch_up()
+            with self._changed:
+                remaining = deadline - time.monotonic()
+                if self.seq > seq or remaining <= 0:
+                    return
+                self._changed.wait_for(lambda: self.seq > seq,
+                                       min(remaining, FEED_POLL_INTERVAL))
+
+    async def wait_async(self, seq, timeout):
+        '''
+        wait_async(seq, timeout)
+            The asyncio counterpart of wait(). Every subscriber on an
+            event loop shares one asyncio.Event.
+        '''
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            self.catch_up()
+            with self._lock:
+                remaining = deadline - loop.time()
+                if self.seq > seq or remaining <= 0:
+                    return
+                waiter = self._loops.get(loop)
+                if waiter is None:
+                    waiter = self._loops[loop] = asyncio.Event()
+            try:
+                await asyncio.wait_for(waiter.wait(),
+                                       min(remaining, FEED_POLL_INTERVAL))
+            except asyncio.TimeoutError:
+                pass
+
+    def _wake(self, loop):
+        with self._lock:
+            waiter = self._loops.pop(loop, None)
+        if waiter is not None:
+            waiter.set()
+
+    def _message(self, seq, event, data):
+        return 'id: %s\nevent: %s\ndata: %s\n\n' % (
+            self.last_event_id(seq), event, data)
+
+
+change_feed = ChangeFeed()
+
+
+def heartbeat():
+    '''
+    heartbeat()
+        Returns the SSE comment sent on an idle stream, which keeps
+        proxies from closing the connection.
+    '''
+
+    return ': heartbeat\n\n'
+
+
+def stream_preamble():
+    '''
+    stream_preamble()
+        Returns the first message of a stream, setting the reconnect
+        delay of the EventSource.
+    '''
+
+    return 'retry: %d\n\n' % RECONNECT_DELAY
@@ -1,24 +1,57 @@
 """
 **Introduction**
 
-The Coffee shop app includes uses a single Alchemy classes to manage Drinks.
+The Coffee shop app uses two Alchemy classes to manage Drinks.
 
 - Drink Class : a persistent drink entity, extends the base SQLAlchemy Model.
+- Ingredient Class : one ingredient of a drink's recipe.
 
 The drink class has the following attributes:
 
 - id: The auto-generated record ID
 - title: The name of the drink, unique
-- List of ingredients, as an json object like
+- recipe: List of ingredients, read and written as a list like
   [{'color': string, 'name':string, 'parts':number}]
+  and stored as Ingredient rows
+- short_recipe_json, long_recipe_json: The short and long form recipe,
+  encoded as JSON when the drink is inserted or updated, so drink lists
+  are assembled without re-reading or re-encoding the ingredients
+- version: The change version of the drink's last write
+
+The ingredient class has the following attributes:
+
+- drink_id: The drink the ingredient belongs to
+- position: The place of the ingredient in the recipe
+- name, color, parts: The ingredient itself. Ingredient names are indexed
+  case-insensitively, so drinks can be looked up by ingredient.
+
+A deleted drink leaves a DrinkTombstone, so clients can sync the changes
+since a version they already have. See changes_since().
+
+Drink titles and ingredient names are indexed for search in drink_search,
+an SQLite FTS5 table kept up to date by triggers. See Drink.matching().
 
 """
 
+import contextlib
+import fcntl
 import os
-from sqlalchemy import Column, String, Integer
+import re
+from sqlalchemy import Column, String, Integer, Float, ForeignKey, Index, \
+    Text, and_, create_engine, event, exc, false, func, inspect, or_, \
+    select, text
+from sqlalchemy.orm import Session, lazyload, relationship, \
+    scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 import json
 
+from .cache import menu_cache
+from .feed import change_feed
+from ..serializer import Fragment, dumps_text
+from ..settings import config_defaults, database_file
+
 database_filename = 'database.db'
 project_dir = os.path.dirname(os.path.abspath(__file__))
 database_path = 'sqlite:///{}'.format(os.path.join(project_dir,
@@ -26,23 +59,518 @@ database_path = 'sqlite:///{}'.format(os.path.join(project_dir,
 
 db = SQLAlchemy()
 
+# ----------------------------------------------------------------------------#
+#  Engine settings
+#
+#  Applied by settings.config_defaults(), see there for the order.
+#
+#     DATABASE_URL: the database URI
+#     DB_READ_URL: URI of the read-only engine used by GET routes,
+#                  defaults to DATABASE_URL
+#     DB_POOL_SIZE, DB_MAX_OVERFLOW: connection pool of the write engine.
+#                  With no pool size SQLite opens a connection per checkout
+#     DB_READ_POOL_SIZE, DB_READ_MAX_OVERFLOW: pool of the read engine
+#     SQLITE_JOURNAL_MODE: e.g. WAL, so readers don't block on the writer
+#     SQLITE_SYNCHRONOUS: OFF, NORMAL, FULL or EXTRA
+#     SQLITE_BUSY_TIMEOUT: milliseconds to wait on a locked database
+#     SQLITE_MMAP_SIZE: bytes of the database file to memory map
+# ----------------------------------------------------------------------------#
+
+DB_DEFAULTS = {
+    'DATABASE_URL': database_path,
+    'DB_READ_URL': None,
+    'DB_POOL_SIZE': None,
+    'DB_MAX_OVERFLOW': 10,
+    'DB_READ_POOL_SIZE': None,
+    'DB_READ_MAX_OVERFLOW': 10,
+    'SQLITE_JOURNAL_MODE': 'WAL',
+    'SQLITE_SYNCHRONOUS': 'NORMAL',
+    'SQLITE_BUSY_TIMEOUT': 5000,
+    'SQLITE_MMAP_SIZE': 0,
+}
+
+SQLITE_JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL',
+                        'OFF')
+SQLITE_SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+read_engine = None
+'''The engine used by read_query(), created by setup_db().'''
+
+read_session = scoped_session(sessionmaker())
+'''Session of the read-only engine, removed at the end of each request.'''
+
 
 def setup_db(app):
-    app.config['SQLALCHEMY_DATABASE_URI'] = database_path
+    global read_engine
+
+    config_defaults(app, DB_DEFAULTS)
+    config = app.config
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = config['DATABASE_URL']
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = _engine_options(
+        config['DATABASE_URL'], config['DB_POOL_SIZE'],
+        config['DB_MAX_OVERFLOW'], config['SQLITE_BUSY_TIMEOUT'])
     db.app = app
     db.init_app(app)
 
+    with app.app_context():
+        engine = db.engine
+        if engine.dialect.name == 'sqlite':
+            event.listen(engine, 'connect', sqlite_pragmas(config))
+
+        # An in-memory database only exists on its own connection, so it
+        # has to be read through the write engine.
+
+        read_url = config['DB_READ_URL'] or engine.url
+        if engine.dialect.name == 'sqlite' and \
+                engine.url.database in (None, '', ':memory:'):
+            read_engine = engine
+        else:
+            read_engine = create_engine(read_url, **_engine_options(
+                str(read_url), config['DB_READ_POOL_SIZE'],
+                config['DB_READ_MAX_OVERFLOW'],
+                config['SQLITE_BUSY_TIMEOUT']))
+            if read_engine.dialect.name == 'sqlite':
+                event.listen(read_engine, 'connect',
+                             sqlite_pragmas(config, read_only=True))
+
+    read_session.configure(bind=read_engine)
+
+    @app.teardown_appcontext
+    def remove_read_session(exception=None):
+        read_session.remove()
+
+
+def read_query(*entities):
+    '''
+    read_query(*entities)
+        Returns a query on the read-only engine. GET routes use it so a
+        burst of menu reads never waits for a write engine connection.
+
+        EXAMPLE::
+
+            drinks = read_query(Drink).order_by(Drink.id).all()
+
+    '''
+
+    return read_session.query(*entities)
+
+
+def _engine_options(url, pool_size, max_overflow, busy_timeout):
+    options = {}
+    if str(url).startswith('sqlite'):
+        options['connect_args'] = {'timeout': int(busy_timeout) / 1000.0}
+    if pool_size:
+        options['poolclass'] = QueuePool
+        options['pool_size'] = int(pool_size)
+        options['max_overflow'] = int(max_overflow)
+        if str(url).startswith('sqlite'):
+            options['connect_args']['check_same_thread'] = False
+    return options
+
+
+def sqlite_pragmas(config, read_only=False):
+    '''
+    sqlite_pragmas(config, read_only=False)
+        Returns a connect event listener applying the SQLITE_* settings
+        of config to each new SQLite connection.
+    '''
+
+    journal_mode = str(config['SQLITE_JOURNAL_MODE']).upper()
+    synchronous = str(config['SQLITE_SYNCHRONOUS']).upper()
+    if journal_mode not in SQLITE_JOURNAL_MODES:
+        raise ValueError('SQLITE_JOURNAL_MODE must be one of %s'
+                         % ', '.join(SQLITE_JOURNAL_MODES))
+    if synchronous not in SQLITE_SYNCHRONOUS_LEVELS:
+        raise ValueError('SQLITE_SYNCHRONOUS must be one of %s'
+                         % ', '.join(SQLITE_SYNCHRONOUS_LEVELS))
+    busy_timeout = int(config['SQLITE_BUSY_TIMEOUT'])
+    mmap_size = int(config['SQLITE_MMAP_SIZE'])
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not read_only:
+            cursor.execute('PRAGMA journal_mode=%s' % journal_mode)
+        cursor.execute('PRAGMA synchronous=%s' % synchronous)
+        cursor.execute('PRAGMA busy_timeout=%d' % busy_timeout)
+        if mmap_size:
+            cursor.execute('PRAGMA mmap_size=%d' % mmap_size)
+        if read_only:
+            cursor.execute('PRAGMA query_only=ON')
+        cursor.close()
+
+    return on_connect
+
+
+def release_connections():
+    '''
+    release_connections()
+        Closes the pooled connections of both engines, so a process
+        forked after startup opens its own.
+    '''
+
+    if db.engine.url.database in (None, '', ':memory:'):
+        return
+    db.engine.dispose()
+    if read_engine is not None and read_engine is not db.engine:
+        read_engine.dispose()
+
+
+# ----------------------------------------------------------------------------#
+#  Schema version
+#
+#  The schema_version table records the SCHEMA_VERSION the database was
+#  last brought up to. db_create_all() only does DDL when that is out of
+#  date, running the MIGRATIONS for each version in between. A database
+#  from before the table existed is version 0.
+#
+#     0: recipe stored as a JSON blob in drink.recipe
+#     1: recipe stored as Ingredient rows, with materialized recipe JSON
+#     2: drink.version change versions, sync_state and drink_tombstone
+#     3: drink_search full-text index of titles and ingredient names
+#
+#  A migration only uses the tables as they were at its version, so any
+#  older database can be brought up to date. Workers starting together
+#  take a lock file first and read the version again under it, so only
+#  the first one migrates.
+# ----------------------------------------------------------------------------#
+
+SCHEMA_VERSION = 3
+
+
+class SchemaVersion(db.Model):
+
+    '''
+    SchemaVersion
+    The schema version the database was last created or migrated to
+    '''
+
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
+
+
+def db_schema_version():
+    '''
+    db_schema_version()
+        Returns the schema version of the database, 0 for a database that
+        predates versioning, or None for an empty database.
+    '''
+
+    tables = inspect(db.engine).get_table_names()
+    if 'schema_version' in tables:
+        return db.session.query(func.max(SchemaVersion.version)).scalar()
+    if 'drink' in tables:
+        return 0
+    return None
+
+
+def db_create_all():
+    '''
+    db_create_all()
+        Creates or migrates the schema to SCHEMA_VERSION without dropping
+        data. When the schema is already current this is one query, so it
+        is safe to call on every startup.
+
+        Returns True if any DDL was run.
+    '''
+
+    if db_schema_version() == SCHEMA_VERSION:
+        return False
+
+    with _migration_lock():
+
+        # Another worker may have migrated while this one waited
+
+        db.session.rollback()
+        current = db_schema_version()
+        if current == SCHEMA_VERSION:
+            return False
+
+        if current is not None:
+            for version in range(current + 1, SCHEMA_VERSION + 1):
+                MIGRATIONS[version]()
+        db.create_all()
+        _stamp_schema_version()
+    return True
+
+
+@contextlib.contextmanager
+def _migration_lock():
+
+    # An exclusive lock on a file named after the database, held by the
+    # processes of this host while they check and migrate the schema
+
+    path = database_file(db.engine.url, 'migrate')
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
 
 def db_drop_and_create_all():
     db.drop_all()
     db.create_all()
+    _stamp_schema_version()
+
+
+def _stamp_schema_version():
+    db.session.query(SchemaVersion).delete()
+    db.session.add(SchemaVersion(version=SCHEMA_VERSION))
+    if db.session.query(SyncState).get(1) is None:
+        latest = db.session.query(func.max(Drink.version)).scalar()
+        db.session.add(SyncState(id=1, version=latest or 0,
+                                 pruned_version=0))
+    db.session.commit()
+
+
+def _migrate_recipe_blobs():
+
+    # Version 0 to 1: move each drink.recipe JSON blob into Ingredient rows.
+    # The recipes are encoded by drinks that are never added to the session
+
+    with db.engine.begin() as connection:
+        rows = connection.execute(text('SELECT id, recipe FROM drink')) \
+            .fetchall()
+
+        # Every recipe is read before the table is changed, so a recipe
+        # that can't be read stops the migration with no data lost
+
+        drinks = []
+        unreadable = []
+        for drink_id, recipe in rows:
+            try:
+                drink = Drink(title=None, recipe=json.loads(recipe))
+            except (TypeError, ValueError, KeyError):
+                current_app.logger.error(
+                    'schema migration 1: can\'t read the recipe of drink '
+                    '%d: %r', drink_id, recipe)
+                unreadable.append(drink_id)
+                continue
+            drink.materialize()
+            drinks.append((drink_id, drink))
+        if unreadable:
+            raise RuntimeError(
+                'Schema migration 1 stopped: the recipes of drinks %s '
+                'can\'t be read. Fix or delete them and start again.'
+                % ', '.join(str(drink_id) for drink_id in unreadable))
+
+        connection.execute(text('ALTER TABLE drink DROP COLUMN recipe'))
+        connection.execute(
+            text('ALTER TABLE drink ADD COLUMN short_recipe_json TEXT'))
+        connection.execute(
+            text('ALTER TABLE drink ADD COLUMN long_recipe_json TEXT'))
+        Ingredient.__table__.create(connection, checkfirst=True)
+
+        for drink_id, drink in drinks:
+            connection.execute(
+                text('UPDATE drink SET short_recipe_json = :short, '
+                     'long_recipe_json = :long WHERE id = :id'),
+                {'short': drink.short_recipe_json,
+                 'long': drink.long_recipe_json, 'id': drink_id})
+            if drink.ingredients:
+                connection.execute(Ingredient.__table__.insert(), [
+                    {'drink_id': drink_id, 'position': i.position,
+                     'name': i.name, 'color': i.color, 'parts': i.parts}
+                    for i in drink.ingredients])
+
+
+def _migrate_drink_versions():
+
+    # Version 1 to 2: number the existing drinks in id order
+
+    with db.engine.begin() as connection:
+        connection.execute(text('ALTER TABLE drink ADD COLUMN version '
+                                'INTEGER NOT NULL DEFAULT 0'))
+        connection.execute(text('UPDATE drink SET version = id'))
+        for index in Drink.__table__.indexes:
+            if 'version' in index.columns:
+                index.create(connection)
+
+
+def _migrate_drink_search():
+
+    # Version 2 to 3: index the titles and ingredient names of the drinks
+
+    with db.engine.begin() as connection:
+        if connection.dialect.name == 'sqlite':
+            _create_drink_search(Drink.__table__, connection)
+            _create_ingredient_search(Ingredient.__table__, connection)
+            rebuild_search(connection)
+
+
+MIGRATIONS = {
+    1: _migrate_recipe_blobs,
+    2: _migrate_drink_versions,
+    3: _migrate_drink_search,
+}
+
+
+# ----------------------------------------------------------------------------#
+#  Change versions
+#
+#  Every drink write takes the next value of one counter, the sync_state
+#  row, as the drink's version, and a delete leaves a DrinkTombstone with a
+#  version of its own. Taking a version writes the counter row, which is
+#  locked until the transaction ends, so versions are handed out in commit
+#  order: a client that has seen version N has seen every change up to N.
+#  Versions are assigned at flush, so every write through the ORM gets one.
+# ----------------------------------------------------------------------------#
+
+class SyncState(db.Model):
+
+    '''
+    SyncState
+    The single row holding the latest change version
+    '''
+
+    __tablename__ = 'sync_state'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    version = Column(Integer, nullable=False)
+    '''The version of the latest drink write.'''
+
+    pruned_version = Column(Integer, nullable=False)
+    '''Tombstones up to this version have been pruned.'''
+
+
+class DrinkTombstone(db.Model):
+
+    '''
+    DrinkTombstone
+    The id of a deleted drink, at the version of the delete
+    '''
+
+    __tablename__ = 'drink_tombstone'
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    drink_id = Column(Integer, nullable=False)
+
+
+def take_versions(connection, count):
+    '''
+    take_versions(connection, count)
+        Reserves count change versions in the transaction of connection.
+        Returns the version before the first one reserved.
+    '''
+
+    state = SyncState.__table__
+    connection.execute(state.update().where(state.c.id == 1)
+                       .values(version=state.c.version + count))
+    latest = connection.execute(select(state.c.version)
+                                .where(state.c.id == 1)).scalar()
+    return latest - count
+
+
+@event.listens_for(Session, 'before_flush')
+def _assign_versions(session, flush_context, instances):
+    changed = [o for o in session.new if isinstance(o, Drink)]
+    changed += [o for o in session.dirty
+                if isinstance(o, Drink) and session.is_modified(o)]
+    deleted = [o for o in session.deleted if isinstance(o, Drink)]
+    if not changed and not deleted:
+        return
+
+    version = take_versions(session.connection(), len(changed) + len(deleted))
+    for drink in changed:
+        version += 1
+        drink.version = version
+    for drink in deleted:
+        version += 1
+        session.add(DrinkTombstone(version=version, drink_id=drink.id))
+
+
+def changes_since(since, limit=None):
+    '''
+    changes_since(since, limit=None)
+        Returns the drinks written and the ids of the drinks deleted after
+        version since, read through the version indexes, so the cost
+        follows the number of changes rather than the size of the menu.
+
+        With a limit, at most limit changes are returned, oldest first.
+
+        Returns::
+
+            {'drinks': [Drink], 'deleted': [id],
+             'version': the version to sync from next,
+             'more': True if changes past version remain,
+             'reset': True if since is older than the pruned tombstones,
+                      in which case every drink is returned and the
+                      client should drop the drinks it holds}
+    '''
+
+    # Read the counter first: every change up to it is already committed
+
+    state = read_query(SyncState).get(1)
+    current = state.version
+    reset = since < state.pruned_version
+    if reset:
+        since = 0
+
+    drinks = read_query(Drink).options(lazyload(Drink.ingredients)) \
+        .filter(Drink.version > since, Drink.version <= current) \
+        .order_by(Drink.version)
+    tombstones = read_query(DrinkTombstone) \
+        .filter(DrinkTombstone.version > since,
+                DrinkTombstone.version <= current) \
+        .order_by(DrinkTombstone.version)
+    if limit is not None:
+        drinks = drinks.limit(limit + 1)
+        tombstones = tombstones.limit(limit + 1)
+
+    # Nothing needs deleting for a client that starts from scratch
+
+    changes = [(d.version, d) for d in drinks]
+    if since > 0:
+        changes += [(t.version, t) for t in tombstones]
+    changes.sort(key=lambda change: change[0])
+
+    more = limit is not None and len(changes) > limit
+    if more:
+        changes = changes[:limit]
+        current = changes[-1][0]
+
+    return {'drinks': [c for _, c in changes if isinstance(c, Drink)],
+            'deleted': [c.drink_id for _, c in changes
+                        if isinstance(c, DrinkTombstone)],
+            'version': current, 'more': more, 'reset': reset}
+
+
+def prune_tombstones(keep):
+    '''
+    prune_tombstones(keep)
+        Deletes every tombstone but the latest keep. A client that last
+        synced before the pruned versions gets the whole menu again.
+
+        Returns the number of tombstones deleted.
+    '''
+
+    oldest_kept = DrinkTombstone.query \
+        .order_by(DrinkTombstone.version.desc()).offset(keep).first()
+    if oldest_kept is None:
+        return 0
+    count = DrinkTombstone.query \
+        .filter(DrinkTombstone.version <= oldest_kept.version) \
+        .delete(synchronize_session=False)
+    state = SyncState.query.get(1)
+    state.pruned_version = max(state.pruned_version, oldest_kept.version)
+    db.session.commit()
+    return count
 
 
 # ----------------------------------------------------------------------------#
 #  Class Drink
 # ----------------------------------------------------------------------------#
 
+# The fields of a drink that can be selected, and those of short() and
+# long(), the default
+DRINK_FIELDS = ('id', 'recipe', 'title', 'version')
+DEFAULT_FIELDS = ('id', 'recipe', 'title')
+
+
 class Drink(db.Model):
 
     '''
@@ -66,16 +594,62 @@ class Drink(db.Model):
     The title (name) of the drink
     '''
 
-    recipe = Column(String(180), nullable=False)
+    ingredients = relationship('Ingredient', order_by='Ingredient.position',
+                               cascade='all, delete-orphan', lazy='joined')
+    '''
+    ingredients, list of Ingredient
+    The recipe, in order. Loaded with the drink through an eager join.
+    '''
+
+    short_recipe_json = Column(Text)
+    '''
+    short_recipe_json, Text
+    The short form recipe as a JSON array. Written by insert() and update()
+    '''
+
+    long_recipe_json = Column(Text)
     '''
-    recipe, string(160)
-    The ingredients blob - this stores a lazy json blob
-    The required datatype is [{'color': string, 'name':string, 'parts':number}]
+    long_recipe_json, Text
+    The long form recipe as a JSON array. Written by insert() and update()
+    '''
+
+    version = Column(Integer, nullable=False, default=0, index=True)
+    '''
+    version, Integer
+    The change version of the drink's last write. Assigned at flush
     '''
 
     def __init__(self, title, recipe):
         self.title = title
-        self.recipe = json.dumps(recipe)
+        self.recipe = recipe
+
+    @property
+    def recipe(self):
+        '''
+        recipe
+            The ingredients as a list like
+            [{'color': string, 'name':string, 'parts':number}].
+            Assigning a list replaces every ingredient of the drink.
+        '''
+
+        return [i.long() for i in self.ingredients]
+
+    @recipe.setter
+    def recipe(self, recipe):
+        if not isinstance(recipe, list):
+            raise ValueError('recipe must be a list of ingredients')
+
+        # Checked here rather than left to the NOT NULL constraints, whose
+        # IntegrityError would read as a duplicate title in a batch
+
+        for r in recipe:
+            if not isinstance(r['name'], str) or \
+                    not isinstance(r['color'], str) or r['parts'] is None:
+                raise ValueError('an ingredient needs a name, a color and '
+                                 'parts')
+        self.ingredients = [Ingredient(position=position, name=r['name'],
+                                       color=r['color'], parts=r['parts'])
+                            for position, r in enumerate(recipe)]
 
     def short(self):
         '''
@@ -87,18 +661,13 @@ class Drink(db.Model):
                 { 'id': self.id,
                   'title': self.title,
                   'recipe': [{'color': string,
-                             'name':string,
                              'parts':number
                             }]
                 }
         '''
 
-        # print(json.loads(self.recipe))
-
-        short_recipe = [{'color': r['color'], 'parts': r['parts']}
-                        for r in json.loads(self.recipe)]
         return {'id': self.id, 'title': self.title,
-                'recipe': short_recipe}
+                'recipe': [i.short() for i in self.ingredients]}
 
     def long(self):
         '''
@@ -115,7 +684,141 @@ class Drink(db.Model):
         '''
 
         return {'id': self.id, 'title': self.title,
-                'recipe': json.loads(self.recipe)}
+                'recipe': self.recipe}
+
+    def short_json(self):
+        '''
+        short_json()
+            short() encoded as JSON, built from the stored recipe JSON.
+        '''
+
+        return _drink_json(self.id, self.title, self.recipe_json('short'))
+
+    def long_json(self):
+        '''
+        long_json()
+            long() encoded as JSON, built from the stored recipe JSON.
+        '''
+
+        return _drink_json(self.id, self.title, self.recipe_json('long'))
+
+    def recipe_json(self, form):
+        '''
+        recipe_json(form)
+            The 'short' or 'long' form recipe as a JSON array: the stored
+            recipe JSON, or encoded from the ingredients when there is
+            none.
+        '''
+
+        if form == 'short':
+            recipe = self.short_recipe_json
+            if recipe is None:
+                recipe = _dumps([i.short() for i in self.ingredients])
+            return recipe
+        recipe = self.long_recipe_json
+        if recipe is None:
+            recipe = _dumps(self.recipe)
+        return recipe
+
+    @classmethod
+    def projection(cls, form, fields=DEFAULT_FIELDS):
+        '''
+        projection(form, fields=DEFAULT_FIELDS)
+            The columns to select for the fields of the 'short' or 'long'
+            form of a drink, labelled with the field names. id is always
+            selected, as the lists page by it. Select them instead of Drink
+            to read rows without loading drinks; projected_json() encodes
+            a row.
+
+            EXAMPLE::
+
+                rows = read_query(*Drink.projection('short', ('title',)))
+
+        '''
+
+        columns = [cls.id.label('id')]
+        if 'recipe' in fields:
+            recipe = cls.short_recipe_json if form == 'short' \
+                else cls.long_recipe_json
+            columns.append(recipe.label('recipe'))
+        if 'title' in fields:
+            columns.append(cls.title.label('title'))
+        if 'version' in fields:
+            columns.append(cls.version.label('version'))
+        return columns
+
+    def materialize(self):
+        '''
+        materialize()
+            Encodes the short and long form recipe from the ingredients.
+            Called by insert() and update() before they commit.
+        '''
+
+        self.short_recipe_json = _dumps([i.short() for i in self.ingredients])
+        self.long_recipe_json = _dumps(self.recipe)
+
+    @classmethod
+    def with_ingredient(cls, name, query=None):
+        '''
+        with_ingredient(name, query=None)
+            Filters query, by default Drink.query, to the drinks using an
+            ingredient, matched case-insensitively through the ingredient
+            name index.
+
+            EXAMPLE::
+
+                drinks = Drink.with_ingredient('oat milk').all()
+
+        '''
+
+        query = cls.query if query is None else query
+        return query.filter(cls.uses_ingredient(name))
+
+    @classmethod
+    def matching(cls, q, dialect='sqlite'):
+        '''
+        matching(q, dialect='sqlite')
+            The filter condition for drinks matching the search text q:
+            each word of q must start a word of the title or of an
+            ingredient name, in any case. Text with no words matches no
+            drink. On SQLite this is a lookup in the drink_search index;
+            other databases scan the tables.
+
+            EXAMPLE::
+
+                query = Drink.query.filter(Drink.matching('oat lat'))
+
+        '''
+
+        words = re.findall(r'\w+', q.lower())
+        if not words:
+            return false()
+        if dialect == 'sqlite':
+            match = ' '.join('"%s"*' % word for word in words)
+            return cls.id.in_(
+                text('SELECT rowid FROM drink_search '
+                     'WHERE drink_search MATCH :match')
+                .bindparams(match=match).columns(rowid=Integer))
+
+        conditions = []
+        for word in words:
+            pattern = '%' + word + '%'
+            conditions.append(or_(
+                cls.title.ilike(pattern),
+                cls.id.in_(select(Ingredient.drink_id)
+                           .where(Ingredient.name.ilike(pattern)))))
+        return and_(*conditions)
+
+    @classmethod
+    def uses_ingredient(cls, name):
+        '''
+        uses_ingredient(name)
+            The filter condition behind with_ingredient(), for building
+            queries outside of a Flask-SQLAlchemy session.
+        '''
+
+        return cls.id.in_(select(Ingredient.drink_id).where(
+            func.lower(Ingredient.name) == name.lower()))
 
     def insert(self):
         '''
@@ -130,8 +833,12 @@ class Drink(db.Model):
 
         '''
 
+        self.materialize()
         db.session.add(self)
+        db.session.flush()
+        change = self.change('created')
         db.session.commit()
+        drinks_changed([change])
 
     def delete(self):
         '''
@@ -146,8 +853,10 @@ class Drink(db.Model):
 
         '''
 
+        change = ('deleted', self.id, None, None)
         db.session.delete(self)
         db.session.commit()
+        drinks_changed([change])
 
     def update(self):
         '''
@@ -163,7 +872,609 @@ class Drink(db.Model):
 
         '''
 
+        self.materialize()
+        change = self.change('updated')
         db.session.commit()
+        drinks_changed([change])
+
+    def change(self, event):
+        '''
+        change(event)
+            Returns the change feed entry of this drink for event,
+            'created' or 'updated'. The drink must be flushed.
+        '''
+
+        return (event, self.id, self.short_json(), self.long_json())
+
+    # ------------------------------------------------------------------------#
+    #  Conditional writes
+    #
+    #  A PATCH or DELETE of one drink is a single UPDATE or DELETE of the
+    #  drink row, conditioned on its id and, when the client sent any, on
+    #  the versions it expects the drink to be at. Nothing is read first,
+    #  so no other write can slip in between the check and the write. Only
+    #  a write that matched no row looks the drink up, to tell a missing
+    #  drink (404) from one at another version (412).
+    #
+    #  SQLAlchemy 1.4 can't compile RETURNING for SQLite, so an update that
+    #  leaves the title or the recipe as it is reads the row back, in the
+    #  same transaction and after the write has locked it.
+    # ------------------------------------------------------------------------#
+
+    @classmethod
+    def update_where(cls, session, drink_id, title=None, recipe=None,
+                     versions=None):
+        '''
+        update_where(session, drink_id, title=None, recipe=None,
+                     versions=None)
+            Sets the title and/or recipe of a drink with one conditional
+            UPDATE, in the transaction of session. versions, when not None,
+            lists the versions the drink may be at, e.g. from If-Match.
+            Works on a sync Session, so the async app runs it with
+            AsyncSession.run_sync(). The caller commits when a change is
+            returned, and rolls back otherwise.
+
+            EXAMPLE::
+
+                result, change = Drink.update_where(db.session, 1,
+                                                    title='Tea',
+                                                    versions=[12])
+
+            Returns (result, change), the change feed entry or None::
+
+                ({'success': True, 'drinks': Fragment(long json),
+                  'version': new version}, change)
+                ({'success': False, 'error': 412, 'message': string},
+                 None)
+        '''
+
+        values = {}
+        if title is not None:
+            if not isinstance(title, str):
+                return _item_error(422, 'Invalid drink.'), None
+            values['title'] = title
+        if recipe is not None:
+            try:
+                drink = cls(title=None, recipe=recipe)
+                drink.materialize()
+            except (LookupError, TypeError, ValueError):
+                return _item_error(422, 'Invalid drink.'), None
+            values['short_recipe_json'] = drink.short_recipe_json
+            values['long_recipe_json'] = drink.long_recipe_json
+
+        connection = session.connection()
+        table = cls.__table__
+        values['version'] = take_versions(connection, 1) + 1
+        try:
+            updated = connection.execute(
+                table.update().where(cls._condition(drink_id, versions))
+                .values(**values)).rowcount
+        except exc.IntegrityError:
+            return _item_error(409, 'Duplicate title.'), None
+        if not updated:
+            return cls._missed(connection, drink_id), None
+
+        # An ingredient the database refuses, e.g. one without parts or
+        # with a name that isn't text, makes the drink invalid
+
+        if recipe is not None:
+            ingredients = Ingredient.__table__
+            connection.execute(ingredients.delete()
+                               .where(ingredients.c.drink_id == drink_id))
+            try:
+                if drink.ingredients:
+                    connection.execute(ingredients.insert(), [
+                        {'drink_id': drink_id, 'position': i.position,
+                         'name': i.name, 'color': i.color,
+                         'parts': i.parts}
+                        for i in drink.ingredients])
+            except exc.SQLAlchemyError:
+                return _item_error(422, 'Invalid drink.'), None
+
+        if title is None or recipe is None:
+            row = connection.execute(
+                select(table.c.title, table.c.short_recipe_json,
+                       table.c.long_recipe_json)
+                .where(table.c.id == drink_id)).one()
+            values = dict(row._mapping, **values)
+            if values['long_recipe_json'] is None:
+                drink = session.get(cls, drink_id)
+                values['short_recipe_json'] = drink.recipe_json('short')
+                values['long_recipe_json'] = drink.recipe_json('long')
+
+        long_json = _drink_json(drink_id, values['title'],
+                                values['long_recipe_json'])
+        change = ('updated', drink_id,
+                  _drink_json(drink_id, values['title'],
+                              values['short_recipe_json']), long_json)
+        return ({'success': True, 'drinks': Fragment(long_json),
+                 'version': values['version']}, change)
+
+    @classmethod
+    def delete_where(cls, session, drink_id, versions=None):
+        '''
+        delete_where(session, drink_id, versions=None)
+            Deletes a drink with one conditional DELETE, in the
+            transaction of session, leaving a tombstone. versions is as
+            for update_where(). The caller commits when a change is
+            returned, and rolls back otherwise.
+
+            Returns (result, change), the change feed entry or None::
+
+                ({'success': True, 'deleted': drink_id}, change)
+                ({'success': False, 'error': 404, 'message': string},
+                 None)
+        '''
+
+        connection = session.connection()
+        version = take_versions(connection, 1) + 1
+        deleted = connection.execute(
+            cls.__table__.delete().where(cls._condition(drink_id, versions))
+        ).rowcount
+        if not deleted:
+            return cls._missed(connection, drink_id), None
+
+        ingredients = Ingredient.__table__
+        connection.execute(ingredients.delete()
+                           .where(ingredients.c.drink_id == drink_id))
+        connection.execute(DrinkTombstone.__table__.insert()
+                           .values(version=version, drink_id=drink_id))
+        return ({'success': True, 'deleted': drink_id},
+                ('deleted', drink_id, None, None))
+
+    @classmethod
+    def _condition(cls, drink_id, versions):
+        table = cls.__table__
+        condition = table.c.id == drink_id
+        if versions is not None:
+            condition = and_(condition, table.c.version.in_(versions))
+        return condition
+
+    @classmethod
+    def _missed(cls, connection, drink_id):
+
+        # The error of a conditional write that matched no row
+
+        table = cls.__table__
+        if connection.execute(select(table.c.id)
+                              .where(table.c.id == drink_id)).first():
+            return _item_error(412, 'Drink has changed.')
+        return _item_error(404, 'Drink not found.')
+
+    # ------------------------------------------------------------------------#
+    #  Batch writes
+    #
+    #  Each batch runs in a single transaction with a single commit. The
+    #  ORM flushes the batch's INSERTs and UPDATEs together, and deletes are
+    #  one DELETE ... WHERE id IN statement per table. Every item gets its
+    #  own result; if the combined flush fails, the items are retried one
+    #  SAVEPOINT at a time so only the failing items are rejected.
+    # ------------------------------------------------------------------------#
+
+    @classmethod
+    def insert_many(cls, items):
+        '''
+        insert_many(items)
+            Inserts a list of drinks in one transaction.
+
+            EXAMPLE::
+
+                results = Drink.insert_many([
+                    {'title': 'Water', 'recipe': [{'name': 'Water',
+                                                   'color': 'blue',
+                                                   'parts': 1}]}])
+
+            Returns one result per item, in order::
+
+                {'success': True, 'drinks': Fragment(drink.long_json())}
+                {'success': False, 'error': 409, 'message': string}
+        '''
+
+        results = [None] * len(items)
+        operations = []
+        titles = set()
+        for index, item in enumerate(items):
+            try:
+                title = item['title']
+                recipe = item['recipe']
+                if title is not None and not isinstance(title, str):
+                    raise ValueError('title must be a string')
+                cls(title=title, recipe=recipe)
+            except Exception:
+                results[index] = _item_error(422, 'Invalid drink.')
+                continue
+            if title is not None and title in titles:
+                results[index] = _item_error(409, 'Duplicate title.')
+                continue
+            titles.add(title)
+            operations.append((index, title, recipe))
+
+        existing = set()
+        if titles:
+            existing = {t for (t,) in db.session.query(cls.title)
+                        .filter(cls.title.in_(titles))}
+
+        def adder(title, recipe):
+            def add():
+                drink = cls(title=title, recipe=recipe)
+                drink.materialize()
+                db.session.add(drink)
+                return drink
+            return add
+
+        pending = []
+        for index, title, recipe in operations:
+            if title in existing:
+                results[index] = _item_error(409, 'Duplicate title.')
+            else:
+                pending.append((index, adder(title, recipe)))
+
+        _apply_batch(pending, results, 'created')
+        return results
+
+    @classmethod
+    def update_many(cls, items):
+        '''
+        update_many(items)
+            Updates a list of drinks in one transaction. Each item holds
+            the drink id and the title and/or recipe to set. An item for
+            a drink already updated by the batch gets a 409.
+
+            EXAMPLE::
+
+                results = Drink.update_many([{'id': 1, 'title': 'Tea'}])
+
+            Returns one result per item, in order, like insert_many().
+        '''
+
+        results = [None] * len(items)
+        operations = []
+        for index, item in enumerate(items):
+            try:
+                drink_id = item['id']
+                title = item.get('title')
+                recipe = item.get('recipe')
+                if not isinstance(drink_id, int) or \
+                        isinstance(drink_id, bool):
+                    raise ValueError('id must be an integer')
+                if title is not None and not isinstance(title, str):
+                    raise ValueError('title must be a string')
+                if recipe is not None and not isinstance(recipe, list):
+                    raise ValueError('recipe must be a list')
+            except Exception:
+                results[index] = _item_error(422, 'Invalid drink.')
+                continue
+            operations.append((index, drink_id, title, recipe))
+
+        ids = {drink_id for _, drink_id, _, _ in operations}
+        drinks = {d.id: d for d in cls.query.filter(cls.id.in_(ids))} \
+            if ids else {}
+
+        def updater(drink, title, recipe):
+            def update():
+                if title is not None:
+                    drink.title = title
+                if recipe is not None:
+                    drink.recipe = recipe
+                drink.materialize()
+                return drink
+            return update
+
+        # A drink is changed once per batch, so each result holds the
+        # drink as that item left it
+
+        pending = []
+        updating = set()
+        for index, drink_id, title, recipe in operations:
+            drink = drinks.get(drink_id)
+            if drink is None:
+                results[index] = _item_error(404, 'Drink not found.')
+                continue
+            if drink_id in updating:
+                results[index] = _item_error(409, 'Duplicate drink id.')
+                continue
+            updating.add(drink_id)
+            pending.append((index, updater(drink, title, recipe)))
+
+        _apply_batch(pending, results, 'updated')
+        return results
+
+    @classmethod
+    def delete_many(cls, ids):
+        '''
+        delete_many(ids)
+            Deletes a list of drinks by id in one transaction.
+
+            EXAMPLE::
+
+                results = Drink.delete_many([1, 2, 3])
+
+            Returns one result per id, in order::
+
+                {'success': True, 'deleted': id}
+                {'success': False, 'error': 404, 'message': string}
+        '''
+
+        found = set()
+        if ids:
+            found = {i for (i,) in db.session.query(cls.id)
+                     .filter(cls.id.in_(ids))}
+        if found:
+            deleted = [i for i in dict.fromkeys(ids) if i in found]
+            version = take_versions(db.session.connection(), len(deleted))
+            Ingredient.query.filter(Ingredient.drink_id.in_(found)) \
+                .delete(synchronize_session=False)
+            cls.query.filter(cls.id.in_(found)) \
+                .delete(synchronize_session=False)
+            db.session.add_all(
+                DrinkTombstone(version=version + n, drink_id=i)
+                for n, i in enumerate(deleted, 1))
+            db.session.commit()
+            db.session.expire_all()
+            drinks_changed([('deleted', i, None, None) for i in deleted])
+
+        return [{'success': True, 'deleted': i} if i in found
+                else _item_error(404, 'Drink not found.') for i in ids]
 
     def __repr__(self):
         return json.dumps(self.short())
+
+
+def _item_error(error, message):
+    return {'success': False, 'error': error, 'message': message}
+
+
+def drinks_changed(changes):
+    '''
+    drinks_changed(changes)
+        Invalidates the menu cache and publishes changes, a list of
+        Drink.change() entries, to the change feed. Called after every
+        committed drink write.
+    '''
+
+    change_feed.publish(changes, menu_cache.invalidate)
+
+
+def _apply_batch(pending, results, event):
+    '''
+    _apply_batch(pending, results, event)
+        Runs the (index, operation) pairs of a batch and commits them.
+        Each operation adds or changes one drink and returns it, and is
+        published to the change feed as event.
+    '''
+
+    drinks = {}
+    try:
+        with db.session.begin_nested():
+            for index, operation in pending:
+                drinks[index] = operation()
+    except (exc.SQLAlchemyError, LookupError, TypeError, ValueError):
+
+        # Retry one item per savepoint to find the items that fail
+
+        # The savepoint flushes as it ends, so an item only counts once
+        # its block has been left without an error
+
+        drinks = {}
+        for index, operation in pending:
+            try:
+                with db.session.begin_nested():
+                    drink = operation()
+            except exc.IntegrityError:
+                results[index] = _item_error(409, 'Duplicate title.')
+            except (exc.SQLAlchemyError, LookupError, TypeError, ValueError):
+                results[index] = _item_error(422, 'Invalid drink.')
+            else:
+                drinks[index] = drink
+
+    changes = []
+    for index, drink in sorted(drinks.items()):
+        results[index] = {'success': True,
+                          'drinks': Fragment(drink.long_json())}
+        changes.append(drink.change(event))
+    db.session.commit()
+    if drinks:
+        drinks_changed(changes)
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':'), sort_keys=True)
+
+
+def projected_json(row, fields, recipe=None):
+    '''
+    projected_json(row, fields, recipe=None)
+        Encodes the fields of a row selected with Drink.projection() as a
+        JSON object. recipe stands in for the recipe JSON of a row stored
+        without one; see Drink.recipe_json().
+
+        EXAMPLE::
+
+            projected_json(row, ('id', 'title'))
+            '{"id":1,"title":"Latte"}'
+
+    '''
+
+    members = []
+    if 'id' in fields:
+        members.append('"id":%d' % row.id)
+    if 'recipe' in fields:
+        members.append('"recipe":%s' % (recipe or row.recipe))
+    if 'title' in fields:
+        members.append('"title":%s' % dumps_text(row.title))
+    if 'version' in fields:
+        members.append('"version":%d' % row.version)
+    return '{%s}' % ','.join(members)
+
+
+def _drink_json(drink_id, title, recipe_json):
+    return '{"id":%d,"recipe":%s,"title":%s}' % (drink_id, recipe_json,
+                                                 dumps_text(title))
+
+
+def backfill_materialized(batch_size=500):
+    '''
+    backfill_materialized(batch_size=500)
+        Writes short_recipe_json and long_recipe_json for every drink
+        that has none, batch_size drinks per commit.
+
+        Returns the number of drinks updated.
+    '''
+
+    count = 0
+    while True:
+        drinks = Drink.query.filter(Drink.long_recipe_json.is_(None)) \
+            .order_by(Drink.id).limit(batch_size).all()
+        if not drinks:
+            break
+        for drink in drinks:
+            drink.materialize()
+        db.session.commit()
+        count += len(drinks)
+    if count:
+        menu_cache.invalidate()
+    return count
+
+
+# ----------------------------------------------------------------------------#
+#  Class Ingredient
+# ----------------------------------------------------------------------------#
+
+class Ingredient(db.Model):
+
+    '''
+    Ingredient
+    One ingredient of a drink recipe, extends the base SQLAlchemy Model
+    '''
+
+    id = Column(Integer, primary_key=True)
+    '''*id* is the auto assigned primary key.'''
+
+    drink_id = Column(Integer, ForeignKey('drink.id', ondelete='CASCADE'),
+                      nullable=False)
+    '''
+    drink_id, Integer
+    The drink this ingredient belongs to
+    '''
+
+    position = Column(Integer, nullable=False)
+    '''
+    position, Integer
+    Zero based place of the ingredient in the recipe
+    '''
+
+    name = Column(String(80), nullable=False)
+    color = Column(String(40), nullable=False)
+    parts = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index('ix_ingredient_drink_position', 'drink_id', 'position'),
+        Index('ix_ingredient_name', func.lower(name)),
+    )
+
+    def short(self):
+        return {'color': self.color, 'parts': _number(self.parts)}
+
+    def long(self):
+        return {'color': self.color, 'name': self.name,
+                'parts': _number(self.parts)}
+
+
+def _number(value):
+    # parts is stored as a float; whole numbers go back out as ints
+
+    if value is not None and float(value).is_integer():
+        return int(value)
+    return value
+
+
+# ----------------------------------------------------------------------------#
+#  Search index
+#
+#  drink_search is an SQLite FTS5 table holding, for each drink, its title
+#  and its ingredient names under the drink id as rowid. Triggers on drink
+#  and ingredient keep it up to date, so every writer, bulk statements and
+#  the async engine included, updates the index in the same transaction.
+#  Prefixes of 2 and 3 characters are indexed too, for search as you type.
+# ----------------------------------------------------------------------------#
+
+DRINK_SEARCH_DDL = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS drink_search
+       USING fts5(title, ingredients,
+                  tokenize = 'unicode61 remove_diacritics 2',
+                  prefix = '2 3')""",
+    """CREATE TRIGGER IF NOT EXISTS drink_search_insert
+       AFTER INSERT ON drink BEGIN
+           INSERT INTO drink_search (rowid, title, ingredients)
+           VALUES (new.id, new.title, coalesce(
+               (SELECT group_concat(name, ' ') FROM ingredient
+                WHERE drink_id = new.id), ''));
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS drink_search_title
+       AFTER UPDATE OF title ON drink BEGIN
+           UPDATE drink_search SET title = new.title WHERE rowid = new.id;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS drink_search_delete
+       AFTER DELETE ON drink BEGIN
+           DELETE FROM drink_search WHERE rowid = old.id;
+       END""",
+)
+
+# The ingredient names of a drink, for the triggers on ingredient
+_INGREDIENT_NAMES = """UPDATE drink_search SET ingredients = coalesce(
+               (SELECT group_concat(name, ' ') FROM ingredient
+                WHERE drink_id = %(row)s.drink_id), '')
+           WHERE rowid = %(row)s.drink_id;"""
+
+INGREDIENT_SEARCH_DDL = (
+    """CREATE TRIGGER IF NOT EXISTS ingredient_search_insert
+       AFTER INSERT ON ingredient BEGIN
+           %s
+       END""" % (_INGREDIENT_NAMES % {'row': 'new'}),
+    """CREATE TRIGGER IF NOT EXISTS ingredient_search_update
+       AFTER UPDATE OF name, drink_id ON ingredient BEGIN
+           %s
+           %s
+       END""" % (_INGREDIENT_NAMES % {'row': 'old'},
+                 _INGREDIENT_NAMES % {'row': 'new'}),
+    """CREATE TRIGGER IF NOT EXISTS ingredient_search_delete
+       AFTER DELETE ON ingredient BEGIN
+           %s
+       END""" % (_INGREDIENT_NAMES % {'row': 'old'}),
+)
+
+
+@event.listens_for(Drink.__table__, 'after_create')
+def _create_drink_search(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        for statement in DRINK_SEARCH_DDL:
+            connection.execute(text(statement))
+
+
+@event.listens_for(Ingredient.__table__, 'after_create')
+def _create_ingredient_search(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text(DRINK_SEARCH_DDL[0]))
+        for statement in INGREDIENT_SEARCH_DDL:
+            connection.execute(text(statement))
+
+
+@event.listens_for(Drink.__table__, 'before_drop')
+def _drop_drink_search(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text('DROP TABLE IF EXISTS drink_search'))
+
+
+def rebuild_search(connection):
+    '''
+    rebuild_search(connection)
+        Fills drink_search again from the drink and ingredient tables.
+    '''
+
+    connection.execute(text('DELETE FROM drink_search'))
+    connection.execute(text(
+        """INSERT INTO drink_search (rowid, title, ingredients)
+           SELECT id, title, coalesce(
+               (SELECT group_concat(name, ' ') FROM ingredient
+                WHERE drink_id = drink.id), '')
+           FROM drink"""))
@@ -0,0 +1,216 @@
+"""
+**Introduction**
+----------------
+The drink list responses of GET /drinks and GET /drinks-detail, shared by
+the WSGI app in api.py and the asyncio app in asgi.py. Each app runs the
+queries and sends the response; everything in between is here:
+
+- list_key(...) : the menu cache key of a drink list request
+- list_select(...), recipes_select(ids) : the queries of a page
+- page_rows(rows, limit), page_body(...) : paging the rows and encoding
+  the response body
+- lookup, save, encode, set_headers : the menu cache, ETag and 304
+  handling of a drink list response
+
+An app's cached_menu() looks the response up, answers a 304 or builds the
+body on a miss, then encodes it::
+
+    tag, body, version = menu.lookup(key, request.if_none_match, store)
+    if tag is None:
+        if body is None:
+            body = menu.save(key, build(), version, store)
+        body, encoding, tag = menu.encode(key, body, version,
+                                          request.accept_encodings,
+                                          current_app.config)
+
+"""
+
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+
+from . import compression, serializer
+from .database.cache import menu_cache
+from .database.models import Drink, projected_json
+from .serializer import Fragment
+
+
+# ----------------------------------------------------------------------------#
+#  Drink list bodies
+# ----------------------------------------------------------------------------#
+
+def list_key(form, fields, limit, after, ingredient, q):
+    '''
+    list_key(form, fields, limit, after, ingredient, q)
+        Returns the menu cache key of a drink list in the 'short' or
+        'long' form, paged, filtered and narrowed to fields as requested.
+
+        EXAMPLE::
+
+            list_key('short', ('id', 'title'), 20, None, None, None)
+            'short:20:None:None:None:id,title'
+
+    '''
+
+    return '%s:%s:%s:%s:%s:%s' % (form, limit, after, ingredient, q,
+                                  ','.join(fields))
+
+
+def list_select(form, fields, limit, after, ingredient, q, dialect):
+    '''
+    list_select(form, fields, limit, after, ingredient, q, dialect)
+        Returns the query of a page of a drink list: the columns behind
+        fields of the drinks using ingredient and matching the search
+        text q when given, after the cursor after, by keyset on Drink.id.
+        One row past limit is read to tell whether a next page exists;
+        see page_rows(). dialect is the name of the database dialect.
+    '''
+
+    query = select(*Drink.projection(form, fields))
+    if ingredient is not None:
+        query = query.where(Drink.uses_ingredient(ingredient))
+    if q is not None:
+        query = query.where(Drink.matching(q, dialect))
+    if after is not None:
+        query = query.where(Drink.id > after)
+    query = query.order_by(Drink.id)
+    if limit is not None:
+        query = query.limit(limit + 1)
+    return query
+
+
+def recipes_select(ids):
+    '''
+    recipes_select(ids)
+        Returns the query of the drinks of ids with their ingredients, for
+        the rows of a page written without stored recipe JSON; see
+        recipes_missing().
+    '''
+
+    return select(Drink).where(Drink.id.in_(ids)) \
+        .options(selectinload(Drink.ingredients))
+
+
+def recipes_missing(rows, fields):
+    '''
+    recipes_missing(rows, fields)
+        Returns the ids of the rows that need their recipe built from
+        their ingredients.
+    '''
+
+    if 'recipe' not in fields:
+        return []
+    return [row.id for row in rows if row.recipe is None]
+
+
+def page_rows(rows, limit):
+    '''
+    page_rows(rows, limit)
+        Returns (rows, next) for the rows of list_select(), where next is
+        the cursor to pass as after for the following page, or None on
+        the last page.
+    '''
+
+    if limit is not None and len(rows) > limit:
+        return rows[:limit], rows[limit - 1].id
+    return rows, None
+
+
+def page_body(rows, fields, recipes, limit, next_after):
+    '''
+    page_body(rows, fields, recipes, limit, next_after)
+        Returns the response body of a page of rows, with the recipe JSON
+        of each drink id in recipes standing in for a missing one. A paged
+        list gets the "next" cursor.
+    '''
+
+    fragments = [projected_json(row, fields, recipes.get(row.id))
+                 for row in rows]
+    if limit is not None:
+        return list_body(fragments, {'next': next_after})
+    return list_body(fragments)
+
+
+def list_body(fragments, extra=None):
+    '''
+    list_body(fragments, extra=None)
+        Assembles a drink list response body from drinks already encoded
+        as JSON, adding the extra keys of the response.
+
+        Returns::
+
+            b'{"drinks":[fragments],<extra>,"success":true}\\n'
+    '''
+
+    body = dict(extra or {}, success=True,
+                drinks=Fragment('[' + ','.join(fragments) + ']'))
+    return serializer.dumps(body) + b'\n'
+
+
+# ----------------------------------------------------------------------------#
+#  Menu cache and ETags
+# ----------------------------------------------------------------------------#
+
+def lookup(key, if_none_match, store=True):
+    '''
+    lookup(key, if_none_match, store=True)
+        Looks up the drink list response of key. Writes by other worker
+        processes are picked up first, see MenuCache.sync(). Returns
+        (tag, body, version):
+
+        - tag is the ETag to answer with a 304 if if_none_match holds
+          the current one, else None
+        - body is the cached body, or None if it must be built, always
+          with store False
+        - version is the menu version of body, or the one to build at
+    '''
+
+    menu_cache.sync()
+    version = menu_cache.version
+    tag = compression.matching_etag(if_none_match,
+                                    menu_cache.etag(key, version))
+    if tag is not None:
+        return tag, None, version
+    entry = menu_cache.get(key) if store else None
+    if entry is None:
+        return None, None, version
+    body, version = entry
+    return None, body, version
+
+
+def save(key, body, version, store=True):
+    '''
+    save(key, body, version, store=True)
+        Stores a body built at version in the menu cache if store, and
+        returns it.
+    '''
+
+    if store:
+        menu_cache.set(key, body, version)
+    return body
+
+
+def encode(key, body, version, accept_encodings, config):
+    '''
+    encode(key, body, version, accept_encodings, config)
+        Returns (body, encoding, tag): body compressed as negotiated, see
+        compression.cached_variant(), the encoding or None, and the ETag
+        of that variant.
+    '''
+
+    body, encoding = compression.cached_variant(
+        key, body, version, accept_encodings, config)
+    return body, encoding, compression.etag(menu_cache.etag(key, version),
+                                            encoding)
+
+
+def set_headers(response, tag, private=False):
+    '''
+    set_headers(response, tag, private=False)
+        Sets the ETag and caching headers of a drink list response, or of
+        its 304. A private list may only be cached by the client.
+    '''
+
+    response.set_etag(tag)
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = \
+        'private, no-cache' if private else 'no-cache'
@@ -0,0 +1,275 @@
+"""
+**Introduction**
+----------------
+Prometheus metrics of the drinks API, served at GET /metrics:
+
+- request count and latency per method, route and status
+- response size per route
+- SQL statements and SQL time per request, and the time of each statement
+- JWT verification time
+- token cache and menu cache lookups by result, and JWKS fetches
+- requests refused by the rate limiter, by budget
+
+The metrics are kept by prometheus_client, which is optional. Without it
+every metric is a no-op and /metrics answers 404.
+
+Each sample costs a histogram bucket increment, so the metrics can stay
+on in production. With several worker processes, point
+PROMETHEUS_MULTIPROC_DIR at an empty directory before the server starts.
+Each worker then writes its samples to memory-mapped files there, and
+/metrics adds up the files of every worker, whichever worker answers the
+scrape.
+
+"""
+
+import contextvars
+import os
+import time
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5,
+                   5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class _NoMetric:
+
+    '''
+    _NoMetric
+    Stands in for every metric when prometheus_client isn't installed
+    '''
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def time(self):
+        return _no_timer
+
+
+class _NoTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_no_timer = _NoTimer()
+
+
+def _metric(kind, name, documentation, labels=(), **kwargs):
+    if prometheus_client is None:
+        return _NoMetric()
+    return getattr(prometheus_client, kind)(name, documentation, labels,
+                                            **kwargs)
+
+
+REQUEST_SECONDS = _metric(
+    'Histogram', 'coffee_http_request_duration_seconds',
+    'Time to answer a request, up to the response headers.',
+    ['method', 'route', 'status'], buckets=LATENCY_BUCKETS)
+
+RESPONSE_BYTES = _metric(
+    'Histogram', 'coffee_http_response_size_bytes',
+    'Size of response bodies of known length.',
+    ['route'], buckets=SIZE_BUCKETS)
+
+REQUEST_QUERIES = _metric(
+    'Histogram', 'coffee_db_queries_per_request',
+    'SQL statements run by a request.',
+    ['route'], buckets=QUERY_COUNT_BUCKETS)
+
+REQUEST_QUERY_SECONDS = _metric(
+    'Histogram', 'coffee_db_seconds_per_request',
+    'Time a request spent running SQL statements.',
+    ['route'], buckets=LATENCY_BUCKETS)
+
+QUERY_SECONDS = _metric(
+    'Histogram', 'coffee_db_query_duration_seconds',
+    'Time to run one SQL statement.', buckets=LATENCY_BUCKETS)
+
+JWT_VERIFY_SECONDS = _metric(
+    'Histogram', 'coffee_jwt_verify_duration_seconds',
+    'Time to verify a JWT that missed the token cache.',
+    buckets=LATENCY_BUCKETS)
+
+CACHE_LOOKUPS = _metric(
+    'Counter', 'coffee_cache_lookups',
+    'Lookups of the token and menu caches, by result.',
+    ['cache', 'result'])
+
+JWKS_FETCHES = _metric(
+    'Counter', 'coffee_jwks_fetches',
+    'Loads of the JWKS key set, by result.', ['result'])
+
+RATE_LIMITED = _metric(
+    'Counter', 'coffee_rate_limited',
+    'Requests refused with a 429 by the rate limiter, by budget.',
+    ['budget'])
+
+TOKEN_CACHE_HITS = CACHE_LOOKUPS.labels('token', 'hit')
+TOKEN_CACHE_MISSES = CACHE_LOOKUPS.labels('token', 'miss')
+MENU_CACHE_HITS = CACHE_LOOKUPS.labels('menu', 'hit')
+MENU_CACHE_MISSES = CACHE_LOOKUPS.labels('menu', 'miss')
+
+
+# ----------------------------------------------------------------------------#
+#  Per request collection
+#
+#  start_request() opens a tally of the SQL statements run until
+#  finish_request() records the request. The tally is held in a context
+#  variable, so it follows the request in threaded and asyncio servers.
+# ----------------------------------------------------------------------------#
+
+_request = contextvars.ContextVar('metrics_request', default=None)
+
+
+def enabled():
+    return prometheus_client is not None
+
+
+def start_request():
+    '''
+    start_request()
+        Marks the start of a request. Called before the request is
+        dispatched.
+    '''
+
+    _request.set([time.perf_counter(), 0, 0.0])
+
+
+def finish_request(method, route, status, size):
+    '''
+    finish_request(method, route, status, size)
+        Records a request with its route rule, e.g. /drinks/<int:drink_id>,
+        its response status and its body size, None if not known.
+    '''
+
+    tally = _request.get()
+    if tally is None:
+        return
+    _request.set(None)
+    started, queries, query_seconds = tally
+
+    REQUEST_SECONDS.labels(method, route, status) \
+        .observe(time.perf_counter() - started)
+    REQUEST_QUERIES.labels(route).observe(queries)
+    REQUEST_QUERY_SECONDS.labels(route).observe(query_seconds)
+    if size is not None:
+        RESPONSE_BYTES.labels(route).observe(size)
+
+
+# ----------------------------------------------------------------------------#
+#  SQL statement timing
+#
+#  One pair of cursor listeners on every Engine times each statement. The
+#  time is recorded here and passed on to the hooks added with
+#  on_statement(), such as the request trace of profiling.py, so every
+#  statement is timed once whoever reads the time. The start time is kept
+#  on the statement's execution context, so a statement that fails, and
+#  never reaches after_cursor_execute, leaves nothing behind.
+# ----------------------------------------------------------------------------#
+
+_statement_hooks = []
+
+
+def on_statement(hook):
+    '''
+    on_statement(hook)
+        Calls hook(statement, seconds) after every SQL statement, timing
+        the statements from now on if nothing did yet.
+
+        EXAMPLE::
+
+            metrics.on_statement(lambda statement, seconds: print(seconds))
+
+    '''
+
+    if hook not in _statement_hooks:
+        _statement_hooks.append(hook)
+    _time_statements()
+
+
+def _time_statements():
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if context is not None:
+        context.statement_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = getattr(context, 'statement_started', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    QUERY_SECONDS.observe(elapsed)
+    tally = _request.get()
+    if tally is not None:
+        tally[1] += 1
+        tally[2] += elapsed
+    for hook in _statement_hooks:
+        hook(statement, elapsed)
+
+
+def init_app(app):
+    '''
+    init_app(app)
+        Times the requests of a Flask app and the SQL statements of every
+        engine. Does nothing without prometheus_client.
+    '''
+
+    if not enabled():
+        return
+
+    _time_statements()
+
+    @app.before_request
+    def start_metrics():
+        start_request()
+
+    @app.after_request
+    def finish_metrics(response):
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        finish_request(request.method, route, response.status_code,
+                       response.calculate_content_length())
+        return response
+
+
+def exposition():
+    '''
+    exposition()
+        Returns the (body, content type) of a scrape, adding up the
+        samples of every worker process in multiprocess mode.
+    '''
+
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return (prometheus_client.generate_latest(registry),
+            prometheus_client.CONTENT_TYPE_LATEST)
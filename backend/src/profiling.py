@@ -0,0 +1,220 @@
+"""
+**Introduction**
+----------------
+Request profiling and the slow request log.
+
+- RequestTrace Class : the phase timings and SQL statements of a request
+- phase(name) : times a phase of the current request, e.g. 'auth'
+
+Every request is traced. A request that takes longer than SLOW_REQUEST_MS
+is logged as a warning with the time spent in each phase and the SQL
+statements it ran, slowest first. The phases are:
+
+- auth: token verification and the permission check
+- build: building a drink list on a menu cache miss, SQL included
+- sql: every SQL statement
+- total: up to the response headers
+
+Profiling is off unless PROFILE_SECRET is set. A request carrying the
+header X-Profile: <PROFILE_SECRET> is then run under cProfile, and its
+stats are written to PROFILE_DIR as a .pstats file named by the
+X-Profile-File response header. Read it with python -m pstats, or turn it
+into a flame graph with a pstats viewer such as snakeviz or flameprof.
+Streamed response bodies are not covered.
+
+"""
+
+import contextlib
+import contextvars
+import cProfile
+import hmac
+import itertools
+import os
+import re
+import tempfile
+import time
+
+from flask import current_app, request
+
+from . import metrics
+from .settings import config_defaults
+
+# ----------------------------------------------------------------------------#
+#  Settings
+#
+#  Applied by settings.config_defaults(), see there for the order.
+#
+#     SLOW_REQUEST_MS: log requests slower than this, 0 to turn off
+#     SLOW_REQUEST_STATEMENTS: most SQL statements kept per request
+#     PROFILE_SECRET: value of the X-Profile header that turns on
+#                     profiling for a request. Unset, nothing is profiled
+#     PROFILE_DIR: where .pstats files are written
+# ----------------------------------------------------------------------------#
+
+PROFILING_DEFAULTS = {
+    'SLOW_REQUEST_MS': 500,
+    'SLOW_REQUEST_STATEMENTS': 50,
+    'PROFILE_SECRET': None,
+    'PROFILE_DIR': os.path.join(tempfile.gettempdir(), 'coffee-profiles'),
+}
+
+# Characters of a SQL statement kept in the slow request log
+STATEMENT_LOG_LENGTH = 300
+
+_trace = contextvars.ContextVar('request_trace', default=None)
+_profile_numbers = itertools.count(1)
+
+
+# ----------------------------------------------------------------------------#
+#  Class RequestTrace
+# ----------------------------------------------------------------------------#
+
+class RequestTrace:
+
+    '''
+    RequestTrace
+    Phase timings and SQL statements of the current request
+    '''
+
+    def __init__(self, max_statements):
+        self.started = time.perf_counter()
+        self.max_statements = max_statements
+        self.phases = {}
+        self.statements = []
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.profiler = None
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def add_statement(self, statement, seconds):
+        self.sql_count += 1
+        self.sql_seconds += seconds
+        if len(self.statements) < self.max_statements:
+            self.statements.append((seconds, statement))
+
+    def report(self, method, path, status, total):
+        '''
+        report(method, path, status, total)
+            Returns the slow request log entry of a request that took
+            total seconds.
+
+            EXAMPLE::
+
+                slow request: GET /drinks-detail 200 in 812.4 ms
+                  auth 3.1 ms, build 790.2 ms, sql 780.1 ms in 2 statements
+                  780.0 ms  SELECT drink.id, drink.title, ...
+                    0.1 ms  SELECT ...
+
+        '''
+
+        phases = ['%s %.1f ms' % (name, seconds * 1000)
+                  for name, seconds in self.phases.items()]
+        phases.append('sql %.1f ms in %d statements' %
+                      (self.sql_seconds * 1000, self.sql_count))
+        lines = ['slow request: %s %s %s in %.1f ms' %
+                 (method, path, status, total * 1000),
+                 '  ' + ', '.join(phases)]
+        for seconds, statement in sorted(self.statements, reverse=True):
+            statement = ' '.join(statement.split())
+            lines.append('  %7.1f ms  %s' %
+                         (seconds * 1000, statement[:STATEMENT_LOG_LENGTH]))
+        return '\n'.join(lines)
+
+
+@contextlib.contextmanager
+def phase(name):
+    '''
+    phase(name)
+        Adds the time spent in the with block to the phase name of the
+        current request.
+
+        EXAMPLE::
+
+            with phase('auth'):
+                payload = verified_payload(token)
+
+    '''
+
+    trace = _trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_phase(name, time.perf_counter() - started)
+
+
+def _add_statement(statement, seconds):
+
+    # Timed by the statement listeners of metrics.py
+
+    trace = _trace.get()
+    if trace is not None:
+        trace.add_statement(statement, seconds)
+
+
+# ----------------------------------------------------------------------------#
+#  Flask hooks
+# ----------------------------------------------------------------------------#
+
+def init_app(app):
+    '''
+    init_app(app)
+        Traces every request of a Flask app, and profiles the requests
+        asking for it when PROFILE_SECRET is set.
+    '''
+
+    config_defaults(app, PROFILING_DEFAULTS)
+
+    metrics.on_statement(_add_statement)
+    app.before_request(start_trace)
+    app.after_request(finish_trace)
+
+
+def start_trace():
+    config = current_app.config
+    trace = RequestTrace(int(config['SLOW_REQUEST_STATEMENTS']))
+    _trace.set(trace)
+
+    secret = config['PROFILE_SECRET']
+    asked = request.headers.get('X-Profile')
+    if secret and asked and hmac.compare_digest(asked.encode('utf-8'),
+                                                secret.encode('utf-8')):
+        trace.profiler = cProfile.Profile()
+        trace.profiler.enable()
+
+
+def finish_trace(response):
+    trace = _trace.get()
+    if trace is None:
+        return response
+    _trace.set(None)
+    total = time.perf_counter() - trace.started
+
+    if trace.profiler is not None:
+        trace.profiler.disable()
+        response.headers['X-Profile-File'] = _dump_profile(trace.profiler)
+
+    threshold = float(current_app.config['SLOW_REQUEST_MS']) / 1000
+    if threshold > 0 and total > threshold:
+
+        # The path only: the query string may hold an access_token
+
+        current_app.logger.warning(trace.report(
+            request.method, request.path, response.status_code, total))
+    return response
+
+
+def _dump_profile(profiler):
+    directory = current_app.config['PROFILE_DIR']
+    os.makedirs(directory, exist_ok=True)
+    name = '%s-%d-%d-%s-%s.pstats' % (
+        time.strftime('%Y%m%d-%H%M%S'), os.getpid(), next(_profile_numbers),
+        request.method,
+        re.sub(r'[^A-Za-z0-9]+', '_', request.path).strip('_') or 'root')
+    profiler.dump_stats(os.path.join(directory, name))
+    return name
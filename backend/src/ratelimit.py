@@ -0,0 +1,250 @@
+"""
+**Introduction**
+----------------
+Token bucket rate limits shared by the worker processes of a server.
+
+- BucketStore Class : token buckets in a memory-mapped file
+- RateLimiter Class : the budgets, and the check that refuses a request
+
+Every budget refills at a steady rate up to a burst size. Each caller has
+its own bucket per budget. Routes that need a permission draw from the
+budget of that permission, keyed by the JWT sub. The public routes draw
+from the 'public' budget, keyed by client IP, when one is configured;
+behind a proxy, set TRUSTED_PROXIES so the IP is the client's rather
+than the proxy's. A request that finds its
+bucket empty is answered with a 429 and a Retry-After header. This happens
+right after the token is verified, before any database work.
+
+The buckets live in RATE_LIMIT_FILE, a small file every worker maps into
+memory, so the limits hold across the workers of a prefork server. Each
+bucket is a slot of a fixed-size hash table. Updates lock only the few
+slots a key may use, with fcntl record locks between processes and a
+thread lock within one. When every slot a key may use is taken, the slot
+that was used least recently is reused.
+
+"""
+
+import hashlib
+import struct
+import time
+
+from flask import abort
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from .metrics import RATE_LIMITED
+from .settings import config_defaults, database_file
+from .sharedfile import SharedFile
+
+# ----------------------------------------------------------------------------#
+#  Settings
+#
+#  Applied by settings.config_defaults(), see there for the order.
+#
+#     RATE_LIMITS: comma separated budget=rate/burst entries, e.g.
+#                  post:drinks=2/10 refills 2 requests a second up to a
+#                  burst of 10. A budget not listed is unlimited. 'off'
+#                  turns rate limiting off. The public budget is off
+#                  by default
+#     RATE_LIMIT_FILE: the file holding the buckets, shared by the workers.
+#                      By default one in the temp directory named after
+#                      DATABASE_URL
+#     RATE_LIMIT_SLOTS: buckets the file holds
+#     TRUSTED_PROXIES: proxies in front of the app whose X-Forwarded-For
+#                      is trusted for the client IP, 0 for none
+# ----------------------------------------------------------------------------#
+
+RATE_LIMIT_DEFAULTS = {
+    'RATE_LIMITS': 'get:drinks-detail=50/100,post:drinks=5/20,'
+                   'patch:drinks=5/20,delete:drinks=5/20',
+    'RATE_LIMIT_FILE': None,
+    'RATE_LIMIT_SLOTS': 65536,
+    'TRUSTED_PROXIES': 0,
+}
+
+# Budget of the routes open to everyone, keyed by client IP
+PUBLIC_BUDGET = 'public'
+
+# Slots a key may be stored in, starting at its hash
+PROBES = 8
+
+# File header: magic and slot count. Each slot: key hash, tokens, last use
+HEADER = struct.Struct('<8sQ')
+SLOT = struct.Struct('<Qdd')
+MAGIC = b'coffeerl'
+
+
+def parse_limits(spec):
+    '''
+    parse_limits(spec)
+        Returns the {budget: (rate, burst)} limits of a RATE_LIMITS value.
+        Raises a ValueError for a malformed entry.
+
+        EXAMPLE::
+
+            parse_limits('public=50/100,post:drinks=2/10')
+            {'public': (50.0, 100.0), 'post:drinks': (2.0, 10.0)}
+
+    '''
+
+    limits = {}
+    if spec.strip().lower() == 'off':
+        return limits
+    for entry in spec.split(','):
+        if not entry.strip():
+            continue
+        budget, _, value = entry.rpartition('=')
+        rate, _, burst = value.partition('/')
+        try:
+            rate, burst = float(rate), float(burst)
+        except ValueError:
+            raise ValueError('Bad RATE_LIMITS entry %r, expected '
+                             'budget=rate/burst' % entry)
+        if not budget.strip() or rate <= 0 or burst < 1:
+            raise ValueError('Bad RATE_LIMITS entry %r, expected '
+                             'budget=rate/burst' % entry)
+        limits[budget.strip()] = (rate, burst)
+    return limits
+
+
+# ----------------------------------------------------------------------------#
+#  Class BucketStore
+# ----------------------------------------------------------------------------#
+
+class BucketStore:
+
+    '''
+    BucketStore(path, slots)
+    Token buckets held in a memory-mapped file shared between processes
+    '''
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = max(int(slots), PROBES)
+        self.file = SharedFile(path, HEADER.pack(MAGIC, self.slots),
+                               HEADER.size + self.slots * SLOT.size)
+
+    def take(self, key, rate, burst, now=None):
+        '''
+        take(key, rate, burst, now=None)
+            Takes a token from the bucket of key, which refills rate
+            tokens a second up to burst. Returns 0 if a token was taken,
+            otherwise the seconds until the next one.
+        '''
+
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+        digest = int.from_bytes(digest, 'little') or 1
+        first = digest % (self.slots - PROBES + 1)
+        offset = HEADER.size + first * SLOT.size
+
+        with self.file.locked(PROBES * SLOT.size, offset) as data:
+
+            # Read the clock under the lock so the last use stored never
+            # goes back. A clock set back just stops the refill
+
+            if now is None:
+                now = time.time()
+            slot, tokens, stamp = self._find(data, offset, digest)
+            if stamp is None:
+                tokens = burst
+            else:
+                tokens = min(burst, tokens + max(0.0, now - stamp) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            SLOT.pack_into(data, slot, digest, tokens,
+                           max(now, stamp or 0.0))
+        return wait
+
+    def _find(self, data, offset, digest):
+
+        # The slot of digest, else a free slot, else the least recently
+        # used one. Returns (slot offset, tokens, last use or None)
+
+        free = None
+        oldest = None
+        for n in range(PROBES):
+            slot = offset + n * SLOT.size
+            key, tokens, stamp = SLOT.unpack_from(data, slot)
+            if key == digest:
+                return slot, tokens, stamp
+            if key == 0:
+                if free is None:
+                    free = slot
+            elif oldest is None or stamp < oldest[1]:
+                oldest = (slot, stamp)
+        return (free if free is not None else oldest[0]), 0.0, None
+
+
+# ----------------------------------------------------------------------------#
+#  Class RateLimiter
+# ----------------------------------------------------------------------------#
+
+class RateLimiter:
+
+    '''
+    RateLimiter
+    The budgets of the process, checked by requires_auth and the public
+    routes
+    '''
+
+    def __init__(self):
+        self.limits = {}
+        self.store = None
+
+    def configure(self, limits, path, slots):
+        '''
+        configure(limits, path, slots)
+            Sets the {budget: (rate, burst)} limits and the bucket file.
+        '''
+
+        self.limits = limits
+        if self.store is None or self.store.path != path or \
+                self.store.slots != max(int(slots), PROBES):
+            self.store = BucketStore(path, slots)
+
+    def check(self, budget, caller):
+        '''
+        check(budget, caller)
+            Takes a request of caller, a JWT sub or a client IP, from
+            budget. Aborts with a 429 when the caller's bucket is empty.
+
+            EXAMPLE::
+
+                limiter.check('post:drinks', payload['sub'])
+
+        '''
+
+        limit = self.limits.get(budget)
+        if limit is None:
+            return
+        wait = self.store.take('%s|%s' % (budget, caller), *limit)
+        if wait:
+            RATE_LIMITED.labels(budget).inc()
+            abort(429, 'Rate limit of %s exceeded.' % budget,
+                  retry_after=max(1, int(wait + 0.999)))
+
+
+limiter = RateLimiter()
+
+
+def init_app(app):
+    '''
+    init_app(app)
+        Applies the rate limit settings of a Flask app to the limiter,
+        and takes the client IP from X-Forwarded-For behind
+        TRUSTED_PROXIES proxies.
+    '''
+
+    config_defaults(app, RATE_LIMIT_DEFAULTS)
+
+    path = app.config['RATE_LIMIT_FILE']
+    if path is None:
+        path = database_file(app.config['DATABASE_URL'], 'ratelimit')
+    limiter.configure(parse_limits(app.config['RATE_LIMITS']), path,
+                      app.config['RATE_LIMIT_SLOTS'])
+
+    proxies = int(app.config['TRUSTED_PROXIES'])
+    if proxies:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies)
@@ -0,0 +1,222 @@
+"""
+**Introduction**
+----------------
+JSON encoding of the API responses.
+
+- Fragment Class : a value already encoded as JSON, written out as is
+- dumps(value) : value encoded as UTF-8 JSON bytes
+- JSONProvider Class : makes jsonify() encode with dumps()
+
+Responses are encoded with orjson when it is installed, otherwise with the
+json module of the standard library. Either way the output is compact with
+sorted keys. JSON_ENCODER picks the encoder: 'auto' (default), 'orjson' or
+'json'.
+
+A Fragment can stand anywhere a value can, so a drink whose JSON is stored
+with it is sent without being decoded and encoded again::
+
+    jsonify({'success': True, 'drinks': Fragment(drink.long_json())})
+
+"""
+
+import json
+
+from flask.json.provider import DefaultJSONProvider
+
+from .settings import config_defaults
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ----------------------------------------------------------------------------#
+#  Settings
+#
+#  Applied by settings.config_defaults(), see there for the order.
+#
+#     JSON_ENCODER: 'auto' for orjson when installed, else 'orjson' or 'json'
+# ----------------------------------------------------------------------------#
+
+SERIALIZER_DEFAULTS = {
+    'JSON_ENCODER': 'auto',
+}
+
+ENCODERS = ('orjson', 'json')
+
+
+# ----------------------------------------------------------------------------#
+#  Class Fragment
+# ----------------------------------------------------------------------------#
+
+class Fragment:
+
+    '''
+    Fragment(json)
+    A value already encoded as JSON text
+    '''
+
+    __slots__ = ('json',)
+
+    def __init__(self, json):
+        self.json = json
+
+    def __repr__(self):
+        return 'Fragment(%r)' % self.json
+
+
+# ----------------------------------------------------------------------------#
+#  Encoders
+#
+#  An encoder turns a value holding no Fragment into JSON text. dumps()
+#  walks the dicts and lists of a value, writing out each Fragment as is and
+#  handing every other value to the encoder. Responses are envelopes around
+#  fragments, so the walk is short. orjson 3.9 and later takes fragments
+#  itself and encodes the whole value in one call.
+# ----------------------------------------------------------------------------#
+
+def _stdlib_encoder(default):
+    return json.JSONEncoder(ensure_ascii=False, sort_keys=True,
+                            separators=(',', ':'), default=default).encode
+
+
+def _orjson_encoder(default):
+    options = orjson.OPT_SORT_KEYS
+
+    def encode(value):
+        return orjson.dumps(value, default=default, option=options) \
+            .decode('utf-8')
+
+    return encode
+
+
+def _walk(value, encode):
+    if isinstance(value, Fragment):
+        return value.json
+    if isinstance(value, dict):
+        return '{%s}' % ','.join(
+            '%s:%s' % (encode(key), _walk(item, encode))
+            for key, item in sorted(value.items()))
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ','.join(_walk(item, encode) for item in value)
+    return encode(value)
+
+
+def _no_default(value):
+    raise TypeError('Object of type %s is not JSON serializable' %
+                    type(value).__name__)
+
+
+_encoder = 'orjson' if orjson is not None else 'json'
+
+
+def use(name):
+    '''
+    use(name)
+        Encodes with name, 'orjson' or 'json', or 'auto' for orjson when
+        it is installed. Raises a ValueError for an unknown name or
+        orjson when it isn't installed.
+    '''
+
+    global _encoder
+
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name not in ENCODERS:
+        raise ValueError('JSON_ENCODER must be auto, orjson or json, '
+                         'not %r' % name)
+    if name == 'orjson' and orjson is None:
+        raise ValueError('JSON_ENCODER is orjson but orjson is not '
+                         'installed')
+    _encoder = name
+
+
+def encoder():
+    '''
+    encoder()
+        Returns the name of the encoder in use, 'orjson' or 'json'.
+    '''
+
+    return _encoder
+
+
+def dumps(value, default=_no_default):
+    '''
+    dumps(value, default=_no_default)
+        Returns value encoded as compact UTF-8 JSON bytes with sorted
+        keys. default is called for an object the encoder doesn't know,
+        and returns a value that can be encoded instead.
+
+        EXAMPLE::
+
+            dumps({'drinks': Fragment('[{"id":1}]'), 'success': True})
+            b'{"drinks":[{"id":1}],"success":true}'
+
+    '''
+
+    if _encoder == 'orjson':
+        if hasattr(orjson, 'Fragment'):
+            def fragments(value):
+                if isinstance(value, Fragment):
+                    return orjson.Fragment(value.json)
+                return default(value)
+
+            return orjson.dumps(value, default=fragments,
+                                option=orjson.OPT_SORT_KEYS)
+        encode = _orjson_encoder(default)
+    else:
+        encode = _stdlib_encoder(default)
+    return _walk(value, encode).encode('utf-8')
+
+
+def dumps_text(value):
+    '''
+    dumps_text(value)
+        Returns value, holding no Fragment, encoded as JSON text.
+    '''
+
+    if _encoder == 'orjson':
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS) \
+            .decode('utf-8')
+    return json.dumps(value, ensure_ascii=False, sort_keys=True,
+                      separators=(',', ':'))
+
+
+# ----------------------------------------------------------------------------#
+#  Class JSONProvider
+# ----------------------------------------------------------------------------#
+
+class JSONProvider(DefaultJSONProvider):
+
+    '''
+    JSONProvider(app)
+    The app.json of the Flask and Quart apps: jsonify(), request.get_json()
+    and the error handlers go through dumps() and the encoder in use
+    '''
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj, kwargs.get('default', self.default)) \
+            .decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if _encoder == 'orjson' and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj, self.default) + b'\n',
+                                        mimetype=self.mimetype)
+
+
+def init_app(app):
+    '''
+    init_app(app)
+        Encodes the JSON of a Flask or Quart app with the encoder named by
+        JSON_ENCODER. The encoder is shared by every app of the process.
+    '''
+
+    config_defaults(app, SERIALIZER_DEFAULTS)
+
+    use(app.config['JSON_ENCODER'])
+    app.json = JSONProvider(app)
@@ -0,0 +1,62 @@
+"""
+**Introduction**
+----------------
+Settings of the app and its modules.
+
+Each module lists its settings in a dict of defaults, e.g. DB_DEFAULTS,
+and applies it with config_defaults() when it is set up. A setting is
+taken from the app config, then the environment, then the default. An
+environment variable that is set always wins over the default, even when
+it is empty or 0, so a setting can be turned off from the environment.
+
+"""
+
+import hashlib
+import os
+import tempfile
+
+from sqlalchemy.engine import make_url
+
+
+def config_defaults(app, defaults):
+    '''
+    config_defaults(app, defaults)
+        Fills in each setting of defaults, a {name: default} dict, that the
+        config of app doesn't hold, from the environment or else the
+        default.
+
+        EXAMPLE::
+
+            config_defaults(app, {'GZIP_LEVEL': 6})
+            level = int(app.config['GZIP_LEVEL'])
+
+    '''
+
+    for key, default in defaults.items():
+        app.config.setdefault(key, os.environ.get(key, default))
+
+
+def database_file(url, name):
+    '''
+    database_file(url, name)
+        Returns the path of the file name in the temp directory kept for
+        the database at url, so that apps on one host share the file only
+        when they share the database. A relative SQLite path is made
+        absolute first.
+
+        EXAMPLE::
+
+            database_file('sqlite:///database.db', 'menu-generation')
+            '/tmp/coffee-menu-generation-5c1d9f0e2a7b4c83'
+
+    '''
+
+    url = make_url(str(url))
+    if url.get_backend_name() == 'sqlite' and url.database and \
+            url.database != ':memory:':
+        key = 'sqlite:' + os.path.abspath(url.database)
+    else:
+        key = str(url)
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8)
+    return os.path.join(tempfile.gettempdir(),
+                        'coffee-%s-%s' % (name, digest.hexdigest()))
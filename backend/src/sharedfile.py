@@ -0,0 +1,102 @@
+"""
+**Introduction**
+
+A small file that every worker process of a prefork server maps into
+memory, for state the workers share without a database query: the rate
+limit buckets and the menu generation counter.
+
+- SharedFile Class : the file and its memory map, mapped again in each
+  forked process
+
+The file starts with a header naming its layout. A file whose header
+doesn't match, e.g. one left by an older version or another setting, is
+cleared and written again when it is mapped.
+
+"""
+
+import contextlib
+import fcntl
+import mmap
+import os
+import threading
+
+_open_lock = threading.Lock()
+
+
+# ----------------------------------------------------------------------------#
+#  Class SharedFile
+# ----------------------------------------------------------------------------#
+
+class SharedFile:
+
+    '''
+    SharedFile(path, header, size, fill=None)
+    A file of size bytes starting with the bytes of header, shared between
+    processes through a memory map. fill, if given, returns the bytes
+    written after the header whenever the file is written afresh.
+    '''
+
+    def __init__(self, path, header, size, fill=None):
+        self.path = path
+        self.header = header
+        self.size = size
+        self.fill = fill
+        self._map = None
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def map(self):
+        '''
+        map()
+            Returns the memory map of the file, mapping it first in a new
+            or forked process.
+        '''
+
+        if self._pid != os.getpid():
+            with _open_lock:
+                if self._pid != os.getpid():
+                    self._map_file()
+        return self._map
+
+    @contextlib.contextmanager
+    def locked(self, length=0, offset=0):
+        '''
+        locked(length=0, offset=0)
+            Holds length bytes of the file from offset, or the whole file
+            for 0, against the other threads and processes, and yields the
+            memory map.
+
+            EXAMPLE::
+
+                with shared.locked(SLOT.size, offset) as data:
+                    SLOT.pack_into(data, offset, *slot)
+
+        '''
+
+        data = self.map()
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, offset)
+            try:
+                yield data
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, offset)
+
+    def _map_file(self):
+
+        # A forked worker maps the file again with a lock of its own
+
+        self._lock = threading.Lock()
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            if os.pread(fd, len(self.header), 0) != self.header:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+                body = self.fill() if self.fill is not None else b''
+                os.pwrite(fd, self.header + body, 0)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(fd, self.size)
+        self._fd = fd
+        self._pid = os.getpid()
@@ -0,0 +1,124 @@
+"""
+**Introduction**
+
+Fixtures of the backend tests: an app on a fresh SQLite database in a
+temp directory, a test client, and access tokens signed by a local key
+set, so no request leaves the machine.
+
+Run from the backend directory::
+
+    python -m pytest -q
+
+"""
+
+import base64
+import json
+import os
+import tempfile
+import time
+
+import pytest
+import rsa
+from jose import jwt
+
+from src.api import create_app
+
+# ----------------------------------------------------------------------------#
+#  Signing keys
+#
+#  One RSA key for the session, published as a local JWKS file that the
+#  apps of the tests trust through JWKS_PATH.
+# ----------------------------------------------------------------------------#
+
+KEY_ID = 'test-key'
+AUDIENCE = 'coffee-test'
+ISSUER = 'https://tests.invalid/'
+
+PERMISSIONS = ['get:drinks-detail', 'post:drinks', 'patch:drinks',
+               'delete:drinks']
+
+_public_key, _private_key = rsa.newkeys(1024)
+
+
+def _b64(number):
+    data = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+_keys_dir = tempfile.mkdtemp()
+with open(os.path.join(_keys_dir, 'keys.json'), 'w') as f:
+    json.dump({'keys': [{'kty': 'RSA', 'kid': KEY_ID, 'use': 'sig',
+                         'n': _b64(_public_key.n),
+                         'e': _b64(_public_key.e)}]}, f)
+
+AUTH_CONFIG = {'JWKS_PATH': _keys_dir, 'API_AUDIENCE': AUDIENCE,
+               'AUTH_ISSUER': ISSUER}
+
+
+def make_token(permissions=PERMISSIONS, subject='manager'):
+    '''
+    make_token(permissions=PERMISSIONS, subject='manager')
+        Returns an access token for subject holding permissions, valid
+        for ten minutes.
+    '''
+
+    claims = {'sub': subject, 'aud': AUDIENCE, 'iss': ISSUER,
+              'exp': int(time.time()) + 600, 'permissions': permissions}
+    return jwt.encode(claims, _private_key.save_pkcs1().decode('ascii'),
+                      algorithm='RS256', headers={'kid': KEY_ID})
+
+
+def bearer(permissions=PERMISSIONS, subject='manager'):
+    '''
+    bearer(permissions=PERMISSIONS, subject='manager')
+        Returns the Authorization header of make_token().
+    '''
+
+    return {'Authorization': 'Bearer ' + make_token(permissions, subject)}
+
+
+# ----------------------------------------------------------------------------#
+#  Fixtures
+# ----------------------------------------------------------------------------#
+
+@pytest.fixture
+def database_url(tmp_path):
+    return 'sqlite:///' + str(tmp_path / 'coffee.db')
+
+
+@pytest.fixture
+def config(database_url):
+    # Rate limiting has tests of its own
+    return dict(AUTH_CONFIG, DATABASE_URL=database_url, RATE_LIMITS='off')
+
+
+@pytest.fixture
+def app(config):
+    return create_app(config)
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def headers():
+    return bearer()
+
+
+@pytest.fixture
+def new_drink(client, headers):
+    '''
+    new_drink(title, recipe=None)
+        Creates a drink through the API and returns the response.
+    '''
+
+    def create(title, recipe=None):
+        if recipe is None:
+            recipe = [{'name': 'water', 'color': 'blue', 'parts': 1}]
+        response = client.post('/drinks', headers=headers,
+                               json={'title': title, 'recipe': recipe})
+        assert response.status_code == 200, response.get_json()
+        return response
+    return create
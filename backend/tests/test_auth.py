@@ -0,0 +1,63 @@
+"""
+Tests of the auth settings taken from the app config, and of the checks
+a token goes through.
+"""
+
+import json
+import os
+import shutil
+
+from src.api import create_app
+from src.auth import auth
+
+from conftest import AUTH_CONFIG, bearer
+
+
+def test_settings_come_from_the_app_config(app):
+    assert auth.expected_claims == {'audience': AUTH_CONFIG['API_AUDIENCE'],
+                                    'issuer': AUTH_CONFIG['AUTH_ISSUER']}
+    assert isinstance(auth.jwks_store.provider, auth.LocalJWKSProvider)
+    assert auth.jwks_store.provider.path == AUTH_CONFIG['JWKS_PATH']
+
+
+def test_issuer_defaults_to_the_tenant(config):
+    config = dict(config, AUTH_ISSUER=None, AUTH0_DOMAIN='tenant.example')
+    create_app(config)
+    assert auth.expected_claims['issuer'] == 'https://tenant.example/'
+
+
+def test_token_for_another_audience_is_refused(config):
+    client = create_app(dict(config, API_AUDIENCE='elsewhere')) \
+        .test_client()
+    assert client.get('/drinks-detail', headers=bearer()).status_code == 401
+
+
+def test_token_without_the_permission_is_refused(client):
+    headers = bearer(['get:drinks-detail'])
+    assert client.get('/drinks-detail', headers=headers).status_code == 200
+    response = client.post('/drinks', headers=headers,
+                           json={'title': 'latte', 'recipe': []})
+    assert response.status_code == 401
+
+
+def test_malformed_authorization_is_refused(client):
+    for value in ('Token abc', 'Bearer', 'Bearer a b', 'Bearer abc'):
+        response = client.get('/drinks-detail',
+                              headers={'Authorization': value})
+        assert response.status_code == 401
+
+
+def test_cached_token_is_refused_once_its_key_is_withdrawn(
+        config, tmp_path):
+    keys = str(tmp_path / 'keys')
+    shutil.copytree(AUTH_CONFIG['JWKS_PATH'], keys)
+    client = create_app(dict(config, JWKS_PATH=keys)).test_client()
+    headers = bearer()
+    assert client.get('/drinks-detail', headers=headers).status_code == 200
+    assert client.get('/drinks-detail', headers=headers).status_code == 200
+    assert auth.token_cache.hits >= 1
+
+    with open(os.path.join(keys, 'keys.json'), 'w') as f:
+        json.dump({'keys': []}, f)
+    auth.jwks_store.provider._next_poll = 0.0
+    assert client.get('/drinks-detail', headers=headers).status_code == 401
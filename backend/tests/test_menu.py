@@ -0,0 +1,130 @@
+"""
+Tests of the drink lists: their ETags and the menu cache, and the change
+feed of GET /drinks/changes.
+"""
+
+from src.database.cache import menu_cache
+from src.database.models import prune_tombstones
+
+
+# ----------------------------------------------------------------------------#
+#  ETags and the menu cache
+# ----------------------------------------------------------------------------#
+
+def test_list_answers_304_to_its_etag(client, new_drink):
+    new_drink('latte')
+    response = client.get('/drinks')
+    tag = response.headers['ETag']
+    assert response.headers['Cache-Control'] == 'no-cache'
+    again = client.get('/drinks', headers={'If-None-Match': tag})
+    assert again.status_code == 304
+    assert again.headers['ETag'] == tag
+
+
+def test_a_write_changes_the_etag(client, headers, new_drink):
+    drink_id = new_drink('latte').get_json()['drinks']['id']
+    tag = client.get('/drinks').headers['ETag']
+    client.patch('/drinks/%d' % drink_id, headers=headers,
+                 json={'title': 'mocha'})
+    response = client.get('/drinks', headers={'If-None-Match': tag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != tag
+    assert response.get_json()['drinks'][0]['title'] == 'mocha'
+
+
+def test_a_write_drops_the_cached_lists(client, headers, new_drink):
+    new_drink('latte')
+    client.get('/drinks')
+    hits = menu_cache.hits
+    client.get('/drinks')
+    assert menu_cache.hits == hits + 1
+
+    new_drink('mocha')
+    titles = [d['title'] for d in client.get('/drinks').get_json()['drinks']]
+    assert titles == ['latte', 'mocha']
+
+
+def test_apps_on_other_databases_keep_their_own_generation(
+        app, tmp_path):
+    from src.api import create_app
+
+    path = menu_cache.shared.path
+    create_app({'DATABASE_URL': 'sqlite:///' + str(tmp_path / 'other.db'),
+                'RATE_LIMITS': 'off'})
+    assert menu_cache.shared.path != path
+
+
+def test_detail_list_needs_a_token(client, headers, new_drink):
+    new_drink('latte')
+    assert client.get('/drinks-detail').status_code == 401
+    response = client.get('/drinks-detail', headers=headers)
+    assert response.get_json()['drinks'][0]['recipe'][0]['name'] == 'water'
+
+
+# ----------------------------------------------------------------------------#
+#  Changes
+# ----------------------------------------------------------------------------#
+
+def changes(client, since, **args):
+    query = '&'.join('%s=%s' % item for item in
+                     dict(args, since=since).items())
+    return client.get('/drinks/changes?' + query).get_json()
+
+
+def test_changes_from_scratch_hold_every_drink(client, new_drink):
+    new_drink('latte')
+    new_drink('mocha')
+    body = changes(client, 0)
+    assert [d['title'] for d in body['drinks']] == ['latte', 'mocha']
+    assert body['deleted'] == []
+    assert body['more'] is False
+    assert body['reset'] is False
+
+
+def test_changes_since_a_version_hold_the_later_writes(
+        client, headers, new_drink):
+    latte = new_drink('latte').get_json()['drinks']['id']
+    mocha = new_drink('mocha').get_json()['drinks']['id']
+    since = changes(client, 0)['version']
+
+    client.patch('/drinks/%d' % latte, headers=headers,
+                 json={'title': 'flat white'})
+    client.delete('/drinks/%d' % mocha, headers=headers)
+    body = changes(client, since)
+    assert [d['title'] for d in body['drinks']] == ['flat white']
+    assert body['deleted'] == [mocha]
+    assert body['version'] > since
+    assert changes(client, body['version'])['drinks'] == []
+
+
+def test_changes_are_paged_oldest_first(client, new_drink):
+    for title in ('latte', 'mocha', 'cortado'):
+        new_drink(title)
+    first = changes(client, 0, limit=2)
+    assert [d['title'] for d in first['drinks']] == ['latte', 'mocha']
+    assert first['more'] is True
+    rest = changes(client, first['version'], limit=2)
+    assert [d['title'] for d in rest['drinks']] == ['cortado']
+    assert rest['more'] is False
+
+
+def test_changes_before_pruned_tombstones_reset(app, client, headers,
+                                                new_drink):
+    since = changes(client, 0)['version']
+    for title in ('latte', 'mocha'):
+        drink_id = new_drink(title).get_json()['drinks']['id']
+        client.delete('/drinks/%d' % drink_id, headers=headers)
+    new_drink('cortado')
+    with app.app_context():
+        assert prune_tombstones(1) == 1
+
+    body = changes(client, since)
+    assert body['reset'] is True
+    assert [d['title'] for d in body['drinks']] == ['cortado']
+    assert changes(client, body['version'])['reset'] is False
+
+
+def test_changes_since_must_be_a_count(client):
+    for since in ('-1', 'x'):
+        response = client.get('/drinks/changes?since=' + since)
+        assert response.status_code == 400
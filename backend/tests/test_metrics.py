@@ -0,0 +1,44 @@
+"""
+Tests of the SQL statement timing shared by the metrics and the request
+trace.
+"""
+
+import pytest
+from sqlalchemy import exc, text
+
+from src import metrics
+from src.database.models import db
+
+
+@pytest.fixture
+def timed():
+    # The (statement, seconds) pairs passed to an on_statement() hook
+
+    calls = []
+
+    def hook(statement, seconds):
+        calls.append((statement, seconds))
+    metrics.on_statement(hook)
+    yield calls
+    metrics._statement_hooks.remove(hook)
+
+
+def test_each_statement_is_timed_once(app, timed):
+    with app.app_context():
+        with db.engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+            connection.execute(text('SELECT 2'))
+    statements = [s for s, _ in timed if s.startswith('SELECT')]
+    assert statements == ['SELECT 1', 'SELECT 2']
+    assert all(seconds >= 0 for _, seconds in timed)
+
+
+def test_failed_statement_leaves_no_start_time(app, timed):
+    with app.app_context():
+        with db.engine.connect() as connection:
+            with pytest.raises(exc.OperationalError):
+                connection.execute(text('SELECT * FROM no_such_table'))
+            connection.execute(text('SELECT 1'))
+            assert not any(isinstance(value, list)
+                           for value in connection.info.values())
+    assert [s for s, _ in timed] == ['SELECT 1']
@@ -0,0 +1,110 @@
+"""
+Tests of the schema migrations, run on a database in the layout of the
+first release: one drink table holding each recipe as a JSON blob.
+"""
+
+import json
+import multiprocessing
+import sqlite3
+
+import pytest
+
+from src.api import create_app
+from src.database import models
+
+RECIPE = [{'name': 'water', 'color': 'blue', 'parts': 1},
+          {'name': 'milk', 'color': 'white', 'parts': 2}]
+
+
+@pytest.fixture
+def legacy_url(tmp_path):
+    path = str(tmp_path / 'legacy.db')
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE drink (id INTEGER PRIMARY KEY, '
+                       'title VARCHAR(80) UNIQUE, '
+                       'recipe VARCHAR(180) NOT NULL)')
+    connection.executemany('INSERT INTO drink (title, recipe) VALUES (?, ?)',
+                           [('latte', json.dumps(RECIPE)),
+                            ('water', json.dumps(RECIPE[:1]))])
+    connection.commit()
+    connection.close()
+    return 'sqlite:///' + path
+
+
+def query(url, sql):
+    connection = sqlite3.connect(url[len('sqlite:///'):])
+    try:
+        return connection.execute(sql).fetchall()
+    finally:
+        connection.close()
+
+
+def test_legacy_database_is_migrated_to_the_current_schema(legacy_url):
+    client = create_app({'DATABASE_URL': legacy_url,
+                         'RATE_LIMITS': 'off'}).test_client()
+
+    assert query(legacy_url, 'SELECT version FROM schema_version') == \
+        [(models.SCHEMA_VERSION,)]
+
+    # 1: the recipes moved into ingredient rows
+    assert query(legacy_url, 'SELECT drink_id, position, name, parts '
+                             'FROM ingredient ORDER BY drink_id, position') \
+        == [(1, 0, 'water', 1), (1, 1, 'milk', 2), (2, 0, 'water', 1)]
+    drinks = client.get('/drinks').get_json()['drinks']
+    assert [d['title'] for d in drinks] == ['latte', 'water']
+    assert [len(d['recipe']) for d in drinks] == [2, 1]
+
+    # 2: the drinks are numbered in id order
+    assert query(legacy_url, 'SELECT id, version FROM drink') == \
+        [(1, 1), (2, 2)]
+
+    # 3: titles and ingredients are searchable
+    found = client.get('/drinks?q=milk').get_json()['drinks']
+    assert [d['title'] for d in found] == ['latte']
+
+
+def test_migrated_database_is_left_alone(legacy_url):
+    create_app({'DATABASE_URL': legacy_url, 'RATE_LIMITS': 'off'})
+    before = query(legacy_url, 'SELECT * FROM ingredient')
+    create_app({'DATABASE_URL': legacy_url, 'RATE_LIMITS': 'off'})
+    assert query(legacy_url, 'SELECT * FROM ingredient') == before
+
+
+def test_unreadable_recipe_stops_migration_1(legacy_url):
+    connection = sqlite3.connect(legacy_url[len('sqlite:///'):])
+    connection.execute("UPDATE drink SET recipe = '{not json' WHERE id = 2")
+    connection.commit()
+    connection.close()
+
+    with pytest.raises(RuntimeError):
+        create_app({'DATABASE_URL': legacy_url, 'RATE_LIMITS': 'off'})
+    assert query(legacy_url, 'SELECT recipe FROM drink WHERE id = 2') == \
+        [('{not json',)]
+
+
+def _start_worker(url, queue):
+    calls = []
+    for version, migrate in list(models.MIGRATIONS.items()):
+        models.MIGRATIONS[version] = \
+            (lambda v, m: lambda: (calls.append(v), m()))(version, migrate)
+    try:
+        create_app({'DATABASE_URL': url, 'RATE_LIMITS': 'off'})
+        queue.put(calls)
+    except Exception as e:
+        queue.put(repr(e))
+
+
+def test_only_one_starting_worker_migrates(legacy_url):
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    workers = [context.Process(target=_start_worker,
+                               args=(legacy_url, queue))
+               for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    results = [queue.get(timeout=60) for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    assert all(isinstance(calls, list) for calls in results), results
+    assert sorted(v for calls in results for v in calls) == [1, 2, 3]
@@ -0,0 +1,108 @@
+"""
+Tests of the rate limits: the budgets of the routes and the token buckets
+behind them.
+"""
+
+import pytest
+
+from src.api import create_app
+from src.ratelimit import BucketStore, limiter, parse_limits
+
+from conftest import bearer
+
+
+@pytest.fixture
+def limited(config, tmp_path):
+    '''
+    limited(limits)
+        Returns a test client of an app with the RATE_LIMITS limits.
+    '''
+
+    def client(limits, **settings):
+        return create_app(dict(
+            config, RATE_LIMITS=limits,
+            RATE_LIMIT_FILE=str(tmp_path / 'buckets'),
+            **settings)).test_client()
+    return client
+
+
+def test_public_budget_is_kept_per_client_address(limited):
+    client = limited('public=1/3')
+    codes = [client.get('/drinks').status_code for _ in range(4)]
+    assert codes == [200, 200, 200, 429]
+    assert int(client.get('/drinks').headers['Retry-After']) >= 1
+    other = client.get('/drinks', environ_base={'REMOTE_ADDR': '10.0.0.9'})
+    assert other.status_code == 200
+
+
+def test_public_routes_are_unlimited_by_default(database_url):
+    client = create_app({'DATABASE_URL': database_url}).test_client()
+    assert 'public' not in limiter.limits
+    assert all(client.get('/drinks').status_code == 200
+               for _ in range(150))
+
+
+def test_trusted_proxies_give_the_forwarded_client_address(limited):
+    client = limited('public=1/1', TRUSTED_PROXIES=1)
+    first = {'X-Forwarded-For': '203.0.113.1'}
+    assert client.get('/drinks', headers=first).status_code == 200
+    assert client.get('/drinks', headers=first).status_code == 429
+    second = {'X-Forwarded-For': '203.0.113.2'}
+    assert client.get('/drinks', headers=second).status_code == 200
+
+
+def test_forwarded_address_is_ignored_without_trusted_proxies(limited):
+    client = limited('public=1/1')
+    assert client.get('/drinks', headers={
+        'X-Forwarded-For': '203.0.113.1'}).status_code == 200
+    assert client.get('/drinks', headers={
+        'X-Forwarded-For': '203.0.113.2'}).status_code == 429
+
+
+def test_apps_on_other_databases_keep_their_own_buckets(tmp_path):
+    paths = set()
+    for name in ('one.db', 'two.db'):
+        create_app({'DATABASE_URL': 'sqlite:///' + str(tmp_path / name)})
+        paths.add(limiter.store.path)
+    assert len(paths) == 2
+
+
+def test_permission_budget_is_kept_per_subject(limited):
+    client = limited('post:drinks=1/2')
+    headers = bearer()
+    codes = [client.post('/drinks', headers=headers,
+                         json={'title': 'drink %d' % i, 'recipe': []})
+             .status_code for i in range(3)]
+    assert codes == [200, 200, 429]
+    response = client.post('/drinks', headers=bearer(subject='barista'),
+                           json={'title': 'drink 9', 'recipe': []})
+    assert response.status_code == 200
+
+
+def test_unauthorized_requests_are_refused_before_the_budget(limited):
+    client = limited('get:drinks-detail=1/1')
+    assert [client.get('/drinks-detail').status_code
+            for _ in range(3)] == [401, 401, 401]
+
+
+def test_budgets_not_listed_are_unlimited(limited):
+    client = limited('post:drinks=1/1')
+    assert all(client.get('/drinks').status_code == 200
+               for _ in range(5))
+
+
+def test_bucket_refills_at_its_rate(tmp_path):
+    store = BucketStore(str(tmp_path / 'buckets'), 64)
+    assert store.take('key', 1, 2, now=100.0) == 0
+    assert store.take('key', 1, 2, now=100.0) == 0
+    assert store.take('key', 1, 2, now=100.0) > 0
+    assert store.take('key', 1, 2, now=101.0) == 0
+
+
+def test_parse_limits():
+    assert parse_limits('off') == {}
+    assert parse_limits('public=50/100, post:drinks=2.5/10') == \
+        {'public': (50.0, 100.0), 'post:drinks': (2.5, 10.0)}
+    for spec in ('public', 'public=1', 'public=0/1', '=1/1'):
+        with pytest.raises(ValueError):
+            parse_limits(spec)
@@ -0,0 +1,309 @@
+"""
+Tests of the drink writes: create, conditional update and delete, and the
+batch routes.
+"""
+
+import asyncio
+import gzip
+import json
+
+import pytest
+
+from src.database.models import Drink, _apply_batch, db
+
+RECIPE = [{'name': 'milk', 'color': 'white', 'parts': 2}]
+
+
+def version(response):
+    # The version of a drink is the ETag of its write response
+    return int(response.headers['ETag'].strip('"'))
+
+
+# ----------------------------------------------------------------------------#
+#  Single writes
+# ----------------------------------------------------------------------------#
+
+def test_create_answers_the_drink_and_its_version(new_drink):
+    response = new_drink('latte', RECIPE)
+    body = response.get_json()
+    assert body['success'] is True
+    assert body['drinks']['title'] == 'latte'
+    assert body['drinks']['recipe'] == RECIPE
+    assert response.headers['ETag'].strip('"').isdigit()
+
+
+def test_create_without_a_token_is_refused(client):
+    response = client.post('/drinks', json={'title': 'latte', 'recipe': []})
+    assert response.status_code == 401
+
+
+def test_create_with_a_duplicate_title_is_refused(client, headers,
+                                                  new_drink):
+    new_drink('latte')
+    response = client.post('/drinks', headers=headers,
+                           json={'title': 'latte', 'recipe': []})
+    assert response.status_code == 422
+
+
+def test_update_sets_title_and_recipe(client, headers, new_drink):
+    created = new_drink('latte')
+    response = client.patch(
+        '/drinks/%d' % created.get_json()['drinks']['id'], headers=headers,
+        json={'title': 'flat white', 'recipe': RECIPE})
+    assert response.status_code == 200
+    updated = response.get_json()['drinks'][0]
+    assert updated['title'] == 'flat white'
+    assert updated['recipe'] == RECIPE
+    assert version(response) > version(created)
+
+
+def test_update_of_a_missing_drink_is_404(client, headers):
+    response = client.patch('/drinks/99', headers=headers,
+                            json={'title': 'tea'})
+    assert response.status_code == 404
+
+
+def test_update_with_the_current_if_match_succeeds(client, headers,
+                                                   new_drink):
+    created = new_drink('latte')
+    response = client.patch(
+        '/drinks/%d' % created.get_json()['drinks']['id'],
+        headers=dict(headers, **{'If-Match': created.headers['ETag']}),
+        json={'title': 'mocha'})
+    assert response.status_code == 200
+
+
+MALFORMED_RECIPES = [
+    'water',
+    [1],
+    [{'name': 'water'}],
+    [{'name': 'water', 'color': 'blue', 'parts': 'abc'}],
+    [{'name': 'water', 'color': 'blue', 'parts': [1]}],
+    [{'name': 'water', 'color': 'blue', 'parts': None}],
+    [{'name': ['water'], 'color': 'blue', 'parts': 1}],
+    [{'name': 'water', 'color': {'blue': 1}, 'parts': 1}],
+]
+
+
+@pytest.mark.parametrize('recipe', MALFORMED_RECIPES)
+def test_update_with_a_malformed_recipe_is_422(client, headers, new_drink,
+                                               recipe):
+    drink_id = new_drink('latte', RECIPE).get_json()['drinks']['id']
+    response = client.patch('/drinks/%d' % drink_id, headers=headers,
+                            json={'title': 'mocha', 'recipe': recipe})
+    assert response.status_code == 422
+    drink = client.get('/drinks-detail', headers=headers) \
+        .get_json()['drinks'][0]
+    assert drink['title'] == 'latte'
+    assert drink['recipe'] == RECIPE
+
+
+@pytest.mark.parametrize('recipe', MALFORMED_RECIPES)
+def test_asgi_update_with_a_malformed_recipe_is_422(config, headers,
+                                                    new_drink, recipe):
+    pytest.importorskip('quart')
+    from src.asgi import create_asgi_app
+
+    drink_id = new_drink('latte', RECIPE).get_json()['drinks']['id']
+    client = create_asgi_app(config).test_client()
+    response = asyncio.run(client.patch(
+        '/drinks/%d' % drink_id, headers=headers,
+        json={'title': 'mocha', 'recipe': recipe}))
+    assert response.status_code == 422
+
+
+def test_update_with_a_stale_if_match_is_412(client, headers, new_drink):
+    created = new_drink('latte')
+    drink_id = created.get_json()['drinks']['id']
+    client.patch('/drinks/%d' % drink_id, headers=headers,
+                 json={'title': 'mocha'})
+    response = client.patch(
+        '/drinks/%d' % drink_id,
+        headers=dict(headers, **{'If-Match': created.headers['ETag']}),
+        json={'title': 'cortado'})
+    assert response.status_code == 412
+    assert client.get('/drinks').get_json()['drinks'][0]['title'] == 'mocha'
+
+
+def test_update_with_the_etag_of_a_compressed_response_succeeds(
+        client, headers):
+    recipe = [{'name': 'ingredient %d' % i, 'color': 'brown', 'parts': 1}
+              for i in range(40)]
+    created = client.post('/drinks', json={'title': 'latte',
+                                           'recipe': recipe},
+                          headers=dict(headers, **{'Accept-Encoding': 'gzip'}))
+    assert created.headers['Content-Encoding'] == 'gzip'
+    assert created.headers['ETag'].endswith('-gzip"')
+    drink = json.loads(gzip.decompress(created.get_data()))['drinks']
+    response = client.patch(
+        '/drinks/%d' % drink['id'],
+        headers=dict(headers, **{'If-Match': created.headers['ETag']}),
+        json={'title': 'mocha'})
+    assert response.status_code == 200
+
+
+def test_update_with_a_stale_version_is_409(client, headers, new_drink):
+    created = new_drink('latte')
+    drink_id = created.get_json()['drinks']['id']
+    client.patch('/drinks/%d' % drink_id, headers=headers,
+                 json={'title': 'mocha'})
+    response = client.patch('/drinks/%d' % drink_id, headers=headers,
+                            json={'title': 'cortado',
+                                  'version': version(created)})
+    assert response.status_code == 409
+
+
+def test_update_with_a_version_that_is_not_an_integer_is_422(
+        client, headers, new_drink):
+    drink = new_drink('latte').get_json()['drinks']
+    for value in ('1', True, 1.5):
+        response = client.patch('/drinks/%d' % drink['id'], headers=headers,
+                                json={'title': 'mocha', 'version': value})
+        assert response.status_code == 422
+
+
+def test_delete_with_a_stale_if_match_is_412(client, headers, new_drink):
+    created = new_drink('latte')
+    drink_id = created.get_json()['drinks']['id']
+    client.patch('/drinks/%d' % drink_id, headers=headers,
+                 json={'title': 'mocha'})
+    response = client.delete(
+        '/drinks/%d' % drink_id,
+        headers=dict(headers, **{'If-Match': created.headers['ETag']}))
+    assert response.status_code == 412
+
+
+def test_delete_answers_the_id(client, headers, new_drink):
+    drink_id = new_drink('latte').get_json()['drinks']['id']
+    response = client.delete('/drinks/%d' % drink_id, headers=headers)
+    assert response.get_json() == {'success': True, 'deleted': drink_id}
+    assert client.delete('/drinks/%d' % drink_id,
+                         headers=headers).status_code == 404
+
+
+# ----------------------------------------------------------------------------#
+#  Batches
+# ----------------------------------------------------------------------------#
+
+def test_batch_create_reports_each_drink(client, headers):
+    response = client.post('/drinks/batch', headers=headers, json={
+        'drinks': [{'title': 'latte', 'recipe': RECIPE},
+                   {'title': 'latte', 'recipe': []},
+                   {'title': 'mocha', 'recipe': []}]})
+    results = response.get_json()['results']
+    assert [r['success'] for r in results] == [True, False, True]
+    assert results[1]['error'] == 409
+    titles = [d['title'] for d in client.get('/drinks').get_json()['drinks']]
+    assert titles == ['latte', 'mocha']
+
+
+def test_batch_update_reports_each_drink(client, headers, new_drink):
+    drink_id = new_drink('latte').get_json()['drinks']['id']
+    response = client.patch('/drinks/batch', headers=headers, json={
+        'drinks': [{'id': drink_id, 'title': 'mocha'},
+                   {'id': 99, 'title': 'tea'}]})
+    results = response.get_json()['results']
+    assert results[0]['success'] is True
+    assert results[0]['drinks']['title'] == 'mocha'
+    assert results[1] == {'success': False, 'error': 404,
+                          'message': 'Drink not found.'}
+
+
+def test_batch_delete_reports_each_drink(client, headers, new_drink):
+    drink_id = new_drink('latte').get_json()['drinks']['id']
+    response = client.delete('/drinks/batch', headers=headers,
+                             json={'ids': [drink_id, 99]})
+    results = response.get_json()['results']
+    assert results[0] == {'success': True, 'deleted': drink_id}
+    assert results[1]['success'] is False
+    assert results[1]['error'] == 404
+    assert client.get('/drinks').get_json()['drinks'] == []
+
+
+def test_batch_must_hold_a_list(client, headers):
+    for body in ({}, {'drinks': []}, {'drinks': 'latte'}):
+        response = client.post('/drinks/batch', headers=headers, json=body)
+        assert response.status_code == 400
+
+
+def test_batch_update_refuses_a_second_item_for_a_drink(
+        client, headers, new_drink):
+    drink_id = new_drink('latte').get_json()['drinks']['id']
+    response = client.patch('/drinks/batch', headers=headers, json={
+        'drinks': [{'id': drink_id, 'title': 'mocha'},
+                   {'id': drink_id, 'title': 'cortado'}]})
+    results = response.get_json()['results']
+    assert results[0]['drinks']['title'] == 'mocha'
+    assert results[1] == {'success': False, 'error': 409,
+                          'message': 'Duplicate drink id.'}
+
+
+def test_batch_reports_each_malformed_recipe(client, headers, new_drink):
+    drink_id = new_drink('latte').get_json()['drinks']['id']
+    malformed = [{'name': 'water', 'color': 'blue', 'parts': None},
+                 {'name': ['water'], 'color': 'blue', 'parts': 1}]
+    items = [{'title': 'tea %d' % i, 'recipe': [ingredient]}
+             for i, ingredient in enumerate(malformed)]
+    created = client.post('/drinks/batch', headers=headers, json={
+        'drinks': items + [{'title': 'mocha', 'recipe': RECIPE}]}) \
+        .get_json()['results']
+    assert [r['success'] for r in created] == [False, False, True]
+    assert [r.get('error') for r in created[:2]] == [422, 422]
+
+    updated = client.patch('/drinks/batch', headers=headers, json={
+        'drinks': [{'id': drink_id, 'recipe': [malformed[0]]}]}) \
+        .get_json()['results']
+    assert updated[0]['error'] == 422
+    titles = [d['title'] for d in client.get('/drinks').get_json()['drinks']]
+    assert titles == ['latte', 'mocha']
+
+
+def test_batch_update_reports_a_title_taken_by_another_drink(
+        client, headers, new_drink):
+    latte = new_drink('latte').get_json()['drinks']['id']
+    mocha = new_drink('mocha').get_json()['drinks']['id']
+    response = client.patch('/drinks/batch', headers=headers, json={
+        'drinks': [{'id': latte, 'title': 'mocha'},
+                   {'id': mocha, 'title': 'cortado'}]})
+    results = response.get_json()['results']
+    assert results[0] == {'success': False, 'error': 409,
+                          'message': 'Duplicate title.'}
+    assert results[1]['drinks']['title'] == 'cortado'
+    titles = [d['title'] for d in client.get('/drinks').get_json()['drinks']]
+    assert titles == ['latte', 'cortado']
+
+
+def test_batch_item_refused_at_flush_is_reported(app, new_drink):
+
+    # A title taken between the batch's check and its flush, as by a
+    # concurrent write, is only refused when the savepoint flushes
+
+    new_drink('latte')
+
+    def adder(title):
+        def add():
+            drink = Drink(title=title, recipe=[])
+            drink.materialize()
+            db.session.add(drink)
+            return drink
+        return add
+
+    results = [None, None]
+    with app.app_context():
+        _apply_batch([(0, adder('latte')), (1, adder('mocha'))], results,
+                     'created')
+        titles = [d.title for d in Drink.query.order_by(Drink.id)]
+    assert results[0] == {'success': False, 'error': 409,
+                          'message': 'Duplicate title.'}
+    assert results[1]['success'] is True
+    assert titles == ['latte', 'mocha']
+
+
+def test_batch_delete_refuses_ids_that_are_not_integers(client, headers,
+                                                        new_drink):
+    drink_id = new_drink('latte').get_json()['drinks']['id']
+    for ids in ([drink_id, True], [drink_id, '1'], [drink_id, 1.0]):
+        response = client.delete('/drinks/batch', headers=headers,
+                                 json={'ids': ids})
+        assert response.status_code == 400
+    assert len(client.get('/drinks').get_json()['drinks']) == 1